@@ -1,78 +1,889 @@
+"""
+Purpose of script: runs the in year publication process.
+
+The tables created, input and output files and years default to the values
+in parameters_inyear.py and can be overridden from the command line, e.g.
+
+    ncmp-inyear bmi_prev dqla --jobs 2
+    ncmp-inyear --dry-run
+    ncmp-inyear --batch extract_1.csv extract_2.csv --output-format excel parquet
+    ncmp-inyear --la-shards --jobs 8
+    ncmp-inyear --rerun-la E06000001
+"""
+import argparse
+import contextlib
+import importlib.util
+import pathlib
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
 import pandas as pd
 
 import ncmp_inyear_code.parameters_inyear as param
 import ncmp_inyear_code.utilities.import_inyeardata as import_inyeardata
-from ncmp_inyear_code.utilities.table_bmi_prev import create_table_bmi_prev
+from ncmp_inyear_code.utilities.reference_cache import snapshot_exists
+from ncmp_inyear_code.utilities.export_inyear import (export_outputs, summarise_exports, record_failure,
+                                                      create_output_workbook, EXPORT_FORMATS)
+from ncmp_inyear_code.utilities.import_timing import check_import_times
+from ncmp_inyear_code.utilities.regression_check import run_regression_check
+from ncmp_inyear_code.utilities.shared_frames import share_frames, open_shared_frames
+from ncmp_inyear_code.utilities.significance import add_significance_tests
+from ncmp_inyear_code.utilities.build_cache import get_build_key, read_build, write_build, build_cache_status
+from ncmp_inyear_code.utilities.sql_cache import describe_entries, clear_entries, get_query_key, get_cached_info
+from ncmp_inyear_code.utilities.la_dq_history import add_la_dq_snapshot
+from ncmp_inyear_code.utilities.la_shards import split_la_shards, merge_la_counts, write_la_counts, read_la_counts
+from ncmp_inyear_code.utilities.table_bmi_prev import create_table_bmi_prev, count_bmi_prev
 from ncmp_inyear_code.utilities.table_dqla import create_table_dqla
-from ncmp_inyear_code.utilities.table_ethnicity_imd import create_table_ethnicity_imd
-from ncmp_inyear_code.utilities.table_school_cohort import create_table_school_cohort
-from ncmp_inyear_code.utilities.table_weighting import create_table_weighting
+from ncmp_inyear_code.utilities.table_ethnicity_imd import create_table_ethnicity_imd, count_ethnicity_imd
+from ncmp_inyear_code.utilities.table_school_cohort import create_table_school_cohort, count_school_cohort
+from ncmp_inyear_code.utilities.table_weighting import create_table_weighting, aggregate_baseyears
+
+# Tables that can be created and the parameter that selects each one by default
+TABLES = {"bmi_prev": "TABLE_BMI_PREV",  # Tables 1 and 2
+          "dqla": "TABLE_DQLA",  # Tables A1 to A3
+          "eth_imd": "TABLE_ETH_IMD",  # Tables B and C
+          "sch_cohort": "TABLE_SCH_COHORT",  # Table D
+          "weighting": "TABLE_WEIGHTING"}  # Table E
+
+# Imported data required by each table
+TABLE_INPUTS = {"bmi_prev": ["df_pupils_import"],
+                "dqla": ["df_la_import", "df_la_compyear", "df_la_lookups"],
+                "eth_imd": ["df_pupils_import", "df_pupils_compyear",
+                            "df_ethnicity_ref"],
+                "sch_cohort": ["df_pupils_import", "df_pupils_compyear"],
+                "weighting": ["df_pupils_import", "df_pupils_baseyears",
+                              "df_ethnicity_ref", "df_lsoa_ref", "df_la_e07_ref",
+                              "df_ethnicity_ref_ohid", "df_imd_ref_ohid",
+                              "df_la_lookups"]}
+
+# Function creating each table, used to version cached table builds
+TABLE_FUNCTIONS = {"bmi_prev": create_table_bmi_prev,
+                   "dqla": create_table_dqla,
+                   "eth_imd": create_table_ethnicity_imd,
+                   "sch_cohort": create_table_school_cohort,
+                   "weighting": create_table_weighting}
+
+# Functions counting the pupils for the tables that can be created from counts
+# made for each LA separately (see IY_LA_SHARDS), taking the TABLE_INPUTS
+# they use as keyword arguments
+TABLE_COUNT_FUNCTIONS = {"bmi_prev": count_bmi_prev,
+                         "eth_imd": count_ethnicity_imd,
+                         "sch_cohort": count_school_cohort}
+
+# Columns used by each table, for the imported data where a table uses only
+# some of the columns - used to fingerprint the inputs of cached table builds
+# and to read only these columns in worker processes, so must list every
+# column the table uses
+TABLE_COLUMNS = {"bmi_prev": {"df_pupils_import": ["BmiPopulationCategory", "BmiPScore",
+                                                   "Gender", "NcmpSystemId",
+                                                   "SchoolYear", "SevereObese"]},
+                 "dqla": {},
+                 "eth_imd": {"df_pupils_import": ["NcmpEthnicityCode", "NcmpSystemId",
+                                                  "NhsEthnicityDescription",
+                                                  "PupilIndexOfMultipleDeprivationD",
+                                                  "SchoolYear"],
+                             "df_pupils_compyear": ["NcmpEthnicityCode", "NcmpSystemId",
+                                                    "NhsEthnicityCode",
+                                                    "PupilIndexOfMultipleDeprivationD",
+                                                    "SchoolYear"]},
+                 "sch_cohort": {"df_pupils_import": ["BmiPopulationCategory", "NcmpSystemId",
+                                                     "SchoolUrn", "SchoolYear"],
+                                "df_pupils_compyear": ["BmiPopulationCategory", "NcmpSystemId",
+                                                       "SchoolUrn", "SchoolYear"]},
+                 "weighting": {"df_pupils_import": ["BmiPopulationCategory", "ImdDecile",
+                                                    "NcmpSystemId", "NhsEthnicityDescription",
+                                                    "OrgCode", "SchoolLowerSuperOutputArea2011",
+                                                    "SchoolUrn", "SchoolYear"]}}
+
+# Parameters used by each table - used to fingerprint cached table builds
+TABLE_PARAMS = {"bmi_prev": ["PUPILS_FILE", "BMI_DERIVED_CATEGORIES"],
+                "dqla": ["LA_IY_FILE", "LA_IY_COMPEXCLUDE", "IY_COMPYEAR"],
+                "eth_imd": ["PUPILS_FILE", "IY_THISYEAR"],
+                "sch_cohort": ["PUPILS_FILE", "IY_THISYEAR", "SCHOOL_PREVALENCE"],
+                "weighting": ["PUPILS_FILE", "IY_THISYEAR", "IY_COMPYEAR",
+                              "URN_UPDATE_WEIGHTING_LA", "WEIGHTING_METHOD",
+                              "RAKING_TOLERANCE", "RAKING_MAX_ITERATIONS",
+                              "WEIGHT_TRIM", "WEIGHT_SENSITIVITY",
+                              "WEIGHT_SENSITIVITY_TRIMS", "WEIGHT_SENSITIVITY_CAPS"]}
+
+
+def describe_import(name):
+    """
+    Returns a description of the source of the imported data specified,
+    used when printing the planned import steps
+    """
+    sources = {"df_pupils_import": param.PUPILS_DATA_PATH,
+               "df_pupils_compyear": f"query_pupils_compyear.sql ({param.IY_COMPYEAR})",
+               "df_ethnicity_ref": "query_ethnicity_ref.sql",
+               "df_pupils_baseyears": f"query_pupils_baseyears.sql ({param.IY_BASEYEARS})",
+               "df_ethnicity_ref_ohid": param.ETHNIC_GROUP_PATH,
+               "df_imd_ref_ohid": param.IMD_QUINTILE_PATH,
+               "df_lsoa_ref": "query_lsoa_ref.sql",
+               "df_la_e07_ref": "query_la_e07_ref.sql",
+               "df_la_import": param.LA_IY_DATA_PATH,
+               "df_la_compyear": f"query_la_compyear.sql ({param.IY_COMPYEAR})",
+               "df_la_lookups": param.LA_IY_LOOKUP_PATH}
+
+    return str(sources[name])
+
+
+# Local snapshots used for reference data imports
+REF_SNAPSHOTS = {"df_ethnicity_ref": "ethnicity_ref",
+                 "df_lsoa_ref": "lsoa_ref",
+                 "df_la_e07_ref": "la_e07_ref"}
+
+# Imports of closed years from SQL, using the query result cache, with the
+# query file, its placeholder and the parameter filling the placeholder
+SQL_CACHED_IMPORTS = {"df_pupils_compyear": ("query_pupils_compyear.sql", "<IY_COMPYEAR>", "IY_COMPYEAR"),
+                      "df_pupils_baseyears": ("query_pupils_baseyears.sql", "<IY_BASEYEARS>", "IY_BASEYEARS"),
+                      "df_la_compyear": ("query_la_compyear.sql", "<IY_COMPYEAR>", "IY_COMPYEAR")}
+
+
+def import_cache_status(name):
+    """
+    Returns whether the imported data specified will be read from a local
+    cache ("cached") or from its source ("uncached").
+    SQL imports are cached if the query result cache holds an unexpired
+    result of the query as rendered for this run
+    """
+    if param.REF_CACHE and name in REF_SNAPSHOTS and snapshot_exists(REF_SNAPSHOTS[name]):
+        return "cached if source version unchanged"
+
+    if param.SQL_CACHE and name in SQL_CACHED_IMPORTS:
+        sql_file_name, placeholder, year_param = SQL_CACHED_IMPORTS[name]
+
+        query = import_inyeardata.render_query(sql_file_name, placeholder,
+                                               getattr(param, year_param))
+        key = get_query_key(query, import_inyeardata.SQL_SERVER, import_inyeardata.SQL_DATABASE)
+        info = get_cached_info(key)
+
+        if info is not None:
+            return f"cached, queried {info['cached']}"
+
+    return "uncached"
+
+
+def import_data(name):
+    """
+    Imports the data specified, using the input files and years set in the
+    parameters file
+
+    Parameters:
+        name:
+            name of the imported data, as used in TABLE_INPUTS
+
+    Returns:
+        Dataframe of imported data
+    """
+    if name == "df_pupils_import":
+        # Import pupil data (NCMP schools only with BMI measurements)
+        return import_inyeardata.import_pupils_data(param.PUPILS_DATA_PATH)
+
+    if name == "df_pupils_compyear":
+        # Import comparison year data from NCMP SQL table
+        return import_inyeardata.import_pupils_compyear(param.IY_COMPYEAR)
+
+    if name == "df_ethnicity_ref":
+        # Import ethnicity reference data
+        return import_inyeardata.import_ethnicity_ref()
+
+    if name == "df_pupils_baseyears":
+        # Import pupil data for base years
+        return import_inyeardata.import_pupils_baseyears(param.IY_BASEYEARS)
+
+    if name == "df_ethnicity_ref_ohid":
+        # Import OHID ethnicity reference data
+        print("import_inyeardata - importing OHID ethnicity reference data")
+        return pd.read_csv(param.ETHNIC_GROUP_PATH)
+
+    if name == "df_imd_ref_ohid":
+        # Import OHID IMD reference data
+        print("import_inyeardata - importing OHID IMD reference data")
+        return pd.read_csv(param.IMD_QUINTILE_PATH)
+
+    if name == "df_lsoa_ref":
+        # Import LSOA reference data
+        return import_inyeardata.import_lsoa_ref()
+
+    if name == "df_la_e07_ref":
+        # Import LA reference data for E07 codes
+        return import_inyeardata.import_la_e07_ref()
+
+    if name == "df_la_import":
+        # Import LA DQ data
+        return import_inyeardata.import_LA_DQ_data(param.LA_IY_DATA_PATH)
+
+    if name == "df_la_compyear":
+        # Import comparison year data from NCMP SQL table
+        return import_inyeardata.import_LA_compyear(param.IY_COMPYEAR)
+
+    if name == "df_la_lookups":
+        # Import LA to reporting region lookups
+        print("import_inyeardata - importing LA to reporting region lookups")
+        return pd.read_csv(param.LA_IY_LOOKUP_PATH)
+
+    raise ValueError(f"Unknown import: {name}")
+
+
+def add_la_dq_trends(outputs, df_la_import):
+    """
+    Adds the LA data quality snapshot of the dqla outputs given to the
+    history, and the month-on-month trends output to the outputs. Run once
+    after dqla is created or read from the build cache, so the table build
+    itself does not change the history
+
+    Parameters:
+        outputs:
+            dictionary of {sheet name: output dataframe} of the dqla table
+        df_la_import:
+            imported LA data quality data
+
+    Returns:
+        Dictionary of {sheet name: output dataframe}, with LA_DQ_Trends added
+    """
+    df_dqla = outputs["LA_InYear"]
+    df_eng = df_dqla.loc[df_dqla["TableRef"] == "A3: England DQ indicators", ["Indicator", "Value"]]
+
+    return {**outputs, "LA_DQ_Trends": add_la_dq_snapshot(df_la_import, df_eng,
+                                                          df_dqla["LADQExtractDate"].iloc[0])}
+
+
+def build_table(table, data, counts=None):
+    """
+    Creates the outputs for the table specified from the imported data,
+    using the years and exclusions set in the parameters file
+
+    Parameters:
+        table:
+            name of the table, as used in TABLES
+        data:
+            dictionary of {import name: dataframe} holding the data in
+            TABLE_INPUTS for the table
+        counts:
+            pupil counts added together across LAs, for the tables in
+            TABLE_COUNT_FUNCTIONS (optional)
+
+    Returns:
+        Dictionary of {sheet name: output dataframe}
+    """
+    if table == "bmi_prev":
+        return create_table_bmi_prev(data["df_pupils_import"], counts=counts)
+
+    if table == "dqla":
+        return create_table_dqla(data["df_la_import"], data["df_la_compyear"],
+                                 data["df_la_lookups"], param.LA_IY_COMPEXCLUDE)
+
+    if table == "eth_imd":
+        return create_table_ethnicity_imd(data["df_pupils_import"],
+                                          data["df_pupils_compyear"],
+                                          data["df_ethnicity_ref"],
+                                          param.IY_THISYEAR, counts=counts)
+
+    if table == "sch_cohort":
+        return create_table_school_cohort(data["df_pupils_import"],
+                                          data["df_pupils_compyear"],
+                                          param.IY_THISYEAR, counts=counts)
+
+    if table == "weighting":
+        # Base years data aggregated once for all extracts in batch mode
+        baseyears = ({name: data[name] for name in ["df_baseyears_weight", "df_compyear_weight"]}
+                     if "df_baseyears_weight" in data else None)
+
+        return create_table_weighting(data["df_pupils_import"],
+                                      data.get("df_pupils_baseyears"),
+                                      data["df_ethnicity_ref"],
+                                      data["df_lsoa_ref"], data["df_la_e07_ref"],
+                                      data["df_ethnicity_ref_ohid"],
+                                      data["df_imd_ref_ohid"],
+                                      param.IY_THISYEAR, param.IY_COMPYEAR,
+                                      df_la_lookups=data["df_la_lookups"],
+                                      baseyears=baseyears)
+
+    raise ValueError(f"Unknown table: {table}")
+
+
+def prefetch_imports(imports):
+    """
+    Starts all the imports specified at the same time in a pool of threads,
+    so SQL queries and file reads overlap rather than waiting on each other
+
+    Parameters:
+        imports:
+            list of import names, as used in TABLE_INPUTS
+
+    Returns:
+        Dictionary of {import name: future of the imported data}
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, min(param.IY_IMPORT_THREADS,
+                                                         len(imports))))
+
+    futures = {name: executor.submit(import_data, name) for name in imports}
+
+    # Imports already started run to completion
+    executor.shutdown(wait=False)
+
+    return futures
+
+
+def build_shared_table(table, shared):
+    """
+    Creates the outputs for the table specified from imported data shared
+    as memory-mapped files, reading only the columns the table uses
+
+    Parameters:
+        table:
+            name of the table, as used in TABLES
+        shared:
+            dictionary of {import name: Feather file path or imported data}
+            holding the data in TABLE_INPUTS for the table
+
+    Returns:
+        Dictionary of {sheet name: output dataframe}
+    """
+    return build_table(table, open_shared_frames(shared, TABLE_COLUMNS[table]))
+
+
+def count_table(table, shard):
+    """
+    Counts the pupils for the table specified in one LA shard
+    """
+    return TABLE_COUNT_FUNCTIONS[table](**shard)
+
+
+def build_sharded_table(table, data, overrides, rerun_las=None):
+    """
+    Creates the outputs for the table specified from pupil counts made for
+    each LA in parallel worker processes and added together. The counts for
+    each LA are stored, so that when rerunning LAs only those LAs are
+    recounted and the stored counts are used for the other LAs
+
+    Parameters:
+        table:
+            name of the table, as used in TABLE_COUNT_FUNCTIONS
+        data:
+            dictionary of {import name: dataframe} holding the data in
+            TABLE_INPUTS for the table
+        overrides:
+            dictionary of {parameter name: value} applied in the workers
+        rerun_las:
+            list of LA codes to recount (optional, default all LAs)
+
+    Returns:
+        Dictionary of {sheet name: output dataframe}
+    """
+    shards = split_la_shards(data)
+
+    if rerun_las:
+        counts = read_la_counts(table)
+
+        # LAs rerun without any pupils in the data are removed
+        for la in set(rerun_las) - set(shards):
+            counts.pop(la, None)
+
+        shards = {la: shards[la] for la in rerun_las if la in shards}
+    else:
+        counts = {}
+
+    print(f"create_publication_inyear - counting {table} for {len(shards)} LA(s)")
+
+    if param.IY_JOBS > 1 and len(shards) > 1:
+        with ProcessPoolExecutor(max_workers=min(param.IY_JOBS, len(shards)),
+                                 initializer=apply_overrides,
+                                 initargs=(overrides,)) as executor:
+            futures = {la: executor.submit(count_table, table, shard)
+                       for la, shard in shards.items()}
+
+            counts.update({la: future.result() for la, future in futures.items()})
+    else:
+        counts.update({la: count_table(table, shard) for la, shard in shards.items()})
+
+    write_la_counts(table, counts)
+
+    return build_table(table, data, counts=merge_la_counts(counts))
+
+
+def plan_imports(tables):
+    """
+    Returns the list of imports required for the tables specified, in the
+    order they are first needed
+    """
+    imports = []
+
+    for table in tables:
+        for name in TABLE_INPUTS[table]:
+            if name not in imports:
+                imports.append(name)
+
+    return imports
+
+
+def apply_overrides(overrides):
+    """
+    Sets the parameters specified for this process, so table processes
+    (including those run in worker processes) use the command line values
+    in place of the defaults in the parameters file
+
+    Parameters:
+        overrides:
+            dictionary of {parameter name: value}
+
+    Returns:
+        None
+    """
+    for name, value in overrides.items():
+        setattr(param, name, value)
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line arguments, using the values in the parameters
+    file as defaults
+    """
+    default_tables = [table for table, flag in TABLES.items()
+                      if getattr(param, flag)]
+
+    parser = argparse.ArgumentParser(prog="ncmp-inyear",
+                                     description="Creates the NCMP in year publication table outputs")
+
+    parser.add_argument("tables", nargs="*", default=default_tables,
+                        help=f"tables to create, any of {', '.join(TABLES)} "
+                             "(default: those set to True in the parameters file)")
+    parser.add_argument("--pupils-path", type=pathlib.Path,
+                        default=param.PUPILS_DATA_PATH,
+                        help="enhanced pupil extract (.csv)")
+    parser.add_argument("--la-path", type=pathlib.Path,
+                        default=param.LA_IY_DATA_PATH,
+                        help="LA data quality extract (.csv)")
+    parser.add_argument("--la-lookup-path", type=pathlib.Path,
+                        default=param.LA_IY_LOOKUP_PATH,
+                        help="LA to reporting region lookups (.csv)")
+    parser.add_argument("--output-path", type=pathlib.Path,
+                        default=param.IY_OUTPUT_PATH,
+                        help="output file")
+    parser.add_argument("--thisyear", default=param.IY_THISYEAR,
+                        help="this academic year, e.g. 2021/22")
+    parser.add_argument("--compyear", default=None,
+                        help="comparison academic year, e.g. 2018/19")
+    parser.add_argument("--baseyears", nargs="+", default=None,
+                        help="base academic years for weighting, e.g. 2016/17 2017/18 2018/19")
+    parser.add_argument("--jobs", type=int, default=param.IY_JOBS,
+                        help="number of worker processes used to create the tables")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print the planned import and build steps without running them")
+    parser.add_argument("--output-format", nargs="+", choices=list(EXPORT_FORMATS),
+                        default=param.IY_OUTPUT_FORMAT,
+                        help="formats of the table outputs")
+    parser.add_argument("--batch", nargs="+", type=pathlib.Path, default=None,
+                        metavar="PUPILS_PATH",
+                        help="create the tables for each of these pupil extracts (.csv), "
+                             "with one output file per extract named with its extract date")
+    parser.add_argument("--la-shards", action="store_true",
+                        help="create the pupil level tables from counts made for each LA "
+                             "in parallel and added together")
+    parser.add_argument("--rerun-la", nargs="+", default=None, metavar="LA_CODE",
+                        help="recount the pupil level tables for these LAs only, using the "
+                             "counts stored for the other LAs by the last run with LA shards")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="rebuild every table, ignoring cached table builds")
+    parser.add_argument("--sql-cache", choices=["list", "clear", "clear-expired"], default=None,
+                        help="list or clear the cached SQL query results, and exit")
+    parser.add_argument("--check-import-time", action="store_true",
+                        help="check the table modules import within IMPORT_TIME_BUDGET and exit")
+    parser.add_argument("--regression-check", action="store_true",
+                        help="check the tables against the golden outputs and performance "
+                             "baseline using synthetic inputs, and exit")
+    parser.add_argument("--update-regression-baseline", action="store_true",
+                        help="store the golden outputs and performance baseline from "
+                             "synthetic inputs, and exit")
+
+    args = parser.parse_args(argv)
+
+    unknown = [table for table in args.tables if table not in TABLES]
+    if unknown:
+        parser.error(f"unknown table(s): {', '.join(unknown)}")
+
+    # Extract dates are taken from the pupil extract file names
+    for pupils_path in args.batch or []:
+        try:
+            datetime.strptime(pupils_path.name[27:35], "%d%m%Y")
+        except ValueError:
+            parser.error(f"no extract date (ddmmyyyy) in pupil extract name: {pupils_path.name}")
+
+    return args
+
+
+def get_overrides(args):
+    """
+    Returns the parameters to override from the parsed command line arguments
+    """
+    overrides = {"PUPILS_DATA_PATH": args.pupils_path,
+                 "PUPILS_FILE": args.pupils_path.name,
+                 "LA_IY_DATA_PATH": args.la_path,
+                 "LA_IY_FILE": args.la_path.name,
+                 "LA_IY_LOOKUP_PATH": args.la_lookup_path,
+                 "IY_OUTPUT_PATH": args.output_path,
+                 "IY_THISYEAR": args.thisyear,
+                 "IY_OUTPUT_FORMAT": args.output_format,
+                 "IY_JOBS": args.jobs}
+
+    if args.rebuild:
+        overrides["BUILD_CACHE"] = False
+
+    if args.la_shards or args.rerun_la:
+        overrides["IY_LA_SHARDS"] = True
+
+    # Rerun LAs use counts stored for the other LAs, not only the table inputs,
+    # so are not taken from or added to the build cache
+    if args.rerun_la:
+        overrides["BUILD_CACHE"] = False
+
+    # Years are given on the command line and used as SQL filters
+    if args.compyear is not None:
+        overrides["IY_COMPYEAR"] = f"= '{args.compyear}'"
+
+    if args.baseyears is not None:
+        overrides["IY_BASEYEARS"] = "in ({})".format(", ".join(f"'{year}'" for year
+                                                               in args.baseyears))
+
+    return overrides
+
+
+def get_snapshot_output_path(output_path, pupils_path):
+    """
+    Returns the output file for the pupil extract specified in batch mode,
+    named after the output file with the extract date added
+    """
+    output_path = pathlib.Path(output_path)
+
+    return output_path.with_name(f"{output_path.stem}_{pupils_path.name[27:35]}"
+                                 f"{output_path.suffix}")
+
+
+def build_snapshot(pupils_path, tables, shared):
+    """
+    Creates the outputs for the tables specified for one pupil extract in
+    batch mode, importing the extract and using the imported data shared
+    for all extracts
+
+    Parameters:
+        pupils_path:
+            the pupil extract (.csv)
+        tables:
+            list of the tables to create
+        shared:
+            dictionary of {import name: Feather file path or imported data}
+            holding the data in TABLE_INPUTS for the tables, except the
+            pupil extract, with the base years data for weighting already
+            aggregated (see aggregate_baseyears)
+
+    Returns:
+        Dictionary of {table: {sheet name: output dataframe}}
+    """
+    # Extract date in the outputs is taken from the pupil extract file name
+    apply_overrides({"PUPILS_DATA_PATH": pupils_path,
+                     "PUPILS_FILE": pupils_path.name})
+
+    data = open_shared_frames(shared)
+    data["df_pupils_import"] = import_data("df_pupils_import")
+
+    outputs = {table: build_table(table, data) for table in tables}
+
+    if param.SIGNIFICANCE_TESTS:
+        outputs = add_significance_tests(outputs, param.SIGNIFICANCE_LEVEL,
+                                         param.SIGNIFICANCE_ADJUSTMENT)
+
+    return outputs
+
+
+def run_batch(pupils_paths, tables, overrides):
+    """
+    Creates the tables specified for each of the pupil extracts given, with
+    one output file per extract. Reference, comparison year and base years
+    data are imported once and shared by all extracts, with the base years
+    data for weighting aggregated once, and extracts are processed in
+    parallel worker processes if more than one job
+
+    Parameters:
+        pupils_paths:
+            list of pupil extracts (.csv)
+        tables:
+            list of the tables to create
+        overrides:
+            dictionary of {parameter name: value} set from the command line
+
+    Returns:
+        List of the outputs (workbook sheets and files) updated in this run
+    """
+    skipped = [table for table in tables if "df_pupils_import" not in TABLE_INPUTS[table]]
+    tables = [table for table in tables if table not in skipped]
+
+    if skipped:
+        print(f"create_publication_inyear - batch mode only creates tables using the "
+              f"pupil extract, skipping {', '.join(skipped)}")
+
+    # Import the data shared by all extracts once, starting all imports at once
+    futures = prefetch_imports([name for name in plan_imports(tables)
+                                if name != "df_pupils_import"])
+    data = {name: future.result() for name, future in futures.items()}
+
+    # Aggregate the base years data for weighting once, rather than for each extract
+    if "weighting" in tables:
+        print("create_publication_inyear - aggregating base years data for all extracts")
+
+        data.update(aggregate_baseyears(data.pop("df_pupils_baseyears"), data["df_ethnicity_ref"],
+                                        data["df_lsoa_ref"], data["df_la_e07_ref"],
+                                        data["df_ethnicity_ref_ohid"], data["df_imd_ref_ohid"],
+                                        param.IY_COMPYEAR))
+
+    formats = ([param.IY_OUTPUT_FORMAT] if isinstance(param.IY_OUTPUT_FORMAT, str)
+               else param.IY_OUTPUT_FORMAT)
+
+    # Each extract gets its own workbook, copied from the output workbook
+    if "excel" in formats and not pathlib.Path(overrides["IY_OUTPUT_PATH"]).exists():
+        raise FileNotFoundError(f"Output workbook {overrides['IY_OUTPUT_PATH']} not found, it is "
+                                "copied to create the workbook for each extract in batch mode")
+
+    with tempfile.TemporaryDirectory() as share_dir, contextlib.ExitStack() as stack:
+        # Build extracts in worker processes only if more than one job
+        if param.IY_JOBS > 1:
+            executor = stack.enter_context(
+                ProcessPoolExecutor(max_workers=max(1, min(param.IY_JOBS, len(pupils_paths))),
+                                    initializer=apply_overrides,
+                                    initargs=(overrides,)))
+
+            if param.IY_SHARE_FRAMES and importlib.util.find_spec("pyarrow"):
+                shared = share_frames(data, pathlib.Path(share_dir))
+            else:
+                shared = data
+
+            builders = [executor.submit(build_snapshot, pupils_path, tables, shared)
+                        for pupils_path in pupils_paths]
+        else:
+            shared = data
+            builders = None
+
+        # Export the outputs of each extract as it is completed, in order
+        for i, pupils_path in enumerate(pupils_paths):
+            print(f"create_publication_inyear - batch extract {i + 1} of "
+                  f"{len(pupils_paths)}: {pupils_path.name}")
+
+            if builders is None:
+                outputs = build_snapshot(pupils_path, tables, shared)
+            else:
+                outputs = builders[i].result()
+
+            snapshot_path = get_snapshot_output_path(overrides["IY_OUTPUT_PATH"], pupils_path)
+
+            if "excel" in formats and not snapshot_path.exists():
+                create_output_workbook(overrides["IY_OUTPUT_PATH"], snapshot_path)
+
+            for table in tables:
+                export_outputs(outputs[table], snapshot_path, param.IY_OUTPUT_FORMAT)
+
+    # Restore the pupil extract set for the run
+    apply_overrides(overrides)
+
+    return summarise_exports()
+
+
+def print_plan(tables, imports):
+    """
+    Prints the planned import and build steps for a dry run
+    """
+    print("create_publication_inyear - dry run, planned steps:")
+
+    for step, name in enumerate(imports, start=1):
+        print(f"    {step}. import {name} from {describe_import(name)} "
+              f"[{import_cache_status(name)}]")
+
+    for step, table in enumerate(tables, start=len(imports) + 1):
+        print(f"    {step}. build {table} using {', '.join(TABLE_INPUTS[table])} "
+              f"[{build_cache_status(table)}]")
+
+    formats = ([param.IY_OUTPUT_FORMAT] if isinstance(param.IY_OUTPUT_FORMAT, str)
+               else param.IY_OUTPUT_FORMAT)
+
+    print(f"    outputs: {', '.join(formats)} to {param.IY_OUTPUT_PATH} "
+          f"using {param.IY_JOBS} job(s)")
+
+    sharded = [table for table in tables if table in TABLE_COUNT_FUNCTIONS]
+
+    if param.IY_LA_SHARDS and sharded:
+        print(f"    counts by LA for {', '.join(sharded)} kept in {param.SHARD_DIR}")
+
+
+def main(argv=None):
+    """
+    Runs the in year publication process for the tables selected on the
+    command line (or in the parameters file)
+
+    Parameters:
+        argv:
+            list of command line arguments (defaults to sys.argv)
+
+    Returns:
+        List of the outputs (workbook sheets and files) updated in this run
+    """
+    args = parse_args(argv)
+
+    if args.check_import_time:
+        sys.exit(0 if check_import_times() else 1)
+
+    if args.sql_cache == "list":
+        df_entries = describe_entries()
+        print(f"create_publication_inyear - {len(df_entries)} cached SQL query result(s) "
+              f"in {param.SQL_CACHE_DIR}, {df_entries['MB'].sum():.1f} MB")
+
+        if len(df_entries):
+            print(df_entries.to_string(index=False))
+
+        sys.exit(0)
+
+    if args.sql_cache is not None:
+        clear_entries(expired_only=args.sql_cache == "clear-expired")
+        sys.exit(0)
+
+    if args.regression_check or args.update_regression_baseline:
+        tables = [table for table in TABLES if table in args.tables]
+        sys.exit(0 if run_regression_check(build_table, tables,
+                                           update=args.update_regression_baseline) else 1)
+
+    overrides = get_overrides(args)
+    apply_overrides(overrides)
+
+    # Keep table order as defined, whatever the order on the command line
+    tables = [table for table in TABLES if table in args.tables]
+    imports = plan_imports(tables)
+
+    if args.dry_run:
+        print_plan(tables, imports)
+
+        for pupils_path in args.batch or []:
+            print(f"    batch: {pupils_path} to "
+                  f"{get_snapshot_output_path(param.IY_OUTPUT_PATH, pupils_path)}")
+
+        return []
+
+    if args.batch:
+        return run_batch(args.batch, tables, overrides)
+
+    # Import data based on table processes selected to run, starting all
+    # imports at once so tables can be built as soon as their inputs are ready
+    futures = prefetch_imports(imports)
+
+    # Returns the imported data for a table, waiting for imports still running
+    def table_data(table):
+        return {name: futures[name].result() for name in TABLE_INPUTS[table]}
+
+    outputs = {}
+    keys = {}
+    failed = set()
+
+    # Runs a step for a table, recording a failure rather than stopping the
+    # run, so the other tables are still created and exported
+    def try_table(table, step):
+        try:
+            return step()
+        except Exception as error:
+            record_failure(table, error)
+            failed.add(table)
+
+    # Reuse cached table builds where the table inputs are unchanged
+    if param.BUILD_CACHE:
+        for table in tables:
+            keys[table] = try_table(table, lambda: get_build_key(table, TABLE_FUNCTIONS[table],
+                                                                 table_data(table),
+                                                                 TABLE_COLUMNS[table],
+                                                                 TABLE_PARAMS[table]))
+
+            cached = read_build(table, keys[table]) if table not in failed else None
 
-# Import data based on table processes selected to run in parameters file
-if param.TABLE_BMI_PREV | param.TABLE_ETH_IMD | param.TABLE_SCH_COHORT | param.TABLE_WEIGHTING:
+            if cached is not None:
+                print(f"create_publication_inyear - {table} inputs unchanged, using cached build")
+                outputs[table] = cached
 
-    # Import pupil data (NCMP schools only with BMI measurements)
-    df_pupils_import = import_inyeardata.import_pupils_data(param.PUPILS_DATA_PATH)
+    builds = [table for table in tables if table not in outputs and table not in failed]
 
-if param.TABLE_BMI_PREV | param.TABLE_ETH_IMD | param.TABLE_SCH_COHORT:
+    # Create pupil level tables from counts made for each LA in parallel
+    if param.IY_LA_SHARDS:
+        for table in builds:
+            if table in TABLE_COUNT_FUNCTIONS:
+                output = try_table(table, lambda: build_sharded_table(table, table_data(table),
+                                                                      overrides, args.rerun_la))
+                if output is not None:
+                    outputs[table] = output
 
-    # Import comparison year data from NCMP SQL table
-    df_pupils_compyear = import_inyeardata.import_pupils_compyear(param.IY_COMPYEAR)
+    unsharded = [table for table in builds if table not in outputs and table not in failed]
 
-if param.TABLE_ETH_IMD | param.TABLE_WEIGHTING:
+    # Create table outputs, in parallel worker processes if more than one job
+    if args.jobs > 1 and len(unsharded) > 1:
+        # Wait for all imports before starting worker processes
+        data = {}
 
-    # Import ethnicity reference data
-    df_ethnicity_ref = import_inyeardata.import_ethnicity_ref()
+        for table in unsharded:
+            data.update(try_table(table, lambda: table_data(table)) or {})
 
-if param.TABLE_WEIGHTING:
+        unsharded = [table for table in unsharded if table not in failed]
 
-    # Import pupil data for base years
-    df_pupils_baseyears = import_inyeardata.import_pupils_baseyears(param.IY_BASEYEARS)
+        with tempfile.TemporaryDirectory() as share_dir, \
+                ProcessPoolExecutor(max_workers=max(1, min(args.jobs, len(unsharded))),
+                                    initializer=apply_overrides,
+                                    initargs=(overrides,)) as executor:
 
-    # Import OHID ethnicity and IMD reference data
-    print("import_inyeardata - importing OHID ethnicity and IMD reference data")
-    df_ethnicity_ref_ohid = pd.read_csv(param.ETHNIC_GROUP_PATH)
-    df_imd_ref_ohid = pd.read_csv(param.IMD_QUINTILE_PATH)
+            # Share imported data as memory-mapped files written once,
+            # rather than pickling a copy for each worker
+            if param.IY_SHARE_FRAMES and importlib.util.find_spec("pyarrow"):
+                shared = share_frames(data, pathlib.Path(share_dir))
+                builder = build_shared_table
+            else:
+                shared = data
+                builder = build_table
 
-    # Import LSOA reference data
-    df_lsoa_ref = import_inyeardata.import_lsoa_ref()
+            builders = {table: executor.submit(builder, table,
+                                               {name: shared[name] for name
+                                                in TABLE_INPUTS[table]})
+                        for table in unsharded}
 
-    # Import LA reference data for E07 codes
-    df_la_e07_ref = import_inyeardata.import_la_e07_ref()
+            for table in unsharded:
+                output = try_table(table, builders[table].result)
 
-if param.TABLE_DQLA:
+                if output is not None:
+                    outputs[table] = output
+    else:
+        for table in unsharded:
+            output = try_table(table, lambda: build_table(table, table_data(table)))
 
-    # Import LA DQ data
-    df_la_import = import_inyeardata.import_LA_DQ_data(param.LA_IY_DATA_PATH)
+            if output is not None:
+                outputs[table] = output
 
-    # Import comparison year data from NCMP SQL table
-    df_la_compyear = import_inyeardata.import_LA_compyear(param.IY_COMPYEAR)
+    # Cache new table builds (before export adds the run date)
+    for table in builds:
+        if table in outputs and keys.get(table) is not None:
+            write_build(table, keys[table], outputs[table])
 
-    # Import LA to reporting region lookups
-    print("import_inyeardata - importing LA to reporting region lookups")
-    df_la_lookups = pd.read_csv(param.LA_IY_LOOKUP_PATH)
+    # Record the LA DQ snapshot in the history once, whether or not dqla was rebuilt
+    if param.LA_DQ_HISTORY and "dqla" in outputs:
+        trends = try_table("dqla", lambda: add_la_dq_trends(outputs["dqla"],
+                                                            table_data("dqla")["df_la_import"]))
 
-# Create and export table outputs based on those selected to run in parameters file
-if param.TABLE_BMI_PREV:
-    create_table_bmi_prev(df_pupils_import, param.IY_OUTPUT_PATH)
+        if trends is not None:
+            outputs["dqla"] = trends
 
-if param.TABLE_DQLA:
-    create_table_dqla(df_la_import, df_la_compyear, df_la_lookups,
-                      param.LA_IY_COMPEXCLUDE, param.IY_OUTPUT_PATH)
+    # Test changes from the comparison year in every output at once
+    if param.SIGNIFICANCE_TESTS:
+        outputs = add_significance_tests(outputs, param.SIGNIFICANCE_LEVEL,
+                                         param.SIGNIFICANCE_ADJUSTMENT)
 
-if param.TABLE_ETH_IMD:
-    create_table_ethnicity_imd(df_pupils_import, df_pupils_compyear,
-                               df_ethnicity_ref, param.IY_THISYEAR,
-                               param.IY_OUTPUT_PATH)
+    # Export table outputs, in each output format
+    for table in tables:
+        if table in outputs:
+            export_outputs(outputs[table], param.IY_OUTPUT_PATH, param.IY_OUTPUT_FORMAT)
 
-if param.TABLE_SCH_COHORT:
-    create_table_school_cohort(df_pupils_import, df_pupils_compyear,
-                               param.IY_THISYEAR, param.IY_OUTPUT_PATH)
+    # Report which tables were updated in this run
+    return summarise_exports()
 
 
-if param.TABLE_WEIGHTING:
-    create_table_weighting(df_pupils_import, df_pupils_baseyears,
-                           df_ethnicity_ref, df_lsoa_ref, df_la_e07_ref,
-                           df_ethnicity_ref_ohid, df_imd_ref_ohid,
-                           param.IY_THISYEAR, param.IY_COMPYEAR,
-                           param.IY_OUTPUT_PATH)
+if __name__ == "__main__":
+    main()
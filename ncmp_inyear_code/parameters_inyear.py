@@ -11,6 +11,33 @@ INPUT_LADQ_DIR = INPUT_DIR / "LADQData"
 OUTPUT_DIR = BASE_DIR / "Outputs"
 OUTPUT_DIR_IY = OUTPUT_DIR / "In year analysis"
 
+# Sets the folder containing the SQL queries used in the import data stage
+SQL_DIR = pathlib.Path(__file__).parent / "sql_code"
+
+# Sets the folder for local snapshots of the reference data (ethnicity, LSOA and E07 LA)
+REF_CACHE_DIR = BASE_DIR / "Cache" / "RefData"
+
+# Sets the folder that data processed out of core is spilled to (see IY_OUT_OF_CORE)
+SPILL_DIR = BASE_DIR / "Cache" / "Spill"
+
+# Sets the folder that the counts for each LA shard are kept in, used to rerun single LAs (see IY_LA_SHARDS)
+SHARD_DIR = BASE_DIR / "Cache" / "Shards"
+
+# Sets the folder for the history of LA data quality snapshots (see LA_DQ_HISTORY)
+LA_DQ_HISTORY_DIR = BASE_DIR / "History" / "LADQData"
+
+# Sets the folder for cached SQL query results (see SQL_CACHE)
+SQL_CACHE_DIR = BASE_DIR / "Cache" / "SqlResults"
+
+# Sets the folder for cached table builds (see BUILD_CACHE)
+BUILD_CACHE_DIR = BASE_DIR / "Cache" / "Builds"
+
+# Sets the folder for the performance baseline of the regression check (kept locally, as it depends on the machine)
+REGRESSION_DIR = BASE_DIR / "Regression"
+
+# Sets the folder for the golden outputs of the regression check, committed with the code (synthetic data only)
+REGRESSION_GOLDEN_DIR = pathlib.Path(__file__).parent.parent / "tests" / "regression_golden"
+
 # Sets the path of the current LA file to be imported for LA DQ production (with extension)
 LA_IY_FILE = "DataQualityAndProgressInformation.csv"
 LA_IY_DATA_PATH = INPUT_LADQ_DIR / LA_IY_FILE
@@ -35,6 +62,26 @@ IMD_QUINTILE_PATH = INPUT_REF_DIR / IMD_QUINTILE
 IY_OUTPUT_FILE = "ncmp_inyear_source.xlsx"
 IY_OUTPUT_PATH = OUTPUT_DIR_IY / IY_OUTPUT_FILE
 
+# Sets the folder for the reports of pupils with duplicate NcmpSystemId (see IY_DUPLICATE_CHECK)
+DUPLICATE_REPORT_DIR = OUTPUT_DIR_IY / "Duplicates"
+
+# Sets whether sheets are re-exported even when their content is unchanged since the last run (True or False)
+# Content hashes of exported sheets are kept in a manifest next to the output file, with the workbook modified time
+# and size, so sheets are also re-exported when the workbook is replaced or edited
+IY_FORCE_EXPORT = False
+
+# Sets the formats of the table outputs, any of: "excel" (sheets of IY_OUTPUT_PATH), "csv" and "parquet" (one file per
+# sheet alongside IY_OUTPUT_PATH, parquet requires the optional pyarrow package), e.g. ["parquet", "csv"]
+# The row counts, schema and extract dates of each output are recorded in a JSON manifest alongside IY_OUTPUT_PATH
+IY_OUTPUT_FORMAT = ["excel"]
+
+# Sets the formats of outputs that are written differently to IY_OUTPUT_FORMAT, as {sheet name: list of formats}
+# e.g. the school level prevalence output (see SCHOOL_PREVALENCE), too large for the publication workbook
+OUTPUT_SHEET_FORMATS = {"SchoolPrevalence": ["parquet"]}
+
+# Sets the number of rows written at a time to CSV files, and in each row group of Parquet files
+EXPORT_CHUNK_ROWS = 100000
+
 
 """PROCESS PARAMETERS"""
 # Sets this year for process
@@ -49,11 +96,57 @@ IY_BASEYEARS = "in ('2016/17', '2017/18','2018/19')"
 # Sets LA(s) to exclude from comparison year dataset for LA DQ production
 LA_IY_COMPEXCLUDE = ["809"]  # 809: Dorset, LA reconfigured and so 1819 data not comparable
 
+# Sets whether each LA data quality snapshot is added to the history in LA_DQ_HISTORY_DIR, keyed by the extract date
+# in LA_IY_FILE, with the month-on-month trends in the measured totals and A3 indicators output (True or False)
+# The snapshot is recorded once per run after the dqla table is created (or read from the build cache)
+LA_DQ_HISTORY = False
+
 # Dictionary of school URNs and LA code to assign to each URN for weighting process
 # e.g. {148715: "E10000024"}
 # Needed when a school URN doesn't have a school LSOA assigned in the pupil data file
 URN_UPDATE_WEIGHTING_LA = {148715: "E10000024"}
 
+# Sets the weighting method: "cell" (weights for each SchoolYear, UpperTierLA, IMD Quintile and Ethnic Group subgroup)
+# or "raking" (iterative proportional fitting to the base years distribution of each variable separately)
+WEIGHTING_METHOD = "cell"
+
+# Sets the convergence tolerance (maximum relative margin error) and maximum iterations for raking
+RAKING_TOLERANCE = 1e-8
+RAKING_MAX_ITERATIONS = 100
+
+# Sets the maximum weight for the weighted output - rows with larger weights are excluded
+WEIGHT_TRIM = 4
+
+# Sets whether the sensitivity of weighted prevalence to weight trimming is output (True or False)
+# Trims exclude rows with weights above each threshold, caps set weights above each cap to the cap
+WEIGHT_SENSITIVITY = False
+WEIGHT_SENSITIVITY_TRIMS = [2, 3, 4, 5, 6, 8, 10]
+WEIGHT_SENSITIVITY_CAPS = [2, 3, 4, 5, 6]
+
+# Sets the derived BMI categories for the BMI prevalence table, as {category name: condition}
+# Conditions are pandas expressions on the BmiPopulationCategory, BmiPScore and SevereObese columns, and categories may overlap
+# e.g. "underweight or healthy": "BmiPopulationCategory in ['underweight', 'healthy weight']"
+BMI_DERIVED_CATEGORIES = {"severely obese": "SevereObese",
+                          "overweight or obese": "BmiPopulationCategory in ['overweight', 'obese']"}
+
+# Sets whether the school cohort table also outputs the measured totals, BMI category prevalences and confidence
+# intervals of every school and school year, this year and in the comparison year (True or False)
+SCHOOL_PREVALENCE = True
+
+# Sets whether the pupil data and comparison year data are checked for duplicate NcmpSystemId on import (True or False)
+# Duplicate ids, those assigned to more than one LA or school, and the extra pupils counted are reported
+# If IY_DEDUPLICATE is set, only the first row for each duplicate id is kept
+IY_DUPLICATE_CHECK = True
+IY_DEDUPLICATE = False
+
+# Sets whether the changes from the comparison year are tested for significance (two-proportion z-tests) in every output
+# with this year and comparison year proportions, except WeightSensitivity and CohortAnalysis (True or False)
+# Weighted outputs are tested using their effective sample sizes, adjusting for the design effect of the weights
+# P-values are adjusted for the number of tests in each output: "bh" (Benjamini-Hochberg), "holm" or None
+SIGNIFICANCE_TESTS = True
+SIGNIFICANCE_LEVEL = 0.05
+SIGNIFICANCE_ADJUSTMENT = "bh"
+
 # Sets which tables should be run as part of the create_publication process (True or False)
 # Can be used to run individual outputs if needed
 TABLE_BMI_PREV = True  # Tables 1 and 2
@@ -61,3 +154,67 @@ TABLE_DQLA = True # Tables A1 to A3
 TABLE_ETH_IMD = True  # Tables B and C
 TABLE_SCH_COHORT = True  # Table D
 TABLE_WEIGHTING = True # Table E
+
+# Sets the number of worker processes used to create the table outputs
+# Can be used to create the selected tables in parallel if set above 1
+IY_JOBS = 1
+
+# Sets whether the pupil level tables (bmi_prev, eth_imd and sch_cohort) are created from counts made separately
+# for each LA (by OrgCode) in IY_JOBS worker processes and added together (True or False)
+# The counts for each LA are kept in SHARD_DIR, so the tables can be updated for LAs that resubmit without
+# recounting the other LAs, with: ncmp-inyear --rerun-la E06000001 E09000002
+IY_LA_SHARDS = False
+
+# Sets the reader used for the pupil data file: "pandas", "pyarrow" (multithreaded, requires the optional pyarrow
+# package) or "parallel" (byte ranges of the file parsed in IY_CSV_WORKERS worker processes, None for one per CPU core)
+IY_CSV_ENGINE = "pandas"
+IY_CSV_WORKERS = None
+
+# Sets the maximum number of imports (SQL queries and file reads) run at the same time
+# All imports for the selected tables are started together, so the import stage takes about as long as the slowest import
+IY_IMPORT_THREADS = 8
+
+# Sets whether imported data is shared with the worker processes (IY_JOBS above 1) as memory-mapped Feather files
+# written once, rather than copied into each worker (True or False, requires the optional pyarrow package)
+# Only numeric columns without missing values are shared in memory, string columns are still copied into each worker
+IY_SHARE_FRAMES = True
+
+# Sets whether large inputs are processed out of core, for long base year histories that do not fit in memory (True or False)
+# Base years data is read from SQL in chunks of IY_CHUNK_ROWS rows, spilled to SPILL_DIR in partitions by academic year
+# and processed one partition at a time, keeping the data held in memory within IY_MEMORY_BUDGET_MB
+# The pupil data file is also read in chunks, filtered before the chunks are combined
+IY_OUT_OF_CORE = False
+IY_MEMORY_BUDGET_MB = 2048
+IY_CHUNK_ROWS = 100000
+
+# Sets whether reference data is read from local snapshots when the SQL source is unchanged (True or False)
+# The source is checked with a row count, max key and checksum query on each run
+REF_CACHE = True
+
+# Sets whether the comparison year and base years SQL query results are reused from a local cache (True or False)
+# Results are keyed on the rendered query text with the server and database, kept for SQL_CACHE_TTL_DAYS, and
+# the least recently used results are removed once the cache exceeds SQL_CACHE_MAX_MB
+# Can be listed or cleared with: ncmp-inyear --sql-cache list (or clear, clear-expired)
+SQL_CACHE = True
+SQL_CACHE_TTL_DAYS = 30
+SQL_CACHE_MAX_MB = 2000
+
+# Sets whether table outputs are reused from cached builds when the table inputs are unchanged (True or False)
+# Builds are keyed on the input columns used by each table, its parameters and code, and the least recently
+# used builds are removed once the cache exceeds BUILD_CACHE_MAX_MB
+# Can be overridden with: ncmp-inyear --rebuild
+BUILD_CACHE = True
+BUILD_CACHE_MAX_MB = 500
+
+# Sets the maximum time in seconds allowed to import each table module (after pandas)
+# Checked with: ncmp-inyear --check-import-time
+IMPORT_TIME_BUDGET = 0.5
+
+# Sets the regression check of the tables against golden outputs and a performance baseline
+# Run with: ncmp-inyear --regression-check (store new golden outputs with --update-regression-baseline)
+REGRESSION_REPEATS = 3  # runs of each table, the fastest is compared with the baseline
+REGRESSION_RTOL = 1e-9  # relative tolerance for numeric values
+REGRESSION_ATOL = 1e-12  # absolute tolerance for numeric values
+REGRESSION_STRICT_ORDER = False  # whether rows and columns must be in the same order
+REGRESSION_PERF_THRESHOLD = 20  # percentage increase in wall time or peak memory that fails the check
+REGRESSION_TIME_NOISE = 0.05  # increases in wall time of up to this many seconds are ignored as timing noise
@@ -1,3 +1,5 @@
-SELECT *
+SELECT [PARENT_GEOGRAPHY_CODE],
+    [GEOGRAPHY_CODE],
+    [ENTITY_CODE]
 FROM [DATABASE].[SERVER].[TABLE]
 WHERE ENTITY_CODE ='E07'
\ No newline at end of file
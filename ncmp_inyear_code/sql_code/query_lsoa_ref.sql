@@ -1,3 +1,4 @@
 SELECT
-    *
+    [LSOACD],
+    [LADCD]
 FROM [DATABASE].[SERVER].[TABLE]
\ No newline at end of file
@@ -0,0 +1,188 @@
+"""
+Purpose of script: keeps the outputs of each table build on local disk,
+keyed on a fingerprint of the table inputs, so a table is only rebuilt when
+its input data, parameters or code have changed.
+
+The fingerprint combines a content hash of the input columns used by the
+table, the parameter values it uses and a hash of the source of the table
+module (and the package modules it uses, directly or through other package
+modules). Cached builds are evicted least
+recently used first once the cache exceeds BUILD_CACHE_MAX_MB.
+"""
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import sys
+import types
+
+import pandas as pd
+
+import ncmp_inyear_code.parameters_inyear as param
+from ncmp_inyear_code.utilities.export_inyear import hash_output
+
+
+def fingerprint_input(data, columns=None):
+    """
+    This function will create a content hash of the imported data given,
+    using only the columns specified.
+    Data held out of core (a folder of partitions) is hashed from the bytes
+    of its partition files
+
+    Parameters:
+        data:
+            dataframe, or path of a folder of partitions
+        columns:
+            list of the columns to hash (defaults to all columns)
+
+    Returns:
+        String containing the hex digest of the content hash
+    """
+    if isinstance(data, pd.DataFrame):
+        return hash_output(data if columns is None else data[columns])
+
+    content_hash = hashlib.sha256()
+
+    for part_path in sorted(data.rglob("part_*.pkl")):
+        content_hash.update(str(part_path.relative_to(data)).encode())
+        content_hash.update(part_path.read_bytes())
+
+    return content_hash.hexdigest()
+
+
+def get_code_modules(function):
+    """
+    Returns the names of the module defining the function given and of the
+    other package modules it uses, directly or through other package
+    modules (except the parameters file, whose values are fingerprinted
+    separately)
+    """
+    modules = {function.__module__}
+    unvisited = [function.__module__]
+
+    # Follow the package modules used by each module found
+    while unvisited:
+        for value in vars(sys.modules[unvisited.pop()]).values():
+            name = value.__name__ if isinstance(value, types.ModuleType) else getattr(value, "__module__", None)
+
+            if (isinstance(name, str) and name.startswith("ncmp_inyear_code") and
+                    name != param.__name__ and name not in modules and name in sys.modules):
+                modules.add(name)
+                unvisited.append(name)
+
+    return modules
+
+
+def get_code_version(function):
+    """
+    This function will create a hash of the source of the module defining
+    the function given, and of the other package modules it uses directly
+    or through other package modules, e.g. raking through table_weighting
+    (see get_code_modules)
+
+    Parameters:
+        function:
+            the table function
+
+    Returns:
+        String containing the hex digest of the code hash
+    """
+    code_hash = hashlib.sha256()
+
+    for name in sorted(get_code_modules(function)):
+        code_hash.update(inspect.getsource(sys.modules[name]).encode())
+
+    return code_hash.hexdigest()
+
+
+def get_build_key(table, function, data, columns, params):
+    """
+    This function will create the cache key of a table build
+
+    Parameters:
+        table:
+            name of the table
+        function:
+            the table function
+        data:
+            dictionary of {import name: imported data} used by the table
+        columns:
+            dictionary of {import name: list of the columns used}, for the
+            imports where the table uses only some of the columns
+        params:
+            list of the names of the parameters used by the table
+
+    Returns:
+        String containing the cache key
+    """
+    fingerprint = {"table": table,
+                   "inputs": {name: fingerprint_input(df, columns.get(name))
+                              for name, df in sorted(data.items())},
+                   "params": {name: repr(getattr(param, name)) for name in params},
+                   "code": get_code_version(function)}
+
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+
+def get_build_path(table, key):
+    """
+    Returns the path of the cached build of the table specified
+    """
+    return param.BUILD_CACHE_DIR / f"{table}_{key[:16]}.pkl"
+
+
+def read_build(table, key):
+    """
+    Reads the cached outputs of the table build specified if they exist,
+    otherwise returns None.
+    Marks the build as recently used for eviction
+    """
+    build_path = get_build_path(table, key)
+
+    if not build_path.exists():
+        return None
+
+    os.utime(build_path)
+
+    with open(build_path, "rb") as build_file:
+        return pickle.load(build_file)
+
+
+def write_build(table, key, outputs):
+    """
+    Writes the outputs of the table build specified to the cache, then
+    evicts the least recently used builds while the cache exceeds
+    BUILD_CACHE_MAX_MB
+    """
+    param.BUILD_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+    with open(get_build_path(table, key), "wb") as build_file:
+        pickle.dump(outputs, build_file)
+
+    build_paths = sorted(param.BUILD_CACHE_DIR.glob("*.pkl"),
+                         key=lambda path: path.stat().st_mtime)
+
+    cache_bytes = sum(path.stat().st_size for path in build_paths)
+
+    # Keep the build just written, even if it exceeds the cache size alone
+    for build_path in build_paths[:-1]:
+        if cache_bytes <= param.BUILD_CACHE_MAX_MB * 1024 ** 2:
+            break
+
+        cache_bytes -= build_path.stat().st_size
+        build_path.unlink()
+
+        print(f"build_cache - evicted {build_path.name}")
+
+
+def build_cache_status(table):
+    """
+    Returns the number of cached builds of the table specified, for dry runs
+    """
+    if not param.BUILD_CACHE:
+        return "build cache off"
+
+    builds = len(list(param.BUILD_CACHE_DIR.glob(f"{table}_*.pkl")))
+
+    return f"{builds} cached build(s), reused if inputs unchanged"
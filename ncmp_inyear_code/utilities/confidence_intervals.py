@@ -0,0 +1,39 @@
+"""
+Purpose of script: calculates confidence intervals for proportions, used by
+the tables so every output uses the same method.
+
+The Wilson score method is used, as in the NCMP annual report
+https://digital.nhs.uk/data-and-information/publications/statistical/national-child-measurement-programme/2020-21-school-year/appendices#appendix-d-confidence-intervals
+"""
+import numpy as np
+
+# 𝑧(1−∝/2) from the standard Normal distribution for 95% confidence intervals,
+# equal to scipy.stats.norm.ppf(0.975) (held as a constant to avoid importing scipy)
+Z_975 = 1.959963984540054
+
+
+def wilson_interval(observed, sample, z=Z_975):
+    """
+    Calculates Wilson score confidence intervals for proportions, for
+    arrays (or series) of any shape at once
+
+    Parameters:
+        observed:
+            observed numbers with the feature of interest e.g. numerators
+        sample:
+            sample sizes e.g. denominators, broadcast against observed
+        z:
+            z score for the confidence level (defaults to 95%)
+
+    Returns:
+        Tuple of (lower, upper) confidence intervals as proportions (0 to 1),
+        nan where the sample size is 0
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        q = 1 - observed / sample  # proportion without feature of interest
+
+        a = (2 * observed) + (z ** 2)
+        b = z * np.sqrt((z ** 2) + (4 * observed * q))
+        c = 2 * (sample + z ** 2)
+
+        return (a - b) / c, (a + b) / c
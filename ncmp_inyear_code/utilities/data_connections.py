@@ -1,10 +1,10 @@
 """
 Purpose of script: handles reading data in from sql.
 """
-import sqlalchemy as sa
 import pandas as pd
 
-import pyodbc
+import ncmp_inyear_code.parameters_inyear as param
+import ncmp_inyear_code.utilities.sql_cache as sql_cache
 
 
 def df_from_sql(query, server, database) -> pd.DataFrame:
@@ -20,6 +20,10 @@ def df_from_sql(query, server, database) -> pd.DataFrame:
     Output:
         pandas Dataframe
     """
+    # Import sqlalchemy (and the pyodbc driver it uses) only when querying SQL,
+    # as they are slow to import and not needed for the CSV based tables
+    import sqlalchemy as sa
+
     conn = sa.create_engine(f"mssql+pyodbc://{server}/{database}?driver=SQL+Server",
                             fast_executemany=True)
 
@@ -27,5 +31,98 @@ def df_from_sql(query, server, database) -> pd.DataFrame:
     df = pd.read_sql_query(query, conn)
     return df
 
+
+def df_chunks_from_sql(query, server, database, chunksize):
+    """
+    Use sqlalchemy to connect to the NHSD server and database as for
+    df_from_sql, returning the query results in chunks so they do not need
+    to be held in memory at once
+
+    Inputs:
+        server: server name
+        database: database name
+        query: string containing a sql query
+        chunksize: number of rows in each chunk
+
+    Output:
+        Iterator of pandas Dataframes
+    """
+    import sqlalchemy as sa
+
+    conn = sa.create_engine(f"mssql+pyodbc://{server}/{database}?driver=SQL+Server",
+                            fast_executemany=True)
+
+    conn.execution_options(autocommit=True)
+
+    return pd.read_sql_query(query, conn, chunksize=chunksize)
+
     print("This message shows that you have successfully imported \
 the get_df_from_sql() function from the data connections module")
+
+
+def df_from_sql_cached(query, server, database, ttl_days=None) -> pd.DataFrame:
+    """
+    Returns the results of a sql query as for df_from_sql, from the local
+    query result cache if the same rendered query has been run on the
+    server and database within its time to live (see sql_cache)
+
+    Inputs:
+        server: server name
+        database: database name
+        query: string containing a sql query
+        ttl_days: days to keep the result (defaults to SQL_CACHE_TTL_DAYS)
+
+    Output:
+        pandas Dataframe
+    """
+    if not param.SQL_CACHE:
+        return df_from_sql(query, server, database)
+
+    key = sql_cache.get_query_key(query, server, database)
+    parts = sql_cache.read_parts(key)
+
+    if parts is not None:
+        print(f"data_connections - using cached query result {key[:12]}")
+        return pd.concat(list(parts), ignore_index=True)
+
+    df = df_from_sql(query, server, database)
+
+    for _ in sql_cache.write_parts(key, iter([df]), query, server, database,
+                                   ttl_days or param.SQL_CACHE_TTL_DAYS):
+        pass
+
+    return df
+
+
+def df_chunks_from_sql_cached(query, server, database, chunksize, ttl_days=None):
+    """
+    Returns the results of a sql query in chunks as for df_chunks_from_sql,
+    from the local query result cache if the same rendered query has been
+    run on the server and database within its time to live (see sql_cache).
+    Cached results are read one stored chunk at a time, split into chunks of
+    at most chunksize rows
+
+    Inputs:
+        server: server name
+        database: database name
+        query: string containing a sql query
+        chunksize: number of rows in each chunk
+        ttl_days: days to keep the result (defaults to SQL_CACHE_TTL_DAYS)
+
+    Output:
+        Iterator of pandas Dataframes
+    """
+    if not param.SQL_CACHE:
+        return df_chunks_from_sql(query, server, database, chunksize)
+
+    key = sql_cache.get_query_key(query, server, database)
+    parts = sql_cache.read_parts(key)
+
+    if parts is not None:
+        print(f"data_connections - using cached query result {key[:12]}")
+        return (df.iloc[start:start + chunksize].copy() for df in parts
+                for start in range(0, len(df), chunksize))
+
+    return sql_cache.write_parts(key, df_chunks_from_sql(query, server, database, chunksize),
+                                 query, server, database,
+                                 ttl_days or param.SQL_CACHE_TTL_DAYS)
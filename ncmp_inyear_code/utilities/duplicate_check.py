@@ -0,0 +1,77 @@
+"""
+Purpose of script: checks the pupil level data for pupils included more than
+once (duplicate NcmpSystemId), e.g. from resubmissions or from schools that
+cross LA borders, which would otherwise inflate the counts in every table.
+
+Duplicates are found by hashing the ids in a single pass over the data, and
+only the duplicated rows are examined further, so the check takes close to
+linear time in the size of the extract.
+"""
+import numpy as np
+
+import ncmp_inyear_code.parameters_inyear as param
+
+
+def check_duplicates(df, name, deduplicate=False):
+    """
+    This function will report the pupils with duplicate NcmpSystemId in the
+    pupil data given: the number of duplicate ids, those assigned to more
+    than one LA or school, and the extra pupils they add to the measured
+    totals by school year. Details of each duplicate id are written to
+    DUPLICATE_REPORT_DIR
+
+    Parameters:
+        df:
+            pupil level data, with the derived pupil features
+        name:
+            name of the data, used in the report and its file name
+        deduplicate:
+            if True, only the first row for each NcmpSystemId is kept
+
+    Returns:
+        Dataframe of the pupil level data, deduplicated if specified
+    """
+    ids = df["NcmpSystemId"]
+    duplicated = ids.notnull() & ids.duplicated(keep=False)
+
+    if not duplicated.any():
+        print(f"duplicate_check - no duplicate NcmpSystemId in {name}")
+        return df
+
+    # Summarise each duplicate id, with the LAs and schools it is assigned to
+    def join_values(values):
+        return ", ".join(sorted(values.dropna().astype(str).unique()))
+
+    df_report = df.loc[duplicated].groupby("NcmpSystemId").agg(Rows=("OrgCode", "size"),
+                                                               LAs=("OrgCode", "nunique"),
+                                                               Schools=("SchoolUrn", "nunique"),
+                                                               OrgCodes=("OrgCode", join_values),
+                                                               SchoolUrns=("SchoolUrn", join_values))
+
+    df_report["Conflict"] = np.select([df_report["LAs"] > 1, df_report["Schools"] > 1],
+                                      ["LA", "School"], "Repeated")
+
+    # Extra pupils counted in the measured totals, by school year
+    extra = ids.notnull() & ids.duplicated(keep="first")
+    df_totals = df.groupby("SchoolYear").agg(Pupils=("NcmpSystemId", "count"))
+    df_totals["Extra"] = extra.groupby(df["SchoolYear"]).sum()
+
+    print(f"duplicate_check - {len(df_report)} duplicate NcmpSystemId in {name} "
+          f"({(df_report['Conflict'] == 'LA').sum()} across LAs, "
+          f"{(df_report['Conflict'] == 'School').sum()} across schools)")
+
+    for schoolyear, row in df_totals.iterrows():
+        print(f"    SchoolYear {schoolyear}: {row['Extra']} extra of {row['Pupils']} pupils "
+              f"counted in the table totals ({row['Extra'] / row['Pupils'] * 100:.3f}%)")
+
+    param.DUPLICATE_REPORT_DIR.mkdir(parents=True, exist_ok=True)
+    report_path = param.DUPLICATE_REPORT_DIR / f"{name}_duplicates.csv"
+    df_report.reset_index().to_csv(report_path, index=False)
+
+    print(f"duplicate_check - duplicate ids written to {report_path}")
+
+    if deduplicate:
+        print(f"duplicate_check - keeping the first row for each duplicate id in {name}")
+        return df.loc[~extra]
+
+    return df
@@ -1,29 +1,175 @@
 from datetime import datetime
-import xlwings as xw
+import hashlib
+import json
+import pathlib
+import shutil
 import pandas as pd
 
+import ncmp_inyear_code.parameters_inyear as param
+
+# Record of the outputs (workbook sheets and files) exported in this run and
+# whether their content changed, keyed by output so that outputs of the same
+# sheet in other formats or output files are recorded separately
+export_log = {}
+
+# Record of the tables and sheets that failed to build or export in this run
+export_failures = {}
+
+
+def hash_output(df):
+    """
+    This function will create a content hash of the specified dataframe,
+    based on its column names, data types and values (ignoring the index)
+
+    Parameters:
+        df:
+            the dataframe to be hashed
+
+    Returns:
+        String containing the hex digest of the content hash
+    """
+    content_hash = hashlib.sha256()
+    content_hash.update(json.dumps([[str(col), str(dtype)] for col, dtype
+                                    in df.dtypes.items()]).encode())
+    content_hash.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+
+    return content_hash.hexdigest()
+
+
+def describe_output(df):
+    """
+    This function will describe the specified dataframe for the manifest of
+    exported outputs: its number of rows, its schema (column data types)
+    and the extract dates it was created from
+
+    Parameters:
+        df:
+            the dataframe exported
+
+    Returns:
+        Dictionary of the description
+    """
+    return {"Rows": len(df),
+            "Schema": {str(col): str(dtype) for col, dtype in df.dtypes.items()},
+            "ExtractDates": {str(col): sorted({str(value) for value in df[col].dropna()})
+                             for col in df.columns if str(col).endswith("ExtractDate")}}
+
+
+def get_manifest_path(file_path):
+    """
+    Returns the path of the manifest of exported outputs (content hashes,
+    row counts, schemas and extract dates), stored next to the output file
+    indicated
+    """
+    file_path = pathlib.Path(file_path)
+
+    return file_path.with_name(file_path.stem + "_manifest.json")
+
+
+def read_manifest(file_path):
+    """
+    Reads the manifest of exported outputs for the output file indicated,
+    returning an empty manifest if none exists yet
+    """
+    manifest_path = get_manifest_path(file_path)
+
+    if not manifest_path.exists():
+        return {}
+
+    with open(manifest_path, "r") as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_manifest(manifest, file_path):
+    """
+    Writes the manifest of exported outputs for the output file indicated
+    """
+    with open(get_manifest_path(file_path), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4, sort_keys=True)
+
+
+def get_workbook_state(file_path):
+    """
+    Returns the modified time and size of the workbook indicated, recorded in
+    the manifest so that sheets are only skipped while the workbook is the
+    one last exported to, or None if the workbook does not exist
+    """
+    file_path = pathlib.Path(file_path)
+
+    if not file_path.exists():
+        return None
+
+    stat = file_path.stat()
+
+    return {"mtime": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def create_output_workbook(template_path, file_path):
+    """
+    This function will create an output workbook as a copy of the workbook
+    given (e.g. for each extract in batch mode), removing any manifest left
+    for the output file, as its sheets are replaced by those of the copy
+
+    Parameters:
+        template_path:
+            the full file path and name of the workbook to copy
+        file_path:
+            the full file path and name of the new workbook
+    """
+    print(f"export_inyear - creating output workbook {pathlib.Path(file_path).name} "
+          f"from {pathlib.Path(template_path).name}")
+
+    shutil.copyfile(template_path, file_path)
+
+    manifest_path = get_manifest_path(file_path)
+
+    if manifest_path.exists():
+        manifest_path.unlink()
+
 
 def export_excel_data(df, sheet, file_path):
     """
     This function will export the specified dataframe to the Excel file
-    indicated
+    indicated.
+    A content hash of the dataframe is stored per sheet in a manifest next
+    to the Excel file, with the modified time and size of the workbook, and
+    the export is skipped when the content is unchanged since the last
+    export and the workbook has not been replaced or edited since (unless
+    IY_FORCE_EXPORT is set)
 
     Parameters:
         df:
             the dataframe to be exported
         sheet:
             the Excel workbook sheet to export the df to
-        file_path: 
+        file_path:
             the full file path and name of the Excel file to export to
 
     Returns:
-        None
+        True if the sheet was updated, False if it was unchanged
 
     """
+    # Hash content before the run date is added
+    content_hash = hash_output(df)
+    manifest = read_manifest(file_path)
+    workbook_state = get_workbook_state(file_path)
+
+    if (not param.IY_FORCE_EXPORT and workbook_state is not None and
+            manifest.get(sheet, {}).get("hash") == content_hash and
+            manifest[sheet].get("Workbook") == workbook_state):
+        print(f"export_inyear - {sheet} sheet unchanged since last export, skipping")
+        export_log[f"{pathlib.Path(file_path).name} {sheet}"] = False
+
+        return False
+
     print(f"export_inyear - exporting outputs to {sheet} sheet of output file")
 
+    # Import xlwings only when exporting to Excel, as it is slow to import
+    import xlwings as xw
+
     # Add run date/time to file before export
-    df["RunDate"] = datetime.now().strftime("%Y-%m-%d, %H:%M:%S")
+    rundate = datetime.now().strftime("%Y-%m-%d, %H:%M:%S")
+    df = df.assign(RunDate=rundate)
 
     # Open Excel application
     app = xw.App(visible=True)
@@ -31,6 +177,10 @@ def export_excel_data(df, sheet, file_path):
     # Open output Excel workbook
     wb = xw.books.open(file_path)
 
+    # Add data sheet if it is a new output
+    if sheet not in [sht.name for sht in wb.sheets]:
+        wb.sheets.add(sheet, after=wb.sheets[-1])
+
     # Select data sheet and overwrite with latest data in dataframe
     sht = wb.sheets[sheet]
     sht.select()
@@ -44,6 +194,198 @@ def export_excel_data(df, sheet, file_path):
     # Close Excel
     app.quit()
 
+    # Record content hash and description of the exported sheet. Other sheets
+    # recorded against the workbook as it was before saving are still current
+    saved_state = get_workbook_state(file_path)
+
+    for entry in manifest.values():
+        if workbook_state is not None and entry.get("Workbook") == workbook_state:
+            entry["Workbook"] = saved_state
+
+    manifest[sheet] = {"hash": content_hash, "RunDate": rundate, "Workbook": saved_state,
+                       **describe_output(df)}
+    write_manifest(manifest, file_path)
+    export_log[f"{pathlib.Path(file_path).name} {sheet}"] = True
+
     outputfile = str(file_path).split("\\")[-1]
 
     print(f"export_inyear - {sheet} sheet updated with latest data in {outputfile}")
+
+    return True
+
+
+def export_csv_data(df, sheet, file_path):
+    """
+    This function will export the specified dataframe to a CSV file named
+    after the sheet, alongside the output file indicated.
+    As for Excel, the export is skipped when the content is unchanged since
+    the last export (unless IY_FORCE_EXPORT is set)
+
+    Parameters:
+        df:
+            the dataframe to be exported
+        sheet:
+            the output sheet name, used to name the CSV file
+        file_path:
+            the full file path and name of the output file
+
+    Returns:
+        True if the CSV file was updated, False if it was unchanged
+
+    """
+    file_path = pathlib.Path(file_path)
+    csv_path = file_path.with_name(f"{file_path.stem}_{sheet}.csv")
+
+    content_hash = hash_output(df)
+    manifest = read_manifest(file_path)
+
+    if (not param.IY_FORCE_EXPORT and csv_path.exists() and
+            manifest.get(csv_path.name, {}).get("hash") == content_hash):
+        print(f"export_inyear - {csv_path.name} unchanged since last export, skipping")
+        export_log[csv_path.name] = False
+
+        return False
+
+    print(f"export_inyear - exporting outputs to {csv_path.name}")
+
+    rundate = datetime.now().strftime("%Y-%m-%d, %H:%M:%S")
+    df = df.assign(RunDate=rundate)
+
+    # Write in chunks of rows, rather than formatting the whole file at once
+    df.to_csv(csv_path, index=False, chunksize=param.EXPORT_CHUNK_ROWS)
+
+    manifest[csv_path.name] = {"hash": content_hash, "RunDate": rundate, **describe_output(df)}
+    write_manifest(manifest, file_path)
+    export_log[csv_path.name] = True
+
+    return True
+
+
+def export_parquet_data(df, sheet, file_path):
+    """
+    This function will export the specified dataframe to a Parquet file named
+    after the sheet, alongside the output file indicated, writing one row
+    group of EXPORT_CHUNK_ROWS rows at a time.
+    As for Excel, the export is skipped when the content is unchanged since
+    the last export (unless IY_FORCE_EXPORT is set)
+
+    Parameters:
+        df:
+            the dataframe to be exported
+        sheet:
+            the output sheet name, used to name the Parquet file
+        file_path:
+            the full file path and name of the output file
+
+    Returns:
+        True if the Parquet file was updated, False if it was unchanged
+
+    """
+    file_path = pathlib.Path(file_path)
+    parquet_path = file_path.with_name(f"{file_path.stem}_{sheet}.parquet")
+
+    content_hash = hash_output(df)
+    manifest = read_manifest(file_path)
+
+    if (not param.IY_FORCE_EXPORT and parquet_path.exists() and
+            manifest.get(parquet_path.name, {}).get("hash") == content_hash):
+        print(f"export_inyear - {parquet_path.name} unchanged since last export, skipping")
+        export_log[parquet_path.name] = False
+
+        return False
+
+    print(f"export_inyear - exporting outputs to {parquet_path.name}")
+
+    # Import pyarrow only when exporting to Parquet, as it is optional
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    rundate = datetime.now().strftime("%Y-%m-%d, %H:%M:%S")
+    df = df.assign(RunDate=rundate)
+
+    # Columns mixing values of different types (e.g. IMD deciles and
+    # "Not stated") are written as text
+    mixed = [col for col in df.columns if df[col].dtype == object and
+             pd.api.types.infer_dtype(df[col], skipna=True).startswith("mixed")]
+    df = df.assign(**{col: df[col].where(df[col].isnull(), df[col].astype(str))
+                      for col in mixed})
+
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+
+    with pq.ParquetWriter(parquet_path, schema) as writer:
+        for start in range(0, max(len(df), 1), param.EXPORT_CHUNK_ROWS):
+            writer.write_table(pa.Table.from_pandas(df.iloc[start:start + param.EXPORT_CHUNK_ROWS],
+                                                    schema=schema, preserve_index=False))
+
+    manifest[parquet_path.name] = {"hash": content_hash, "RunDate": rundate, **describe_output(df)}
+    write_manifest(manifest, file_path)
+    export_log[parquet_path.name] = True
+
+    return True
+
+
+# Export functions for each output format
+EXPORT_FORMATS = {"excel": export_excel_data,
+                  "csv": export_csv_data,
+                  "parquet": export_parquet_data}
+
+
+def record_failure(name, error):
+    """
+    Records and prints a table or sheet that failed to build or export, so
+    the run can continue with the other tables
+    """
+    print(f"export_inyear - {name} failed: {type(error).__name__}: {error}")
+    export_failures[name] = f"{type(error).__name__}: {error}"
+
+
+def export_outputs(outputs, file_path, output_format="excel"):
+    """
+    This function will export each of the table outputs specified in each
+    of the chosen output formats, or in the formats set for the sheet in
+    OUTPUT_SHEET_FORMATS. A sheet that fails to export in one format is
+    recorded and the other sheets and formats are still exported
+
+    Parameters:
+        outputs:
+            dictionary of {sheet name: output dataframe}
+        file_path:
+            the full file path and name of the output file
+        output_format:
+            one of the keys of EXPORT_FORMATS, or a list of them
+
+    Returns:
+        None
+    """
+    formats = [output_format] if isinstance(output_format, str) else output_format
+
+    for sheet, df in outputs.items():
+        for export_format in param.OUTPUT_SHEET_FORMATS.get(sheet, formats):
+            try:
+                EXPORT_FORMATS[export_format](df, sheet, file_path)
+            except Exception as error:
+                record_failure(f"{sheet} ({export_format}, {pathlib.Path(file_path).name})", error)
+
+
+def summarise_exports():
+    """
+    Prints a summary of the outputs (workbook sheets and files) updated,
+    left unchanged and failed in this run
+
+    Parameters:
+        None
+
+    Returns:
+        List of the outputs updated in this run
+    """
+    changed = [output for output, updated in export_log.items() if updated]
+    unchanged = [output for output, updated in export_log.items() if not updated]
+
+    print("export_inyear - run summary")
+    print(f"    outputs changed: {', '.join(changed) if changed else 'none'}")
+    print(f"    outputs unchanged: {', '.join(unchanged) if unchanged else 'none'}")
+
+    if export_failures:
+        print(f"    FAILED ({len(export_failures)}): {', '.join(export_failures)}")
+
+    return changed
@@ -1,6 +1,30 @@
+import pathlib
+
 import pandas as pd
 
+import ncmp_inyear_code.parameters_inyear as param
 import ncmp_inyear_code.utilities.data_connections as dbc
+from ncmp_inyear_code.utilities.reference_cache import get_reference_data
+from ncmp_inyear_code.utilities.out_of_core import spill_partitions
+from ncmp_inyear_code.utilities.pupil_features import derive_pupil_features
+from ncmp_inyear_code.utilities.duplicate_check import check_duplicates
+from ncmp_inyear_code.utilities.parallel_csv import read_csv_parallel
+
+# Server and database of the NCMP and corporate reference data SQL tables
+SQL_SERVER = "SERVER"
+SQL_DATABASE = "DATABASE"
+
+
+def render_query(sql_file_name, placeholder, value):
+    """
+    Returns the text of the SQL query in the file given (from the SQL
+    folder), with the placeholder replaced by the value given. This is the
+    query text the query result cache is keyed on
+    """
+    with open(param.SQL_DIR / sql_file_name, "r") as sql_file:
+        data = sql_file.read()
+
+    return data.replace(placeholder, value)
 
 
 """IMPORT LA DATA FUNCTIONS"""
@@ -73,23 +97,101 @@ def import_LA_compyear(compyear):
     """
     print("import_inyeardata - importing LA comparison data")
 
-    server = "SERVER"
-    database = "DATABASE"
-
-    sql_folder = r"ncmp_inyear_code\sql_code"
-
-    with open(sql_folder + "\query_la_compyear.sql", "r") as sql_file:
-        data = sql_file.read()
+    server = SQL_SERVER
+    database = SQL_DATABASE
 
-    data = data.replace("<IY_COMPYEAR>", compyear)
+    data = render_query("query_la_compyear.sql", "<IY_COMPYEAR>", compyear)
 
-    # Get SQL data
-    df_la_compyear = dbc.df_from_sql(data, server, database)
+    # Get SQL data (or cached query result)
+    df_la_compyear = dbc.df_from_sql_cached(data, server, database)
 
     return df_la_compyear
 
 """IMPORT PUPIL DATA FUNCTIONS"""
 
+# Pupil data file columns required for the process
+PUPIL_IMPORT_COLS = ["Bmi", "BmiPopulationCategory", "BmiPScore",
+                     "GenderCode",
+                     "NcmpEthnicityCode", "NcmpSchoolStatus", "NcmpSystemId",
+                     "NhsEthnicityDescription",
+                     "PupilIndexOfMultipleDeprivationDecile",
+                     "SchoolIndexOfMultipleDeprivationDecile",
+                     "SchoolLowerSuperOutputArea2011",
+                     "SchoolUrn", "SchoolYear", "SubmitterLocalAuthorityCode",
+                     "SubmitterLocalAuthorityName"]
+
+# Types of the pupil data file columns for the readers that parse the file
+# in parts (chunks or byte ranges) or with pyarrow, so every part has the
+# same types whatever values it holds. Identifier columns (NcmpSystemId,
+# SchoolUrn and the LA code) are read as strings, as from the SQL data.
+# The default pandas reader infers the types from the whole file instead
+PUPIL_DTYPES = {"Bmi": "float64",
+                "BmiPopulationCategory": str,
+                "BmiPScore": "float64",
+                "GenderCode": str,
+                "NcmpEthnicityCode": str,
+                "NcmpSchoolStatus": str,
+                "NcmpSystemId": str,
+                "NhsEthnicityDescription": str,
+                "PupilIndexOfMultipleDeprivationDecile": "float64",
+                "SchoolIndexOfMultipleDeprivationDecile": "float64",
+                "SchoolLowerSuperOutputArea2011": str,
+                "SchoolUrn": str,
+                "SchoolYear": str,
+                "SubmitterLocalAuthorityCode": str,
+                "SubmitterLocalAuthorityName": str}
+
+
+def filter_ncmp(df):
+    """
+    Filters the pupil data for NCMP schools that have submitted BMI data
+    """
+    return df[(df["Bmi"].notnull()) & (df["NcmpSchoolStatus"] == "NCMP")].copy()
+
+
+def read_pupils_arrow(file_path, import_cols):
+    """
+    This function will read the pupil level data from the specified location
+    with the multithreaded pyarrow CSV reader, filtering for NCMP schools
+    with BMI data before converting to pandas, so rows that are filtered out
+    are never converted to Python objects.
+    Repeated strings are converted to shared Python objects, and columns
+    are returned in the order of the file, with the types in PUPIL_DTYPES
+    and empty fields as missing values, as for pandas
+
+    Parameters:
+        file_path:
+            the full file path and name
+        import_cols:
+            list of the columns to import
+
+    Returns:
+        Dataframe with specified columns, for NCMP schools with BMI data
+    """
+    # Import pyarrow only when selected, as it is an optional dependency
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+
+    column_types = {col: pa.string() if dtype is str else pa.from_numpy_dtype(dtype)
+                    for col, dtype in PUPIL_DTYPES.items() if col in import_cols}
+
+    # Read empty (and quoted empty) strings as missing, as pandas does
+    table = pa_csv.read_csv(file_path,
+                            read_options=pa_csv.ReadOptions(use_threads=True),
+                            convert_options=pa_csv.ConvertOptions(include_columns=import_cols,
+                                                                  column_types=column_types,
+                                                                  strings_can_be_null=True,
+                                                                  quoted_strings_can_be_null=True))
+
+    table = table.filter(pc.and_(pc.is_valid(table["Bmi"]),
+                                 pc.equal(table["NcmpSchoolStatus"], "NCMP")))
+
+    file_cols = pd.read_csv(file_path, nrows=0).columns
+
+    return table.to_pandas(deduplicate_objects=True)[[col for col in file_cols
+                                                      if col in import_cols]]
+
 
 def import_pupils_data(file_path):
     """
@@ -97,6 +199,8 @@ def import_pupils_data(file_path):
     It will only import the specified columns, with data for NCMP schools that
     have provided BMI measurements.
     It will also update 'very overweight' to 'obese' for reporting purposes
+    and add the derived pupil features (see pupil_features), and check for
+    duplicate NcmpSystemId if IY_DUPLICATE_CHECK is set
 
     Parameters:
         file_path:
@@ -109,26 +213,31 @@ def import_pupils_data(file_path):
     # Import pupil data - select only columns required for process
     print("import_inyeardata - importing pupils data")
 
-    import_cols = ["Bmi", "BmiPopulationCategory", "BmiPScore",
-                   "GenderCode",
-                   "NcmpEthnicityCode", "NcmpSchoolStatus", "NcmpSystemId",
-                   "NhsEthnicityDescription",
-                   "PupilIndexOfMultipleDeprivationDecile",
-                   "SchoolIndexOfMultipleDeprivationDecile",
-                   "SchoolLowerSuperOutputArea2011",
-                   "SchoolUrn", "SchoolYear", "SubmitterLocalAuthorityCode",
-                   "SubmitterLocalAuthorityName"]
-
-    df_pupils_import = pd.read_csv(file_path, usecols=import_cols)
-
-    # Filter for NCMP schools that have submitted BMI data
-    df_pupils_import = df_pupils_import[(df_pupils_import["Bmi"].notnull()) &
-                                        (df_pupils_import["NcmpSchoolStatus"] == "NCMP")].copy()
+    if param.IY_CSV_ENGINE == "pyarrow":
+        df_pupils_import = read_pupils_arrow(file_path, PUPIL_IMPORT_COLS)
+    elif param.IY_CSV_ENGINE == "parallel":
+        # Read byte ranges of the file on several cores, filtering each range
+        df_pupils_import = read_csv_parallel(file_path, PUPIL_IMPORT_COLS, PUPIL_DTYPES,
+                                             filter_ncmp, param.IY_CSV_WORKERS)
+    elif param.IY_OUT_OF_CORE:
+        # Read in chunks, filtering each chunk before it is combined
+        df_pupils_import = pd.concat(filter_ncmp(chunk) for chunk in
+                                     pd.read_csv(file_path, usecols=PUPIL_IMPORT_COLS,
+                                                 dtype=PUPIL_DTYPES,
+                                                 chunksize=param.IY_CHUNK_ROWS))
+    else:
+        df_pupils_import = filter_ncmp(pd.read_csv(file_path, usecols=PUPIL_IMPORT_COLS))
 
     # Update 'very overweight' to 'obese'
     df_pupils_import.loc[df_pupils_import["BmiPopulationCategory"] == "very overweight",
                          "BmiPopulationCategory"] = "obese"
 
+    df_pupils_import = derive_pupil_features(df_pupils_import)
+
+    if param.IY_DUPLICATE_CHECK:
+        df_pupils_import = check_duplicates(df_pupils_import, pathlib.Path(file_path).stem,
+                                            param.IY_DEDUPLICATE)
+
     return df_pupils_import
 
 
@@ -138,6 +247,8 @@ def import_pupils_compyear(compyear):
     import for this year, from the specified location, based on the query
     referenced below
     It will also update 'very overweight' to 'obese' for reporting purposes
+    and add the derived pupil features (see pupil_features), and check for
+    duplicate NcmpSystemId if IY_DUPLICATE_CHECK is set
 
     Parameters:
         compyear:
@@ -149,23 +260,24 @@ def import_pupils_compyear(compyear):
     """
     print("import_inyeardata - importing pupils comparison data")
 
-    server = "SERVER"
-    database = "DATABASE"
-
-    sql_folder = r"ncmp_inyear_code\sql_code"
+    server = SQL_SERVER
+    database = SQL_DATABASE
 
-    with open(sql_folder + "\query_pupils_compyear.sql", "r") as sql_file:
-        data = sql_file.read()
-
-    data = data.replace("<IY_COMPYEAR>", compyear)
+    data = render_query("query_pupils_compyear.sql", "<IY_COMPYEAR>", compyear)
 
-    # Get SQL data
-    df_pupils_compyear = dbc.df_from_sql(data, server, database)
+    # Get SQL data (or cached query result)
+    df_pupils_compyear = dbc.df_from_sql_cached(data, server, database)
 
     # Update 'very overweight' to 'obese'
     df_pupils_compyear.loc[df_pupils_compyear["BmiPopulationCategory"] == "very overweight",
                            "BmiPopulationCategory"] = "obese"
 
+    df_pupils_compyear = derive_pupil_features(df_pupils_compyear)
+
+    if param.IY_DUPLICATE_CHECK:
+        df_pupils_compyear = check_duplicates(df_pupils_compyear, "pupils_compyear",
+                                              param.IY_DEDUPLICATE)
+
     return df_pupils_compyear
 
 
@@ -175,33 +287,45 @@ def import_pupils_baseyears(baseyears):
     base data for the weighting table output, from the specified location,
     based on the query referenced below
     It will also update 'very overweight' to 'obese' for reporting purposes
+    and add the derived pupil features (see pupil_features)
 
     Parameters:
         baseyears:
             defines which years to use in the SQL query for filtering
 
+    If IY_OUT_OF_CORE is set, the data is read in chunks and spilled to
+    local disk in partitions by academic year, and the folder of partitions
+    is returned instead (see out_of_core.iter_partitions)
+
     Returns:
         Dataframe with the extracted SQL data for the base years specified
-        and 'very overweight' updated to 'obese'
+        and 'very overweight' updated to 'obese' (or the folder of
+        partitions of the data if out of core)
     """
     print("import_inyeardata - importing base years data for weighting")
 
-    server = "SERVER"
-    database = "DATABASE"
+    server = SQL_SERVER
+    database = SQL_DATABASE
 
-    sql_folder = r"ncmp_inyear_code\sql_code"
+    data = render_query("query_pupils_baseyears.sql", "<IY_BASEYEARS>", baseyears)
 
-    with open(sql_folder + "\query_pupils_baseyears.sql", "r") as sql_file:
-        data = sql_file.read()
+    # Update 'very overweight' to 'obese' and add the derived features
+    def recode_obese(df):
+        df.loc[df["BmiPopulationCategory"] == "very overweight",
+               "BmiPopulationCategory"] = "obese"
 
-    data = data.replace("<IY_BASEYEARS>", baseyears)
+        return derive_pupil_features(df)
 
-    # Get SQL data
-    df_pupils_baseyears = dbc.df_from_sql(data, server, database)
+    if param.IY_OUT_OF_CORE:
+        # Get SQL data (or cached query result) in chunks and spill to disk by academic year
+        chunks = dbc.df_chunks_from_sql_cached(data, server, database, param.IY_CHUNK_ROWS)
 
-    # Update 'very overweight' to 'obese'
-    df_pupils_baseyears.loc[df_pupils_baseyears["BmiPopulationCategory"] == "very overweight",
-                            "BmiPopulationCategory"] = "obese"
+        return spill_partitions((recode_obese(chunk) for chunk in chunks),
+                                param.SPILL_DIR / "pupils_baseyears",
+                                "AcademicYear", param.IY_MEMORY_BUDGET_MB)
+
+    # Get SQL data (or cached query result)
+    df_pupils_baseyears = recode_obese(dbc.df_from_sql_cached(data, server, database))
 
     return df_pupils_baseyears
 
@@ -212,7 +336,8 @@ def import_pupils_baseyears(baseyears):
 def import_ethnicity_ref():
     """
     This function will import the ethnicity reference data from the
-    from the specified location
+    from the specified location, using the local snapshot if the source
+    is unchanged
 
     Parameters:
         None
@@ -222,16 +347,16 @@ def import_ethnicity_ref():
     """
     print("import_inyeardata - importing ethnicity reference data")
 
-    server = "SERVER"
-    database = "DATABASE"
+    server = SQL_SERVER
+    database = SQL_DATABASE
 
-    sql_folder = r"ncmp_inyear_code\sql_code"
-
-    with open(sql_folder + "\query_ethnicity_ref.sql", "r") as sql_file:
+    with open(param.SQL_DIR / "query_ethnicity_ref.sql", "r") as sql_file:
         data = sql_file.read()
 
-    # Get SQL data
-    df_ethnicity_ref = dbc.df_from_sql(data, server, database)
+    # Get SQL data (or local snapshot)
+    df_ethnicity_ref = get_reference_data("ethnicity_ref", data, "Value",
+                                          server, database,
+                                          columns=["Value", "NhsEthnicityDescription"])
 
     return df_ethnicity_ref
 
@@ -239,7 +364,8 @@ def import_ethnicity_ref():
 def import_lsoa_ref():
     """
     This function will import the latest LSOA reference data from the
-    from the specified location
+    from the specified location, using the local snapshot if the source
+    is unchanged
 
     Parameters:
         None
@@ -249,19 +375,18 @@ def import_lsoa_ref():
     """
     print("import_inyeardata - importing LSOA reference data")
 
-    server = "SERVER"
-    database = "DATABASE"
-
-    sql_folder = r"ncmp_inyear_code\sql_code"
+    server = SQL_SERVER
+    database = SQL_DATABASE
 
-    with open(sql_folder + "\query_lsoa_ref.sql", "r") as sql_file:
+    with open(param.SQL_DIR / "query_lsoa_ref.sql", "r") as sql_file:
         data = sql_file.read()
 
-    # Get SQL data
-    df_lsoa_ref = dbc.df_from_sql(data, server, database)
-
+    # Get SQL data (or local snapshot)
     # Remove duplicates from LSOA reference data, keep only the last entry
-    df_lsoa_ref = df_lsoa_ref.drop_duplicates(subset=["LSOACD"], keep='last')
+    df_lsoa_ref = get_reference_data("lsoa_ref", data, "LSOACD",
+                                     server, database,
+                                     columns=["LSOACD", "LADCD"],
+                                     dedup=True)
 
     return df_lsoa_ref
 
@@ -269,7 +394,8 @@ def import_lsoa_ref():
 def import_la_e07_ref():
     """
     This function will import the latest E07 LA reference data from the
-    from the specified location
+    from the specified location, using the local snapshot if the source
+    is unchanged
 
     Parameters:
         None
@@ -280,19 +406,19 @@ def import_la_e07_ref():
     """
     print("import_inyeardata - importing E07 LA reference data")
 
-    server = "SERVER"
-    database = "DATABASE"
+    server = SQL_SERVER
+    database = SQL_DATABASE
 
-    sql_folder = r"ncmp_inyear_code\sql_code"
-
-    with open(sql_folder + "\query_la_e07_ref.sql", "r") as sql_file:
+    with open(param.SQL_DIR / "query_la_e07_ref.sql", "r") as sql_file:
         data = sql_file.read()
 
-    # Get SQL data
-    df_la_e07_ref = dbc.df_from_sql(data, server, database)
-
-    # Remove duplicates from LSOA reference data, keep only the last entry
-    df_la_e07_ref = df_la_e07_ref.drop_duplicates(subset=["GEOGRAPHY_CODE"],
-                                                  keep='last')
+    # Get SQL data (or local snapshot)
+    # Remove duplicates from E07 reference data, keep only the last entry
+    df_la_e07_ref = get_reference_data("la_e07_ref", data, "GEOGRAPHY_CODE",
+                                       server, database,
+                                       columns=["PARENT_GEOGRAPHY_CODE",
+                                                "GEOGRAPHY_CODE",
+                                                "ENTITY_CODE"],
+                                       dedup=True)
 
     return df_la_e07_ref
@@ -0,0 +1,97 @@
+"""
+Purpose of script: checks that the table modules import quickly, without
+loading heavy dependencies that are only needed at the point of use
+(Excel export, SQL connections).
+"""
+import json
+import pathlib
+import subprocess
+import sys
+
+import ncmp_inyear_code.parameters_inyear as param
+
+# Dependencies that should only be imported when they are used
+HEAVY_MODULES = ["xlwings", "sqlalchemy", "pyodbc", "scipy", "pyarrow"]
+
+# Times the import of a module in a fresh interpreter, after pandas and numpy
+# (which every module needs) have been imported. Only heavy dependencies newly
+# loaded by the module are reported, not those loaded by pandas itself
+TIMING_CODE = """
+import json, sys, time
+import numpy, pandas
+before = set(sys.modules)
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds,
+                  "loaded": [m for m in {heavy} if m in sys.modules and m not in before]}}))
+"""
+
+
+def get_table_modules():
+    """
+    Returns the names of the table modules, plus the publication script
+    used as the command line entry point
+    """
+    utilities_dir = pathlib.Path(__file__).parent
+
+    modules = [f"ncmp_inyear_code.utilities.{path.stem}"
+               for path in sorted(utilities_dir.glob("table_*.py"))]
+
+    return modules + ["ncmp_inyear_code.create_publication_inyear"]
+
+
+def time_import(module):
+    """
+    This function will time the import of the module specified in a fresh
+    Python process
+
+    Parameters:
+        module:
+            full name of the module to import
+
+    Returns:
+        Dictionary with the import time in seconds ("seconds") and the list
+        of heavy dependencies loaded by the import ("loaded")
+    """
+    code = TIMING_CODE.format(module=module, heavy=HEAVY_MODULES)
+
+    # Run from the project folder so the package can be imported
+    project_dir = pathlib.Path(__file__).parents[2]
+
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True,
+                            text=True, check=True, cwd=project_dir)
+
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def check_import_times(budget=None):
+    """
+    This function will check the import time of each table module against
+    the budget, and that no heavy dependencies are loaded on import
+
+    Parameters:
+        budget:
+            maximum import time in seconds for each module
+            (defaults to IMPORT_TIME_BUDGET in the parameters file)
+
+    Returns:
+        True if every module is within budget, otherwise False
+    """
+    if budget is None:
+        budget = param.IMPORT_TIME_BUDGET
+
+    print(f"import_timing - checking import times against a budget of {budget}s")
+
+    passed = True
+
+    for module in get_table_modules():
+        timing = time_import(module)
+        within_budget = timing["seconds"] <= budget and not timing["loaded"]
+        passed = passed and within_budget
+
+        loaded = f", loaded {', '.join(timing['loaded'])}" if timing["loaded"] else ""
+        print(f"    {'ok' if within_budget else 'FAIL'}  {module}: "
+              f"{timing['seconds']:.3f}s{loaded}")
+
+    return passed
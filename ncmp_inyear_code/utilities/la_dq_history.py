@@ -0,0 +1,144 @@
+"""
+Purpose of script: keeps a local history of the monthly LA data quality
+snapshots, keyed by extract date, with month-on-month trends in the number
+measured by each LA and in the England data quality indicators (table A3).
+
+Each snapshot and its trend values are kept in their own files, so when a
+new snapshot arrives only its change from the previous snapshot (and the
+change for the snapshot after it, if an earlier snapshot arrives late) is
+calculated, rather than recalculating the whole history.
+
+Files are written in the Feather (Arrow) columnar format if the optional
+pyarrow package is installed, otherwise as pickles.
+"""
+import importlib.util
+
+import pandas as pd
+
+import ncmp_inyear_code.parameters_inyear as param
+
+# Measured totals of each LA tracked in the trends
+LA_TREND_COLS = ["TotalEligMeas", "TotalEligMeasYrR", "TotalEligMeasYr6"]
+
+
+def write_history_frame(df, name):
+    """
+    Writes a dataframe to the history folder under the name given
+    """
+    param.LA_DQ_HISTORY_DIR.mkdir(parents=True, exist_ok=True)
+
+    if importlib.util.find_spec("pyarrow"):
+        df.reset_index(drop=True).to_feather(param.LA_DQ_HISTORY_DIR / f"{name}.feather")
+    else:
+        df.to_pickle(param.LA_DQ_HISTORY_DIR / f"{name}.pkl")
+
+
+def read_history_frame(path):
+    """
+    Reads a dataframe written by write_history_frame
+    """
+    if path.suffix == ".feather":
+        return pd.read_feather(path)
+
+    return pd.read_pickle(path)
+
+
+def get_history_paths(prefix):
+    """
+    Returns {extract date (yyyymmdd): path} of the history files with the
+    prefix given, in date order
+    """
+    if not param.LA_DQ_HISTORY_DIR.exists():
+        return {}
+
+    paths = param.LA_DQ_HISTORY_DIR.glob(f"{prefix}_*")
+
+    return dict(sorted((path.stem[len(prefix) + 1:], path) for path in paths))
+
+
+def calc_trend(df_values, df_previous):
+    """
+    Adds the change in each value since the previous snapshot
+
+    Parameters:
+        df_values:
+            trend values of a snapshot (LADQExtractDate, LACode, Indicator,
+            Value)
+        df_previous:
+            trend values of the previous snapshot, or None for the first
+
+    Returns:
+        Dataframe of the trend values with PrevExtractDate and Change added
+    """
+    df_trend = df_values[["LADQExtractDate", "LACode", "Indicator", "Value"]]
+
+    if df_previous is None:
+        df_trend = df_trend.assign(PrevExtractDate=pd.NaT, Change=float("nan"))
+    else:
+        df_previous = df_previous[["LADQExtractDate", "LACode", "Indicator", "Value"]]
+
+        df_trend = pd.merge(df_trend,
+                            df_previous.rename(columns={"LADQExtractDate": "PrevExtractDate",
+                                                        "Value": "PrevValue"}),
+                            how="left", on=["LACode", "Indicator"])
+
+        df_trend["Change"] = df_trend["Value"] - df_trend["PrevValue"]
+        df_trend = df_trend.drop(columns="PrevValue")
+
+    return df_trend
+
+
+def add_la_dq_snapshot(df_la_import, df_eng, extract_date):
+    """
+    This function will add an LA data quality snapshot to the history, and
+    calculate the change in the measured totals for each LA and in the
+    England indicators since the previous snapshot in the history.
+    A snapshot for an extract date already in the history replaces it
+
+    Parameters:
+        df_la_import:
+            imported LA data quality data
+        df_eng:
+            England data quality indicators (Indicator, Value) from table A3
+        extract_date:
+            extract date of the LA data quality file
+
+    Returns:
+        Dataframe of the trend values of every snapshot in the history
+    """
+    key = extract_date.strftime("%Y%m%d")
+
+    print(f"la_dq_history - adding LA DQ snapshot {extract_date} to history")
+
+    write_history_frame(df_la_import, f"la_dq_{key}")
+
+    # Trend values - measured totals for each LA and England indicators
+    df_la = df_la_import[["LACode", "TotalEligMeasYrR", "TotalEligMeasYr6"]].copy()
+    df_la["TotalEligMeas"] = df_la["TotalEligMeasYrR"] + df_la["TotalEligMeasYr6"]
+
+    df_values = pd.concat([df_la.melt(id_vars="LACode", value_vars=LA_TREND_COLS,
+                                      var_name="Indicator", value_name="Value"),
+                           df_eng[["Indicator", "Value"]].assign(LACode="England")])
+
+    df_values["LACode"] = df_values["LACode"].astype(str)
+    df_values["Value"] = df_values["Value"].astype(float)
+    df_values["LADQExtractDate"] = pd.Timestamp(extract_date)
+
+    # Only the snapshots either side of this one in the history are needed
+    trend_paths = get_history_paths("trend")
+    trend_paths.pop(key, None)
+
+    previous = [date for date in trend_paths if date < key]
+    following = [date for date in trend_paths if date > key]
+
+    df_previous = read_history_frame(trend_paths[previous[-1]]) if previous else None
+
+    write_history_frame(calc_trend(df_values, df_previous), f"trend_{key}")
+
+    # A snapshot arriving after later ones changes the trend of the next one
+    if following:
+        df_next = read_history_frame(trend_paths[following[0]])
+        write_history_frame(calc_trend(df_next, df_values), f"trend_{following[0]}")
+
+    return pd.concat([read_history_frame(path) for path
+                      in get_history_paths("trend").values()], ignore_index=True)
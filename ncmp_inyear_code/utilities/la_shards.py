@@ -0,0 +1,123 @@
+"""
+Purpose of script: splits the pupil level data into shards by LA, so the
+counts used by the pupil level tables can be made for each LA separately
+(in parallel) and added together, before the proportions and confidence
+intervals are calculated from the combined counts.
+
+The counts for each LA are kept in a folder per table, so the tables can be
+updated for LAs that resubmit their data by recounting only those LAs.
+"""
+import shutil
+
+import pandas as pd
+
+import ncmp_inyear_code.parameters_inyear as param
+
+# Column holding the LA of each pupil, in the pupil data and NCMP SQL table
+SHARD_COLUMN = "OrgCode"
+
+
+def split_la_shards(data):
+    """
+    This function will split the imported data given into shards by LA.
+    Data with an LA column is split, other data (e.g. reference data) is
+    included in full in every shard
+
+    Parameters:
+        data:
+            dictionary of {import name: imported data}
+
+    Returns:
+        Dictionary of {LA code: dictionary of {import name: data for the LA}},
+        with data for each LA in any of the imported data
+    """
+    split = {name: dict(tuple(df.groupby(SHARD_COLUMN, sort=False, dropna=False)))
+             for name, df in data.items()
+             if isinstance(df, pd.DataFrame) and SHARD_COLUMN in df.columns}
+
+    las = sorted({get_shard_name(la) for groups in split.values() for la in groups})
+
+    shards = {la: {} for la in las}
+
+    for name, df in data.items():
+        if name not in split:
+            for la in las:
+                shards[la][name] = df
+            continue
+
+        groups = {get_shard_name(la): df_la for la, df_la in split[name].items()}
+
+        # LAs without data in this import get an empty dataframe
+        for la in las:
+            shards[la][name] = groups.get(la, df.iloc[0:0])
+
+    return shards
+
+
+def get_shard_name(la):
+    """
+    Returns the name of the shard for an LA code, "unknown" for pupils
+    without an LA
+    """
+    return "unknown" if pd.isnull(la) else str(la)
+
+
+def merge_la_counts(counts):
+    """
+    This function will add together the counts made for each LA
+
+    Parameters:
+        counts:
+            dictionary of {LA code: counts for the LA}, with the counts
+            indexed by the groups counted
+
+    Returns:
+        Dataframe of counts indexed by the groups counted, in sorted order
+    """
+    df_counts = pd.concat(list(counts.values()))
+
+    return df_counts.groupby(level=list(range(df_counts.index.nlevels)),
+                             dropna=False).sum()
+
+
+def write_la_counts(table, counts):
+    """
+    This function will store the counts made for each LA for the table
+    specified, replacing those stored from the last run
+
+    Parameters:
+        table:
+            name of the table
+        counts:
+            dictionary of {LA code: counts for the LA}
+    """
+    shard_dir = param.SHARD_DIR / table
+
+    if shard_dir.exists():
+        shutil.rmtree(shard_dir)
+
+    shard_dir.mkdir(parents=True)
+
+    for la, df_counts in counts.items():
+        df_counts.to_pickle(shard_dir / f"{la}.pkl")
+
+
+def read_la_counts(table):
+    """
+    This function will read the counts stored for each LA for the table
+    specified
+
+    Parameters:
+        table:
+            name of the table
+
+    Returns:
+        Dictionary of {LA code: counts for the LA}
+    """
+    shard_dir = param.SHARD_DIR / table
+
+    if not shard_dir.exists():
+        raise FileNotFoundError(f"No LA counts stored for {table} in {shard_dir}, "
+                                "run with IY_LA_SHARDS set first")
+
+    return {path.stem: pd.read_pickle(path) for path in sorted(shard_dir.glob("*.pkl"))}
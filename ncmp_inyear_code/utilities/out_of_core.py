@@ -0,0 +1,93 @@
+"""
+Purpose of script: holds large datasets out of core, by spilling them to
+local disk in partitions as they are read in chunks, so they can be
+processed one partition at a time within a memory budget.
+
+Partitions are written as pickles in a folder per value of the partition
+column, and are read back in the order they were written.
+"""
+import shutil
+
+import pandas as pd
+
+# Fraction of the memory budget that may be held in unwritten partitions,
+# leaving room for the merges applied to each partition in the table stage
+SPILL_FRACTION = 0.25
+
+
+def spill_partitions(chunks, spill_dir, partition_col, budget_mb):
+    """
+    This function will write the chunks of data given to local disk in
+    partitions by the values of the partition column. Chunks are buffered
+    in memory and written once the buffer reaches its share of the memory
+    budget, so partitions are as large as the budget allows
+
+    Parameters:
+        chunks:
+            iterable of dataframes with the same columns
+        spill_dir:
+            folder to write the partitions to (emptied first)
+        partition_col:
+            column to partition the data by
+        budget_mb:
+            memory budget in megabytes
+
+    Returns:
+        Path of the folder containing the partitions
+    """
+    if spill_dir.exists():
+        shutil.rmtree(spill_dir)
+
+    spill_dir.mkdir(parents=True)
+
+    buffer_limit = budget_mb * SPILL_FRACTION * 1024 ** 2
+    buffers = {}
+    buffer_bytes = 0
+    part = 0
+
+    # Write the buffered chunks of each partition value to a new file
+    def write_buffers(buffers, part):
+        for value, buffer in buffers.items():
+            partition_dir = spill_dir / f"{partition_col}={str(value).replace('/', '_')}"
+            partition_dir.mkdir(exist_ok=True)
+            pd.concat(buffer).to_pickle(partition_dir / f"part_{part:05d}.pkl")
+
+    for chunk in chunks:
+        for value, df_chunk in chunk.groupby(partition_col, sort=False, dropna=False):
+            buffers.setdefault(value, []).append(df_chunk)
+
+        buffer_bytes += chunk.memory_usage(deep=True).sum()
+
+        if buffer_bytes >= buffer_limit:
+            write_buffers(buffers, part)
+            buffers = {}
+            buffer_bytes = 0
+            part += 1
+
+    write_buffers(buffers, part)
+
+    print(f"out_of_core - data spilled to {part + 1} part(s) in {spill_dir}")
+
+    return spill_dir
+
+
+def iter_partitions(data):
+    """
+    This function will return each partition of the data given in turn.
+    Data held in memory (a dataframe) is returned as a single partition
+
+    Parameters:
+        data:
+            dataframe, or path of a folder of partitions written by
+            spill_partitions
+
+    Returns:
+        Generator of dataframes
+    """
+    if isinstance(data, pd.DataFrame):
+        yield data
+        return
+
+    for partition_dir in sorted(path for path in data.iterdir() if path.is_dir()):
+        for part_path in sorted(partition_dir.glob("part_*.pkl")):
+            yield pd.read_pickle(part_path)
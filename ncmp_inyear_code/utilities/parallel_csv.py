@@ -0,0 +1,152 @@
+"""
+Purpose of script: reads a large CSV file on several cores, by splitting the
+file on line boundaries into byte ranges that are parsed (and filtered) in
+worker processes, then joined back together in file order.
+
+The rows are returned with the same columns, types and row index as a single
+pd.read_csv of the whole file, given the same columns and dtype map. Columns
+without a type in the dtype map are read as strings, as a type inferred for
+each range separately could differ between ranges (e.g. a range where an
+identifier is blank or has a letter).
+Fields must not contain line breaks (as in the NCMP extracts), since the
+ranges are split at each new line.
+"""
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+# Smallest byte range parsed by a worker, so small files are not split
+# into more ranges than is worthwhile
+MIN_RANGE_BYTES = 1024 ** 2
+
+# Number of byte ranges for each worker, so workers that finish their ranges
+# early take on more of the file
+RANGES_PER_WORKER = 4
+
+
+def get_byte_ranges(file_path, ranges):
+    """
+    This function will split a CSV file into byte ranges of about equal size
+    after the header line, each starting and ending on a line boundary
+
+    Parameters:
+        file_path:
+            the full file path and name
+        ranges:
+            number of byte ranges to split the file into
+
+    Returns:
+        List of (start, end) byte offsets of each range, in file order
+    """
+    with open(file_path, "rb") as csv_file:
+        csv_file.readline()
+        data_start = csv_file.tell()
+        file_end = csv_file.seek(0, io.SEEK_END)
+
+        range_bytes = max(MIN_RANGE_BYTES, (file_end - data_start) // max(1, ranges))
+        bounds = [data_start]
+
+        for offset in range(data_start + range_bytes, file_end, range_bytes):
+            # Move to the start of the next line (unless already at one)
+            csv_file.seek(offset - 1)
+            csv_file.readline()
+
+            if bounds[-1] < csv_file.tell() < file_end:
+                bounds.append(csv_file.tell())
+
+        bounds.append(file_end)
+
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+
+
+def read_byte_range(file_path, start, end, names, usecols, dtype, row_filter):
+    """
+    This function will parse a byte range of a CSV file, in a worker process
+
+    Parameters:
+        file_path:
+            the full file path and name
+        start, end:
+            byte offsets of the range, on line boundaries
+        names:
+            list of all the columns in the file header
+        usecols:
+            list of the columns to read
+        dtype:
+            dictionary of {column: type} for every column read
+        row_filter:
+            function taking and returning a dataframe, to filter the rows
+            read (a module level function, so it can be sent to the worker)
+
+    Returns:
+        Tuple of (number of rows in the range, dataframe of the filtered
+        rows indexed by their position in the range)
+    """
+    with open(file_path, "rb") as csv_file:
+        csv_file.seek(start)
+        range_data = csv_file.read(end - start)
+
+    df = pd.read_csv(io.BytesIO(range_data), header=None, names=names,
+                     usecols=usecols, dtype=dtype)
+
+    return len(df), row_filter(df)
+
+
+def read_csv_parallel(file_path, usecols, dtype, row_filter, workers=None):
+    """
+    This function will read a CSV file in byte ranges parsed in parallel
+    worker processes, as for pd.read_csv with the columns and dtype map
+    given followed by the row filter
+
+    Parameters:
+        file_path:
+            the full file path and name
+        usecols:
+            list of the columns to read
+        dtype:
+            dictionary of {column: type} for the columns read (other
+            columns are read as strings)
+        row_filter:
+            module level function taking and returning a dataframe, to
+            filter the rows of each range before they are joined
+        workers:
+            number of worker processes (defaults to one per CPU core)
+
+    Returns:
+        Dataframe of the filtered rows in file order, indexed by their row
+        number in the file
+    """
+    names = list(pd.read_csv(file_path, nrows=0).columns)
+
+    # Fix the type of every column read, so all the ranges have the same types
+    dtype = {col: dtype.get(col, str) for col in usecols or names}
+
+    workers = workers or os.cpu_count() or 1
+    byte_ranges = get_byte_ranges(file_path, workers * RANGES_PER_WORKER)
+
+    # A file with a header only has no ranges to read
+    if not byte_ranges:
+        return row_filter(pd.read_csv(file_path, usecols=usecols, dtype=dtype))
+
+    print(f"parallel_csv - reading {len(byte_ranges)} byte range(s) of "
+          f"{file_path} in {min(workers, len(byte_ranges))} worker process(es)")
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(byte_ranges))) as executor:
+        results = [executor.submit(read_byte_range, file_path, start, end,
+                                   names, usecols, dtype, row_filter)
+                   for start, end in byte_ranges]
+
+        # Number the rows of each range on from the rows of the ranges before it
+        frames = []
+        row_offset = 0
+
+        for result in results:
+            range_rows, df = result.result()
+            df.index = df.index + row_offset
+            row_offset += range_rows
+
+            frames.append(df)
+
+    return pd.concat(frames)
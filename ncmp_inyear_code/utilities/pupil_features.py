@@ -0,0 +1,51 @@
+"""
+Purpose of script: derives the pupil level features used by the tables,
+once for each pupil dataset (this year, comparison year and base years) as
+it is imported, so every table uses the same derived columns.
+
+Pupil data file columns are renamed to the names used in the NCMP SQL
+table, so all pupil datasets share one schema whatever their source.
+"""
+# Pupil data file columns and the NCMP SQL table names they are renamed to
+PUPIL_COLUMN_NAMES = {"PupilIndexOfMultipleDeprivationDecile": "PupilIndexOfMultipleDeprivationD",
+                      "SchoolIndexOfMultipleDeprivationDecile": "SchoolIndexOfMultiDeprivationD",
+                      "SubmitterLocalAuthorityCode": "OrgCode"}
+
+# Gender codes reported, other codes are excluded from the gender breakdowns
+GENDER_CODES = {"ge01": "male", "ge02": "female"}
+
+# Minimum BMI centile (p score) for severe obesity
+SEVERE_OBESITY_PSCORE = 0.996
+
+
+def derive_pupil_features(df):
+    """
+    This function will rename the pupil data columns to the NCMP SQL table
+    names and add the derived pupil level features:
+        SchoolYear - school year as a string (R or 6)
+        Gender - male or female from GenderCode, where it is available
+        SevereObese - True for pupils with a BMI p score at or above the
+            severe obesity threshold
+        ImdDecile - pupil IMD decile, or school IMD decile where the pupil
+            IMD decile is missing
+
+    Parameters:
+        df:
+            pupil level data from the pupil data file or NCMP SQL table
+
+    Returns:
+        Dataframe with renamed columns and derived features
+    """
+    df = df.rename(columns=PUPIL_COLUMN_NAMES)
+
+    df["SchoolYear"] = df["SchoolYear"].astype(str)
+
+    if "GenderCode" in df.columns:
+        df["Gender"] = df["GenderCode"].map(GENDER_CODES)
+
+    df["SevereObese"] = df["BmiPScore"] >= SEVERE_OBESITY_PSCORE
+
+    # Replace missing pupil IMD with school IMD
+    df["ImdDecile"] = df["PupilIndexOfMultipleDeprivationD"].fillna(df["SchoolIndexOfMultiDeprivationD"])
+
+    return df
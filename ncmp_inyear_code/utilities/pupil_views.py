@@ -0,0 +1,40 @@
+"""
+Purpose of script: creates lightweight views of the shared pupil data so
+each table process can add its own derived columns without copying the
+imported data.
+"""
+import pandas as pd
+
+
+def create_pupil_view(df, columns, derived=None):
+    """
+    Creates a view of the shared pupil data for a table process. The selected
+    columns reference the data already held in df rather than copying it,
+    so a full run holds close to one copy of each imported dataset.
+
+    The imported data is treated as read only: derived columns (including
+    retyped versions of existing columns) should be supplied through
+    derived rather than by overwriting columns of the view in place.
+
+    Parameters:
+        df:
+            imported pupil data shared across table processes
+        columns:
+            list of columns to include, or a dictionary of
+            {column: new column name} to include and rename
+        derived:
+            dictionary of {column name: Series or single value} for the
+            derived columns to add to the view
+
+    Returns:
+        Dataframe with the selected and derived columns
+    """
+    if not isinstance(columns, dict):
+        columns = {col: col for col in columns}
+
+    view = {newcol: df[col] for col, newcol in columns.items()}
+
+    if derived is not None:
+        view.update(derived)
+
+    return pd.DataFrame(view, index=df.index, copy=False)
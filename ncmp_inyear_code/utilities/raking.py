@@ -0,0 +1,98 @@
+"""
+Purpose of script: creates weights by raking (iterative proportional
+fitting), as an alternative to cell weighting for the weighting table.
+
+Raking matches the base years distribution of each weighting variable
+separately (its margins), rather than the full cross-classification of
+all the variables, so sparse cells do not produce zero or extreme weights.
+"""
+import numpy as np
+import pandas as pd
+
+
+def rake_weights(df_thisyear_weight, df_baseyears_weight, dims, tolerance,
+                 max_iterations, groupcol="SchoolYear"):
+    """
+    Creates a raked weight for each subgroup (cell) measured this year, so
+    the weighted distribution of each of the dims matches its distribution
+    in the base years, within each school year.
+
+    Levels of a dim not measured this year cannot be matched, so the base
+    years margins are restricted to the levels measured this year. Levels
+    measured this year but not in the base years get a weight of 0, as in
+    cell weighting.
+
+    The solver works on integer codes for every cell and updates the weights
+    of all school years at once for each dim, using bincount for the margins.
+
+    Parameters:
+        df_thisyear_weight:
+            this year measured value (measured_ThisYear) by groupcol and dims
+        df_baseyears_weight:
+            base years average measured value (measured_BaseYear) by groupcol
+            and dims
+        dims:
+            list of weighting variables to match the margins of
+        tolerance:
+            maximum relative difference between the weighted and target
+            margins for the weights to be treated as converged
+        max_iterations:
+            maximum number of iterations (one iteration adjusts every dim)
+        groupcol:
+            variable the margins are matched within
+
+    Returns:
+        Series of weights aligned with df_thisyear_weight, and a dataframe of
+        convergence diagnostics (maximum margin error after each iteration)
+    """
+    measured = df_thisyear_weight["measured_ThisYear"].to_numpy(dtype=float)
+    weights = np.ones(len(measured))
+
+    codes = []
+    targets = []
+
+    for dim in dims:
+        # Code each cell by school year and level of the dim
+        keys = [groupcol, dim]
+        cell_levels = pd.MultiIndex.from_frame(df_thisyear_weight[keys])
+        levels = cell_levels.unique()
+        dim_codes = levels.get_indexer(cell_levels)
+
+        # Base years margin for the levels measured this year, scaled to the
+        # school year total measured this year
+        base_margin = (df_baseyears_weight.groupby(keys).measured_BaseYear.sum()
+                       .reindex(levels, fill_value=0))
+        base_share = base_margin / base_margin.groupby(level=0).transform("sum")
+
+        thisyear_total = (df_thisyear_weight.groupby(groupcol).measured_ThisYear.sum()
+                          .reindex(levels.get_level_values(0)).to_numpy())
+
+        codes.append(dim_codes)
+        targets.append(np.nan_to_num(base_share.to_numpy() * thisyear_total))
+
+    diagnostics = []
+
+    for iteration in range(1, max_iterations + 1):
+
+        for dim_codes, target in zip(codes, targets):
+            current = np.bincount(dim_codes, weights=measured * weights,
+                                  minlength=len(target))
+            factor = np.divide(target, current, out=np.zeros(len(target)),
+                               where=current > 0)
+            weights = weights * factor[dim_codes]
+
+        # Largest relative difference from any target margin after the iteration
+        max_error = max(np.max(np.abs(np.bincount(dim_codes, weights=measured * weights,
+                                                  minlength=len(target)) - target) /
+                               np.maximum(target, 1))
+                        for dim_codes, target in zip(codes, targets))
+
+        diagnostics.append({"Iteration": iteration, "MaxMarginError": max_error})
+
+        if max_error <= tolerance:
+            break
+
+    df_diagnostics = pd.DataFrame(diagnostics)
+    df_diagnostics["Converged"] = df_diagnostics["MaxMarginError"] <= tolerance
+
+    return pd.Series(weights, index=df_thisyear_weight.index), df_diagnostics
@@ -0,0 +1,150 @@
+"""
+Purpose of script: keeps local snapshots of the corporate reference data
+tables, so a full table is only transferred from SQL when the source has
+changed.
+
+Each snapshot is stored pruned to the columns used, deduplicated and typed
+(as a pickle), with a version made up of the row count, the maximum key
+and a checksum of the source table. The version is checked with a single
+cheap aggregate query on each run.
+"""
+import json
+from datetime import datetime
+
+import pandas as pd
+
+import ncmp_inyear_code.parameters_inyear as param
+import ncmp_inyear_code.utilities.data_connections as dbc
+
+
+def get_snapshot_paths(name):
+    """
+    Returns the paths of the data and version files for the reference data
+    snapshot specified
+    """
+    return (param.REF_CACHE_DIR / f"{name}.pkl",
+            param.REF_CACHE_DIR / f"{name}.json")
+
+
+def get_source_version(query, key, server, database):
+    """
+    This function will get the current version of a reference data table:
+    its row count, maximum key value and checksum, using one aggregate
+    query over the reference data query
+
+    Parameters:
+        query:
+            string containing the sql query for the reference data
+        key:
+            key column of the reference data
+        server:
+            server name
+        database:
+            database name
+
+    Returns:
+        Dictionary with the row count, maximum key and checksum
+    """
+    version_query = (f"SELECT COUNT(*) AS RowCount, "
+                     f"MAX([{key}]) AS MaxKey, "
+                     f"CHECKSUM_AGG(BINARY_CHECKSUM(*)) AS RowChecksum "
+                     f"FROM ({query}) AS RefData")
+
+    df_version = dbc.df_from_sql(version_query, server, database)
+
+    return {col: str(df_version[col].iloc[0]) for col in df_version.columns}
+
+
+def read_snapshot(name, version):
+    """
+    Reads the reference data snapshot specified if it exists and matches
+    the version of the source, otherwise returns None
+    """
+    data_path, version_path = get_snapshot_paths(name)
+
+    if not (data_path.exists() and version_path.exists()):
+        return None
+
+    with open(version_path, "r") as version_file:
+        snapshot_info = json.load(version_file)
+
+    if snapshot_info["version"] != version:
+        return None
+
+    return pd.read_pickle(data_path)
+
+
+def write_snapshot(name, df, version):
+    """
+    Writes the reference data snapshot specified, with its source version
+    """
+    data_path, version_path = get_snapshot_paths(name)
+    param.REF_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+    df.to_pickle(data_path)
+
+    with open(version_path, "w") as version_file:
+        json.dump({"version": version,
+                   "columns": list(df.columns),
+                   "rows": len(df),
+                   "cached": datetime.now().strftime("%Y-%m-%d, %H:%M:%S")},
+                  version_file, indent=4)
+
+
+def snapshot_exists(name):
+    """
+    Returns True if a snapshot of the reference data specified is stored
+    locally (whether or not it is still current)
+    """
+    data_path, version_path = get_snapshot_paths(name)
+
+    return data_path.exists() and version_path.exists()
+
+
+def get_reference_data(name, query, key, server, database, columns,
+                       dedup=False):
+    """
+    This function will return the reference data for the query specified,
+    from the local snapshot if the source table is unchanged, otherwise
+    from SQL (updating the snapshot)
+
+    Parameters:
+        name:
+            name of the reference data, used to name the snapshot files
+        query:
+            string containing the sql query for the reference data
+        key:
+            key column of the reference data
+        server:
+            server name
+        database:
+            database name
+        columns:
+            list of the columns to keep in the reference data
+        dedup:
+            if True, remove duplicate keys keeping only the last entry
+
+    Returns:
+        Dataframe with the reference data
+    """
+    if not param.REF_CACHE:
+        version = None
+    else:
+        version = get_source_version(query, key, server, database)
+        df_ref = read_snapshot(name, version)
+
+        if df_ref is not None:
+            print(f"reference_cache - {name} unchanged, using local snapshot")
+            return df_ref
+
+    # Get SQL data
+    df_ref = dbc.df_from_sql(query, server, database)[columns]
+
+    if dedup:
+        df_ref = df_ref.drop_duplicates(subset=[key], keep="last")
+
+    if version is not None:
+        print(f"reference_cache - {name} changed, updating local snapshot")
+        write_snapshot(name, df_ref, version)
+
+    return df_ref
@@ -0,0 +1,496 @@
+"""
+Purpose of script: checks that changes to the table processes leave the
+published numbers unchanged and do not slow them down.
+
+Every table is created from fixed synthetic inputs and each output, with
+the significance tests added before export, is compared with the golden
+outputs committed with the code, within numeric tolerances. The wall time
+and peak memory of each table are compared with the performance baseline
+stored locally (as they depend on the machine), and the check fails if
+either is worse by more than REGRESSION_PERF_THRESHOLD percent.
+
+Golden outputs are stored as plain Python values and type names, so they can
+be read with other pandas versions.
+"""
+import contextlib
+import json
+import pathlib
+import pickle
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import ncmp_inyear_code.parameters_inyear as param
+import ncmp_inyear_code.utilities.import_inyeardata as import_inyeardata
+from ncmp_inyear_code.utilities.pupil_features import derive_pupil_features
+from ncmp_inyear_code.utilities.significance import add_significance_tests
+
+# Parameters used to create the tables from the synthetic inputs, fixed so the
+# outputs do not depend on the parameters set for the publication (every
+# parameter affecting the outputs of build_table is pinned)
+REGRESSION_PARAMS = {"PUPILS_FILE": "IC_Enhanced_Pupils_2021_22_31032022.csv",
+                     "LA_IY_FILE": "DataQualityAndProgressInformation_31032022.csv",
+                     "IY_THISYEAR": "2021/22",
+                     "IY_COMPYEAR": "= '2018/19'",
+                     "IY_BASEYEARS": "in ('2016/17', '2017/18','2018/19')",
+                     "LA_IY_COMPEXCLUDE": ["809"],
+                     "URN_UPDATE_WEIGHTING_LA": {100101: "E06000000"},
+                     "BMI_DERIVED_CATEGORIES": {"severely obese": "SevereObese",
+                                                "overweight or obese": "BmiPopulationCategory in ['overweight', 'obese']"},
+                     "WEIGHTING_METHOD": "cell",
+                     "RAKING_TOLERANCE": 1e-8,
+                     "RAKING_MAX_ITERATIONS": 100,
+                     "WEIGHT_TRIM": 4,
+                     "WEIGHT_SENSITIVITY": True,
+                     "WEIGHT_SENSITIVITY_TRIMS": [2, 3, 4, 5, 6, 8, 10],
+                     "WEIGHT_SENSITIVITY_CAPS": [2, 3, 4, 5, 6],
+                     "SCHOOL_PREVALENCE": True,
+                     "IY_CSV_ENGINE": "pandas",
+                     "IY_OUT_OF_CORE": False,
+                     "IY_DUPLICATE_CHECK": False,
+                     "IY_DEDUPLICATE": False,
+                     "SIGNIFICANCE_TESTS": True,
+                     "SIGNIFICANCE_LEVEL": 0.05,
+                     "SIGNIFICANCE_ADJUSTMENT": "bh"}
+
+# Size and random seed of the synthetic inputs the golden outputs were created from
+SYNTHETIC_PUPILS = 50000
+SYNTHETIC_SEED = 2022
+
+# Synthetic reference values
+BMI_CATEGORIES = ["underweight", "healthy weight", "overweight", "obese"]
+ETHNICITIES = [(1, "A", "White - British", "White"),
+               (2, "H", "Asian or Asian British - Indian", "Asian"),
+               (3, "N", "Black or Black British - African", "Black"),
+               (4, "F", "Mixed - Any other mixed background", "Mixed"),
+               (5, "S", "Other Ethnic Groups - Any other ethnic group", "Other"),
+               (99, "Z", "Not stated", "Unknown")]
+LA_CODES = [str(code) for code in range(800, 830)]
+LSOAS = [f"E0100{i:04d}" for i in range(300)]
+LADS = [f"E0600{i:04d}" for i in range(20)] + [f"E0700{i:04d}" for i in range(10)]
+
+LA_DQ_COLUMNS = ["PercentageBlankNhsNumber", "PercentageBlankPostcode",
+                 "PercentageDateOfMeasurementAugust",
+                 "PercentageDateOfMeasurementWeekend", "PercentageEthnicGroupAsian",
+                 "PercentageEthnicGroupBlack", "PercentageEthnicGroupChinese",
+                 "PercentageEthnicGroupMixed", "PercentageEthnicGroupOther",
+                 "PercentageEthnicGroupUnknown", "PercentageEthnicGroupWhite",
+                 "PercentageExtremeBmi", "PercentageExtremeHeight",
+                 "PercentageExtremeWeight", "PercentageHalfNumberHeights",
+                 "PercentageHalfNumberWeights", "PercentagePostcodeSameAsSchool",
+                 "PercentageWholeNumberHeights", "PercentageWholeNumberWeights",
+                 "PercentageYear6", "PercentageYear6Female", "PercentageYear6Male",
+                 "PercentageYearR", "PercentageYearRFemale", "PercentageYearRMale"]
+
+
+def create_synthetic_pupils(rng, size, academicyears=None):
+    """
+    This function will create synthetic pupil level data, in the format of
+    the pupil data file if no academic years are given, otherwise in the
+    format of the NCMP SQL table for the academic years given
+
+    Parameters:
+        rng:
+            numpy random generator
+        size:
+            number of pupils
+        academicyears:
+            list of academic years (optional)
+
+    Returns:
+        Dataframe of synthetic pupil data
+    """
+    ethnicity = rng.integers(0, len(ETHNICITIES), size)
+
+    df = pd.DataFrame({"Bmi": np.where(rng.random(size) < 0.02, np.nan,
+                                       rng.normal(17, 2, size)),
+                       "BmiPopulationCategory": rng.choice(BMI_CATEGORIES, size,
+                                                           p=[0.02, 0.7, 0.14, 0.14]),
+                       "BmiPScore": rng.random(size),
+                       "NcmpEthnicityCode": [ETHNICITIES[i][1] for i in ethnicity],
+                       "NcmpSchoolStatus": np.where(rng.random(size) < 0.03,
+                                                    "Independent", "NCMP"),
+                       "NcmpSystemId": np.arange(size),
+                       "PupilIndexOfMultipleDeprivationDecile": np.where(rng.random(size) < 0.05, np.nan,
+                                                                         rng.integers(1, 11, size)),
+                       "SchoolIndexOfMultipleDeprivationDecile": rng.integers(1, 11, size).astype(float),
+                       "SchoolLowerSuperOutputArea2011": rng.choice(LSOAS, size),
+                       # Some schools are only measured in one of the years
+                       "SchoolUrn": (rng.integers(99900, 100600, size) if academicyears
+                                     else rng.integers(100000, 100700, size)),
+                       "SchoolYear": rng.choice(["R", "6"], size),
+                       "SubmitterLocalAuthorityCode": rng.choice(LA_CODES, size)})
+
+    # Schools without an LSOA are assigned an LA in URN_UPDATE_WEIGHTING_LA
+    df.loc[df["SchoolUrn"] == 100101, "SchoolLowerSuperOutputArea2011"] = np.nan
+
+    if academicyears is None:
+        df["GenderCode"] = rng.choice(["ge01", "ge02", "ge09"], size, p=[0.49, 0.49, 0.02])
+        df["NhsEthnicityDescription"] = [ETHNICITIES[i][2] for i in ethnicity]
+        df["SubmitterLocalAuthorityName"] = "LA " + df["SubmitterLocalAuthorityCode"]
+
+        return df
+
+    # Filter and rename as in the SQL queries
+    df = df.loc[df["Bmi"].notnull() & (df["NcmpSchoolStatus"] == "NCMP")]
+
+    df = df.rename(columns={"SubmitterLocalAuthorityCode": "OrgCode",
+                            "PupilIndexOfMultipleDeprivationDecile": "PupilIndexOfMultipleDeprivationD",
+                            "SchoolIndexOfMultipleDeprivationDecile": "SchoolIndexOfMultiDeprivationD"})
+
+    df["NhsEthnicityCode"] = [ETHNICITIES[i][0] for i in ethnicity[df.index]]
+    df["AcademicYear"] = rng.choice(academicyears, len(df))
+
+    # Add the derived features as in the SQL imports
+    return derive_pupil_features(df.reset_index(drop=True))
+
+
+def create_synthetic_inputs(size=None, seed=None):
+    """
+    This function will create synthetic versions of every import used by the
+    tables. The pupil and LA data quality files are written to a temporary
+    folder and read with the import functions; the SQL and reference data
+    are created in the format returned by their imports
+
+    Parameters:
+        size:
+            number of pupils this year (defaults to SYNTHETIC_PUPILS)
+        seed:
+            random seed (defaults to SYNTHETIC_SEED)
+
+    Returns:
+        Dictionary of {import name: dataframe}
+    """
+    size = SYNTHETIC_PUPILS if size is None else size
+    rng = np.random.default_rng(SYNTHETIC_SEED if seed is None else seed)
+
+    data = {}
+
+    la_codes = LA_CODES + ["714", "906"]
+
+    df_la_dq = pd.DataFrame({"LocalAuthorityCode": la_codes})
+
+    for col in LA_DQ_COLUMNS:
+        df_la_dq[col] = rng.uniform(0, 100, len(la_codes)).round(1)
+
+    df_la_dq["TotalEligibleMeasuredYear6"] = rng.integers(0, 3000, len(la_codes))
+    df_la_dq["TotalEligibleMeasuredYearR"] = rng.integers(0, 3000, len(la_codes))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        pupils_path = pathlib.Path(temp_dir) / REGRESSION_PARAMS["PUPILS_FILE"]
+        la_path = pathlib.Path(temp_dir) / REGRESSION_PARAMS["LA_IY_FILE"]
+
+        create_synthetic_pupils(rng, size).to_csv(pupils_path, index=False)
+        df_la_dq.to_csv(la_path, index=False)
+
+        data["df_pupils_import"] = import_inyeardata.import_pupils_data(pupils_path)
+        data["df_la_import"] = import_inyeardata.import_LA_DQ_data(la_path)
+
+    data["df_pupils_compyear"] = create_synthetic_pupils(rng, size, ["2018/19"])
+    data["df_pupils_baseyears"] = create_synthetic_pupils(rng, size * 3, ["2016/17", "2017/18", "2018/19"])
+
+    data["df_la_compyear"] = pd.DataFrame({"AcademicYear": "2018/19",
+                                           "SchoolYear": rng.choice(["R", "6"], size),
+                                           "OrgCode": rng.choice([int(code) for code in LA_CODES[:-2]], size),
+                                           "NcmpSystemId": np.arange(size)})
+
+    data["df_la_lookups"] = pd.DataFrame({"LACode": [int(code) for code in la_codes],
+                                          "PHERegionalOffice": [f"Region {i % 9}" for i
+                                                                in range(len(la_codes))]})
+
+    data["df_ethnicity_ref"] = pd.DataFrame({"Value": [eth[0] for eth in ETHNICITIES],
+                                             "NhsEthnicityDescription": [eth[2] for eth in ETHNICITIES]})
+
+    data["df_ethnicity_ref_ohid"] = pd.DataFrame({"NhsEthnicityDescription": [eth[2] for eth in ETHNICITIES],
+                                                  "Ethnic Group": [eth[3] for eth in ETHNICITIES]})
+
+    data["df_imd_ref_ohid"] = pd.DataFrame({"IMD Decile": np.arange(1, 11),
+                                            "IMD Quintile": np.repeat(np.arange(1, 6), 2)})
+
+    data["df_lsoa_ref"] = pd.DataFrame({"LSOACD": LSOAS,
+                                        "LADCD": [LADS[i % len(LADS)] for i in range(len(LSOAS))]})
+
+    data["df_la_e07_ref"] = pd.DataFrame({"PARENT_GEOGRAPHY_CODE": [f"E1000{i % 3:04d}" for i in range(10)],
+                                          "GEOGRAPHY_CODE": LADS[20:],
+                                          "ENTITY_CODE": "E07"})
+
+    return data
+
+
+def compare_output(df, df_golden, rtol, atol):
+    """
+    This function will compare a table output with its golden output.
+    Columns must match by name (in the same order if
+    REGRESSION_STRICT_ORDER is set, otherwise in any order), and rows must
+    match in order if REGRESSION_STRICT_ORDER is set, otherwise after
+    sorting by the non-numeric columns. Numeric values must match within
+    the tolerances given, other values exactly
+
+    Parameters:
+        df:
+            the table output
+        df_golden:
+            the golden output
+        rtol:
+            relative tolerance for numeric values
+        atol:
+            absolute tolerance for numeric values
+
+    Returns:
+        List of the differences found (empty if the outputs match)
+    """
+    differences = []
+
+    missing = [col for col in df_golden.columns if col not in df.columns]
+    extra = [col for col in df.columns if col not in df_golden.columns]
+
+    if missing or extra:
+        return [f"columns missing {missing}, extra {extra}"]
+
+    if param.REGRESSION_STRICT_ORDER and list(df.columns) != list(df_golden.columns):
+        differences.append("column order changed")
+
+    if len(df) != len(df_golden):
+        return differences + [f"{len(df)} rows, expected {len(df_golden)}"]
+
+    df = df[df_golden.columns]
+
+    if not param.REGRESSION_STRICT_ORDER:
+        keys = [col for col in df_golden.columns
+                if not pd.api.types.is_numeric_dtype(df_golden[col])]
+
+        if keys:
+            df = df.astype({key: str for key in keys}).sort_values(keys, kind="mergesort")
+            df_golden = df_golden.astype({key: str for key in keys}).sort_values(keys, kind="mergesort")
+
+    for col in df_golden.columns:
+        values = df[col].to_numpy()
+        golden = df_golden[col].to_numpy()
+
+        if pd.api.types.is_numeric_dtype(df_golden[col]):
+            if not pd.api.types.is_numeric_dtype(df[col]):
+                differences.append(f"{col} is no longer numeric")
+                continue
+
+            matches = np.isclose(values.astype(float), golden.astype(float),
+                                 rtol=rtol, atol=atol, equal_nan=True)
+        else:
+            matches = (values == golden) | (pd.isnull(values) & pd.isnull(golden))
+
+        if not matches.all():
+            differences.append(f"{col} differs in {(~matches).sum()} row(s)")
+
+    return differences
+
+
+@contextlib.contextmanager
+def pinned_params():
+    """
+    Sets the parameters in REGRESSION_PARAMS for the duration of the
+    context, restoring the parameters set for the publication afterwards
+    """
+    saved_params = {name: getattr(param, name) for name in REGRESSION_PARAMS}
+
+    for name, value in REGRESSION_PARAMS.items():
+        setattr(param, name, value)
+
+    try:
+        yield
+    finally:
+        for name, value in saved_params.items():
+            setattr(param, name, value)
+
+
+def add_export_tests(table, outputs):
+    """
+    Adds the significance tests added to the outputs of a table before
+    export, so they are compared with the golden outputs too
+    """
+    if param.SIGNIFICANCE_TESTS:
+        outputs = add_significance_tests({table: outputs}, param.SIGNIFICANCE_LEVEL,
+                                         param.SIGNIFICANCE_ADJUSTMENT)[table]
+
+    return outputs
+
+
+def write_golden(table, outputs):
+    """
+    Stores the outputs of a table as its golden outputs, as plain Python
+    values and type names for each column
+    """
+    param.REGRESSION_GOLDEN_DIR.mkdir(parents=True, exist_ok=True)
+
+    golden = {sheet: {"dtypes": {str(col): str(dtype) for col, dtype in df.dtypes.items()},
+                      "values": {str(col): df[col].tolist() for col in df.columns}}
+              for sheet, df in outputs.items()}
+
+    with open(param.REGRESSION_GOLDEN_DIR / f"{table}.pkl", "wb") as golden_file:
+        pickle.dump(golden, golden_file, protocol=4)
+
+
+def read_golden(table):
+    """
+    Reads the golden outputs of a table, or returns None if none are stored
+    """
+    golden_path = param.REGRESSION_GOLDEN_DIR / f"{table}.pkl"
+
+    if not golden_path.exists():
+        return None
+
+    with open(golden_path, "rb") as golden_file:
+        golden = pickle.load(golden_file)
+
+    # Each column is created with its type, so object columns keep their values as stored
+    return {sheet: pd.DataFrame({col: pd.Series(output["values"][col], dtype=dtype)
+                                 for col, dtype in output["dtypes"].items()},
+                                columns=list(output["dtypes"]))
+            for sheet, output in golden.items()}
+
+
+def compare_golden(table, outputs):
+    """
+    This function will compare the outputs of a table with its golden
+    outputs
+
+    Parameters:
+        table:
+            the table compared
+        outputs:
+            dictionary of {sheet name: output dataframe}
+
+    Returns:
+        List of the differences found (empty if the outputs match)
+    """
+    golden = read_golden(table)
+
+    if golden is None:
+        return [f"no golden outputs stored in {param.REGRESSION_GOLDEN_DIR}"]
+
+    problems = []
+
+    for sheet in sorted(set(golden) | set(outputs)):
+        if sheet not in outputs or sheet not in golden:
+            problems.append(f"{sheet} sheet {'missing' if sheet in golden else 'not in golden outputs'}")
+            continue
+
+        problems += [f"{sheet}: {difference}" for difference
+                     in compare_output(outputs[sheet], golden[sheet],
+                                       param.REGRESSION_RTOL, param.REGRESSION_ATOL)]
+
+    return problems
+
+
+def measure_table(build_table, table, data):
+    """
+    This function will create the table specified, timing the fastest of
+    REGRESSION_REPEATS runs and measuring peak memory in a separate run
+    (as tracing memory slows the run down)
+
+    Returns:
+        Dictionary of {sheet name: output dataframe}, and dictionary with
+        the wall time ("seconds") and peak memory ("peak_mb")
+    """
+    times = []
+
+    for _ in range(param.REGRESSION_REPEATS):
+        start = time.perf_counter()
+        outputs = build_table(table, data)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    build_table(table, data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return outputs, {"seconds": min(times), "peak_mb": peak / 1024 ** 2}
+
+
+def run_regression_check(build_table, tables, update=False):
+    """
+    This function will create the tables specified from the synthetic
+    inputs and compare their outputs with the golden outputs, and their
+    wall time and peak memory with the stored performance baseline
+
+    Parameters:
+        build_table:
+            function creating the outputs of a table from the imported data
+        tables:
+            list of the tables to check
+        update:
+            if True, store the outputs and performance as the new golden
+            outputs and baseline instead of comparing
+
+    Returns:
+        True if every table matches its golden outputs and is within the
+        performance threshold, otherwise False
+    """
+    baseline_path = param.REGRESSION_DIR / "performance_baseline.json"
+
+    with pinned_params():
+        print("regression_check - creating synthetic inputs")
+        data = create_synthetic_inputs()
+
+        results = {}
+
+        for table in tables:
+            print(f"regression_check - creating {table} from synthetic inputs")
+            outputs, performance = measure_table(build_table, table, data)
+
+            results[table] = add_export_tests(table, outputs), performance
+
+    baseline = {}
+    if baseline_path.exists():
+        with open(baseline_path, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+
+    if update:
+        for table, (outputs, performance) in results.items():
+            write_golden(table, outputs)
+            baseline[table] = performance
+
+        param.REGRESSION_DIR.mkdir(parents=True, exist_ok=True)
+
+        with open(baseline_path, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=4, sort_keys=True)
+
+        print(f"regression_check - golden outputs updated in {param.REGRESSION_GOLDEN_DIR} "
+              f"and performance baseline in {param.REGRESSION_DIR}")
+
+        return True
+
+    threshold = param.REGRESSION_PERF_THRESHOLD
+    passed = True
+
+    print(f"regression_check - comparing with golden outputs and baseline "
+          f"(performance threshold {threshold}%)")
+
+    for table, (outputs, performance) in results.items():
+        problems = compare_golden(table, outputs)
+
+        # Compare wall time and peak memory with the baseline
+        for measure, unit in [("seconds", "s"), ("peak_mb", "MB")]:
+            if table not in baseline:
+                continue
+
+            limit = baseline[table][measure] * (1 + threshold / 100)
+
+            # Ignore small increases in wall time, which are timing noise
+            if measure == "seconds":
+                limit = max(limit, baseline[table][measure] + param.REGRESSION_TIME_NOISE)
+
+            if performance[measure] > limit:
+                problems.append(f"{measure} {performance[measure]:.3f}{unit} above "
+                                f"{limit:.3f}{unit} ({baseline[table][measure]:.3f}{unit} baseline)")
+
+        passed = passed and not problems
+
+        print(f"    {'FAIL' if problems else 'ok'}  {table}: {performance['seconds']:.3f}s, "
+              f"peak {performance['peak_mb']:.1f}MB")
+
+        for problem in problems:
+            print(f"        {problem}")
+
+    return passed
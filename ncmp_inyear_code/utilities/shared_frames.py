@@ -0,0 +1,93 @@
+"""
+Purpose of script: shares imported data with the worker processes that
+create the tables, by writing each dataframe once to an uncompressed
+Feather (Arrow IPC) file that every worker memory-maps, rather than
+pickling a copy of the data into each worker.
+
+Workers read only the columns their table uses. Numeric columns without
+missing values are read without copying from the memory-mapped file, so the
+operating system keeps one copy of them in memory for all the workers.
+String columns (e.g. ethnicity, LSOA, OrgCode and BMI category) and columns
+with missing values are still converted to a pandas copy in each worker,
+with repeated strings shared within the worker. They are not shared as
+categoricals, which would change how the tables group them.
+"""
+import pandas as pd
+
+
+def share_frames(data, share_dir):
+    """
+    This function will write each dataframe in the imported data given to a
+    Feather file in the folder specified.
+    Data that is not a dataframe (e.g. a folder of partitions) or that
+    cannot be stored in Arrow format (e.g. columns of mixed types) is
+    returned unchanged, to be passed to the workers as before
+
+    Parameters:
+        data:
+            dictionary of {import name: imported data}
+        share_dir:
+            folder to write the Feather files to
+
+    Returns:
+        Dictionary of {import name: Feather file path or imported data}
+    """
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    shared = {}
+
+    for name, df in data.items():
+        if not isinstance(df, pd.DataFrame):
+            shared[name] = df
+            continue
+
+        share_path = share_dir / f"{name}.feather"
+
+        try:
+            # Feather files need a default index, which the tables do not use
+            feather.write_feather(pa.Table.from_pandas(df, preserve_index=False),
+                                  share_path, compression="uncompressed")
+        except (TypeError, ValueError) as error:
+            print(f"shared_frames - {name} passed to workers by copy: {error}")
+            shared[name] = df
+            continue
+
+        shared[name] = share_path
+
+    return shared
+
+
+def open_shared_frames(shared, columns=None):
+    """
+    This function will open the shared imported data given, memory-mapping
+    each Feather file
+
+    Parameters:
+        shared:
+            dictionary of {import name: Feather file path or imported data}
+        columns:
+            dictionary of {import name: list of the columns used}, for the
+            imports where only some of the columns are needed (optional)
+
+    Returns:
+        Dictionary of {import name: imported data}
+    """
+    import pyarrow.feather as feather
+
+    columns = {} if columns is None else columns
+    data = {}
+
+    for name, share_path in shared.items():
+        if isinstance(share_path, pd.DataFrame) or share_path.suffix != ".feather":
+            data[name] = share_path
+            continue
+
+        table = feather.read_table(share_path, columns=columns.get(name),
+                                   memory_map=True)
+
+        # Keep each column in its own block, so numeric columns are not
+        # copied to combine them (string columns are converted to objects)
+        data[name] = table.to_pandas(split_blocks=True, deduplicate_objects=True)
+
+    return data
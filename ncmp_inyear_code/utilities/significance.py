@@ -0,0 +1,165 @@
+"""
+Purpose of script: tests whether the changes between this year and the
+comparison year in the table outputs are statistically significant, using
+two-proportion z-tests on every row of every output with this year and
+comparison year proportions at once.
+
+Weighted outputs are tested using their (Kish) effective sample sizes, which
+adjusts the tests for the design effect of the weights. P-values are
+adjusted for the number of tests made in each output, so the results of a
+published sheet do not depend on which other tables are run.
+
+The normal distribution is calculated with NumPy, without importing scipy.
+"""
+import numpy as np
+
+# Outputs with proportions that are not tested: the weighted estimates of the
+# weight sensitivity analysis (which have no effective sample sizes), and the
+# school cohort comparisons (the same pupils in both years, so the samples
+# are not independent)
+UNTESTED_SHEETS = ["WeightSensitivity", "CohortAnalysis"]
+
+
+def erfc(x):
+    """
+    Complementary error function, using the Chebyshev approximation in
+    Numerical Recipes (erfcc, fractional error below 1.2e-7)
+    """
+    z = np.abs(x)
+    t = 1 / (1 + 0.5 * z)
+
+    ans = t * np.exp(-z * z - 1.26551223 +
+                     t * (1.00002368 + t * (0.37409196 + t * (0.09678418 +
+                     t * (-0.18628806 + t * (0.27886807 + t * (-1.13520398 +
+                     t * (1.48851587 + t * (-0.82215223 + t * 0.17087277)))))))))
+
+    return np.where(x >= 0, ans, 2 - ans)
+
+
+def two_proportion_test(p1, n1, p2, n2):
+    """
+    Two-sided two-proportion z-tests, using the pooled proportion
+
+    Parameters:
+        p1, p2:
+            arrays of the proportions compared (0 to 1)
+        n1, n2:
+            arrays of the (effective) sample sizes of each proportion
+
+    Returns:
+        Tuple of arrays (z score, p-value), with nan where a test cannot
+        be made (e.g. no sample, or both proportions 0 or 1)
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pooled = (p1 * n1 + p2 * n2) / (n1 + n2)
+        se = np.sqrt(pooled * (1 - pooled) * (1 / n1 + 1 / n2))
+        z = np.where(se > 0, (p1 - p2) / se, np.nan)
+
+    return z, erfc(np.abs(z) / np.sqrt(2))
+
+
+def adjust_pvalues(pvalues, method):
+    """
+    Adjusts p-values for multiple comparisons
+
+    Parameters:
+        pvalues:
+            array of p-values (nan where no test was made)
+        method:
+            "bh" (Benjamini-Hochberg false discovery rate), "holm"
+            (Holm-Bonferroni family-wise error rate) or None (no adjustment)
+
+    Returns:
+        Array of adjusted p-values
+    """
+    if method is None:
+        return pvalues
+
+    if method not in ["bh", "holm"]:
+        raise ValueError(f"Unknown p-value adjustment: {method}")
+
+    valid = ~np.isnan(pvalues)
+    ordered = np.argsort(pvalues[valid])
+    sorted_p = pvalues[valid][ordered]
+    m = len(sorted_p)
+
+    if method == "bh":
+        adjusted = sorted_p * m / np.arange(1, m + 1)
+        adjusted = np.minimum.accumulate(adjusted[::-1])[::-1]
+    else:
+        adjusted = np.maximum.accumulate(sorted_p * (m - np.arange(m)))
+
+    result = np.full(len(pvalues), np.nan)
+    result[np.flatnonzero(valid)[ordered]] = np.minimum(adjusted, 1)
+
+    return result
+
+
+def get_sample_size(df, yearref):
+    """
+    Returns the sample size for the year reference given - the effective
+    sample size for weighted outputs, otherwise the total
+    """
+    if f"EffectiveSampleSize{yearref}" in df.columns:
+        return df[f"EffectiveSampleSize{yearref}"].to_numpy(dtype=float)
+
+    return df[f"Total{yearref}"].to_numpy(dtype=float)
+
+
+def add_significance_tests(outputs, level, adjustment):
+    """
+    This function will test the change between this year and the comparison
+    year for every row of the outputs with ProportionThisYear and
+    ProportionCompYear (except UNTESTED_SHEETS), adjusting the p-values for
+    the number of tests made in each output
+
+    Parameters:
+        outputs:
+            dictionary of {table: {sheet name: output dataframe}}
+        level:
+            significance level for the adjusted p-values, e.g. 0.05
+        adjustment:
+            p-value adjustment, "bh", "holm" or None (see adjust_pvalues)
+
+    Returns:
+        Dictionary of {table: {sheet name: output dataframe}}, with the z
+        score, p-value, adjusted p-value and significance flag added to
+        the outputs tested
+    """
+    tested = [(table, sheet) for table, sheets in outputs.items()
+              for sheet, df in sheets.items()
+              if {"ProportionThisYear", "ProportionCompYear"} <= set(df.columns)
+              and sheet not in UNTESTED_SHEETS]
+
+    if not tested:
+        return outputs
+
+    # Test every row of every output at once
+    frames = [outputs[table][sheet] for table, sheet in tested]
+
+    z, pvalues = two_proportion_test(
+        np.concatenate([df["ProportionThisYear"].to_numpy(dtype=float) / 100 for df in frames]),
+        np.concatenate([get_sample_size(df, "ThisYear") for df in frames]),
+        np.concatenate([df["ProportionCompYear"].to_numpy(dtype=float) / 100 for df in frames]),
+        np.concatenate([get_sample_size(df, "CompYear") for df in frames]))
+
+    # Each output is a separate family of tests for the p-value adjustment
+    bounds = np.cumsum([0] + [len(df) for df in frames])
+    adjusted = np.concatenate([adjust_pvalues(pvalues[start:end], adjustment)
+                               for start, end in zip(bounds[:-1], bounds[1:])])
+
+    print(f"significance - {np.count_nonzero(adjusted < level)} of "
+          f"{np.count_nonzero(~np.isnan(adjusted))} changes from the comparison year "
+          f"significant at {level} ({adjustment or 'no'} adjustment within each output)")
+
+    outputs = {table: dict(sheets) for table, sheets in outputs.items()}
+
+    for (table, sheet), df, start, end in zip(tested, frames, bounds[:-1], bounds[1:]):
+        rows = slice(start, end)
+
+        outputs[table][sheet] = df.assign(ZScore=z[rows],
+                                          PValue=pvalues[rows],
+                                          PValueAdjusted=adjusted[rows],
+                                          SignificantChange=adjusted[rows] < level)
+
+    return outputs
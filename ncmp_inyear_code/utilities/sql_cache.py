@@ -0,0 +1,335 @@
+"""
+Purpose of script: keeps the results of SQL queries on local disk, keyed on
+a hash of the rendered query text and the server and database it is run on,
+so a query for closed years (e.g. the comparison year or base years) is only
+run against the server once.
+
+Each result is stored as typed columnar files (Feather if the optional
+pyarrow package is installed, otherwise pickles), one per chunk for chunked
+queries, with the query details, row count and expiry in an entry file.
+Entries expire after their time to live, and the least recently used entries
+are evicted once the cache exceeds SQL_CACHE_MAX_MB.
+"""
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+import ncmp_inyear_code.parameters_inyear as param
+
+DATE_FORMAT = "%Y-%m-%d, %H:%M:%S"
+
+
+def get_query_key(query, server, database):
+    """
+    Returns the cache key of a rendered SQL query run on the server and
+    database given
+    """
+    query_info = {"query": query, "server": server, "database": database}
+
+    return hashlib.sha256(json.dumps(query_info, sort_keys=True).encode()).hexdigest()
+
+
+def get_entry_dir(key):
+    """
+    Returns the folder of the cached result with the key given
+    """
+    return param.SQL_CACHE_DIR / key[:32]
+
+
+def read_entry_info(entry_dir):
+    """
+    Reads the details of a cached result, or returns None if the result is
+    incomplete
+    """
+    info_path = entry_dir / "entry.json"
+
+    # The entry may be removed or still being written by another run
+    try:
+        with open(info_path, "r") as info_file:
+            return json.load(info_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def is_expired(info):
+    """
+    Returns True if the cached result with the details given has expired
+    """
+    return datetime.strptime(info["expires"], DATE_FORMAT) <= datetime.now()
+
+
+def get_cached_info(key):
+    """
+    Returns the details of the cached result with the key given if it exists
+    and has not expired, otherwise returns None
+    """
+    info = read_entry_info(get_entry_dir(key))
+
+    if info is None or info["key"] != key or is_expired(info):
+        return None
+
+    return info
+
+
+def write_part(df, entry_dir, part):
+    """
+    Writes a chunk of a query result to the folder of a cached result
+    """
+    if importlib.util.find_spec("pyarrow"):
+        df.reset_index(drop=True).to_feather(entry_dir / f"part_{part:05d}.feather")
+    else:
+        df.to_pickle(entry_dir / f"part_{part:05d}.pkl")
+
+
+def drop_entry(key, error):
+    """
+    Removes a partly written cached result after an error storing it, so the
+    query result is used uncached
+    """
+    print(f"sql_cache - could not cache query result {key[:12]} "
+          f"({type(error).__name__}: {error}), using the result uncached")
+
+    shutil.rmtree(get_entry_dir(key), ignore_errors=True)
+
+
+def read_parts(key):
+    """
+    This function will read the chunks of the cached result with the key
+    given, if it exists and has not expired.
+    Marks the result as recently used for eviction
+
+    Parameters:
+        key:
+            cache key of the query (see get_query_key)
+
+    Returns:
+        Iterator of dataframes of the chunks of the result, or None if the
+        result is not cached
+    """
+    entry_dir = get_entry_dir(key)
+
+    if get_cached_info(key) is None:
+        return None
+
+    os.utime(entry_dir / "entry.json")
+
+    def iter_parts():
+        for part_path in sorted(entry_dir.glob("part_*")):
+            if part_path.suffix == ".feather":
+                yield pd.read_feather(part_path)
+            else:
+                yield pd.read_pickle(part_path)
+
+    return iter_parts()
+
+
+def write_parts(key, chunks, query, server, database, ttl_days):
+    """
+    This function will store the chunks of a query result in the cache as
+    they are passed on, completing the cached result only once every chunk
+    has been read, then evicts expired and least recently used results.
+    If a chunk cannot be stored (e.g. a column Feather cannot write), the
+    chunks are still passed on and the result is not cached
+
+    Parameters:
+        key:
+            cache key of the query (see get_query_key)
+        chunks:
+            iterator of dataframes of the chunks of the query result
+        query:
+            string containing the rendered sql query
+        server:
+            server name
+        database:
+            database name
+        ttl_days:
+            number of days the cached result is used for
+
+    Returns:
+        Iterator of dataframes of the chunks of the result
+    """
+    entry_dir = get_entry_dir(key)
+    caching = True
+
+    try:
+        if entry_dir.exists():
+            shutil.rmtree(entry_dir)
+
+        entry_dir.mkdir(parents=True)
+    except Exception as error:
+        drop_entry(key, error)
+        caching = False
+
+    rows = 0
+    complete = False
+
+    try:
+        for part, df in enumerate(chunks):
+            if caching:
+                try:
+                    write_part(df, entry_dir, part)
+                except Exception as error:
+                    drop_entry(key, error)
+                    caching = False
+
+            rows += len(df)
+
+            yield df
+
+        complete = True
+    finally:
+        # Results not read in full are not cached
+        if not complete:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+    if not caching:
+        return
+
+    now = datetime.now()
+
+    try:
+        with open(entry_dir / "entry.json", "w") as info_file:
+            json.dump({"key": key,
+                       "query": query,
+                       "server": server,
+                       "database": database,
+                       "rows": rows,
+                       "cached": now.strftime(DATE_FORMAT),
+                       "expires": (now + timedelta(days=ttl_days)).strftime(DATE_FORMAT)},
+                      info_file, indent=4)
+    except Exception as error:
+        drop_entry(key, error)
+        return
+
+    print(f"sql_cache - cached {rows} rows of query result {key[:12]}")
+
+    evict_entries(keep=entry_dir)
+
+
+def get_entries():
+    """
+    Returns the folders of the cached results, least recently used first
+    """
+    if not param.SQL_CACHE_DIR.exists():
+        return []
+
+    entry_dirs = [entry_dir for entry_dir in param.SQL_CACHE_DIR.iterdir()
+                  if (entry_dir / "entry.json").exists()]
+
+    return sorted(entry_dirs, key=lambda entry_dir: (entry_dir / "entry.json").stat().st_mtime)
+
+
+def get_entry_bytes(entry_dir):
+    """
+    Returns the size in bytes of the files of a cached result (0 if it has
+    been removed by another run)
+    """
+    try:
+        return sum(path.stat().st_size for path in entry_dir.iterdir())
+    except FileNotFoundError:
+        return 0
+
+
+def evict_entries(keep=None):
+    """
+    This function will remove expired cached results, then the least
+    recently used results while the cache exceeds SQL_CACHE_MAX_MB
+
+    Parameters:
+        keep:
+            folder of a cached result to keep, even if it exceeds the cache
+            size alone (optional)
+    """
+    entry_dirs = []
+
+    for entry_dir in get_entries():
+        info = read_entry_info(entry_dir)
+
+        # Skip results removed by another run since the folders were listed
+        if info is None:
+            continue
+
+        if entry_dir != keep and is_expired(info):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            print(f"sql_cache - removed expired result {entry_dir.name[:12]}")
+        else:
+            entry_dirs.append(entry_dir)
+
+    cache_bytes = sum(get_entry_bytes(entry_dir) for entry_dir in entry_dirs)
+
+    for entry_dir in entry_dirs:
+        if cache_bytes <= param.SQL_CACHE_MAX_MB * 1024 ** 2:
+            break
+
+        if entry_dir == keep:
+            continue
+
+        cache_bytes -= get_entry_bytes(entry_dir)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+
+        print(f"sql_cache - evicted result {entry_dir.name[:12]}")
+
+
+def describe_entries():
+    """
+    This function will describe each cached query result, least recently
+    used first
+
+    Returns:
+        Dataframe with the key, server, database, start of the query, rows,
+        size, cached, last used and expiry dates of each cached result
+    """
+    entries = []
+
+    for entry_dir in get_entries():
+        info = read_entry_info(entry_dir)
+
+        if info is None:
+            continue
+
+        entries.append({"Key": info["key"][:12],
+                        "Server": info["server"],
+                        "Database": info["database"],
+                        "Query": " ".join(info["query"].split())[:60],
+                        "Rows": info["rows"],
+                        "MB": round(get_entry_bytes(entry_dir) / 1024 ** 2, 1),
+                        "Cached": info["cached"],
+                        "LastUsed": datetime.fromtimestamp((entry_dir / "entry.json").stat().st_mtime)
+                                            .strftime(DATE_FORMAT),
+                        "Expires": info["expires"],
+                        "Expired": is_expired(info)})
+
+    return pd.DataFrame(entries, columns=["Key", "Server", "Database", "Query", "Rows", "MB",
+                                          "Cached", "LastUsed", "Expires", "Expired"])
+
+
+def clear_entries(expired_only=False):
+    """
+    This function will remove the cached query results
+
+    Parameters:
+        expired_only:
+            if True, only expired results are removed
+
+    Returns:
+        Number of cached results removed
+    """
+    removed = 0
+
+    for entry_dir in get_entries():
+        info = read_entry_info(entry_dir)
+
+        if info is None or (expired_only and not is_expired(info)):
+            continue
+
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        removed += 1
+
+    print(f"sql_cache - removed {removed} cached result(s) from {param.SQL_CACHE_DIR}")
+
+    return removed
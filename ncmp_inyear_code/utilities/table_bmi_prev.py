@@ -1,76 +1,84 @@
 import pandas as pd
-import numpy as np
-import scipy.stats
 from datetime import datetime
 
 import ncmp_inyear_code.parameters_inyear as param
+from ncmp_inyear_code.utilities.confidence_intervals import wilson_interval
 from ncmp_inyear_code.utilities.export_inyear import export_excel_data
+from ncmp_inyear_code.utilities.pupil_views import create_pupil_view
 
+# BMI categories of the pupil data, which together make up the total measured
+BMI_CATEGORIES = ["underweight", "healthy weight", "overweight", "obese"]
 
-def create_table_bmi_prev(df_pupils_import, outputpath):
+
+def count_bmi_prev(df_pupils_import):
     """
-    Creates the data for the BMI prevalence tables and outputs it to
-    the Excel source data file
+    Counts the pupils in each BMI category and derived category by school
+    year and gender. Counts for separate sets of pupils (e.g. each LA) can
+    be added together
 
     Parameters:
-        df_pupils_data:
+        df_pupils_import:
             imported pupil data
-        outputpath:
-            filepath to output file for export
 
     Returns:
-        None
+        Dataframe of counts indexed by school year and gender, with one
+        column per category
     """
+    # Create view of pupil data with the columns used
+    df = create_pupil_view(df_pupils_import,
+                           ["BmiPopulationCategory", "BmiPScore", "Gender",
+                            "NcmpSystemId", "SchoolYear", "SevereObese"])
 
-    print("inyear_bmi_prev - processing pupil data")
+    # Flag the pupils in each BMI category and derived category (which can
+    # overlap), so all categories are counted in one grouped aggregation
+    # without copying subsets of the pupil data
+    masks = {category: df["BmiPopulationCategory"] == category
+             for category in BMI_CATEGORIES}
 
-    df = df_pupils_import.copy()
+    for category, condition in param.BMI_DERIVED_CATEGORIES.items():
+        masks[category] = df.eval(condition).astype(bool)
 
-    # Recode gender
-    df.loc[df["GenderCode"] == "ge01", "Gender"] = "male"
-    df.loc[df["GenderCode"] == "ge02", "Gender"] = "female"
+    # Pupils with a missing NcmpSystemId are not counted
+    counted = df["NcmpSystemId"].notnull()
 
-    # Update data types
-    df['SchoolYear'] = df['SchoolYear'].apply(str)
+    df_masks = pd.DataFrame({category: mask & counted
+                             for category, mask in masks.items()},
+                            index=df.index).rename_axis(columns="BmiPopulationCategory")
 
-    # Group by categories and count
-    def groupcount(df, groupcols, countcol):
-        """ Groups by selected columns (groupcols) and counts
-        selected column (countcol)"""
-        df = df[groupcols + [countcol]].groupby(by=groupcols).count()
-        df.rename(columns={countcol: "Count"}, inplace=True)
-        df.reset_index(inplace=True)
+    # Count each category by school year and gender, one column per category
+    return df_masks.groupby([df["SchoolYear"], df["Gender"]]).sum()
 
-        return df
 
-    # Group and count by existing categories in dataset
-    groupcols = ["SchoolYear", "Gender", "BmiPopulationCategory"]
-    countcol = "NcmpSystemId"
-    df_group = groupcount(df, groupcols, countcol)
+def create_table_bmi_prev(df_pupils_import, outputpath=None, counts=None):
+    """
+    Creates the data for the BMI prevalence tables and outputs it to
+    the Excel source data file if an output filepath is given
 
-    # Create severely obese, and obese and overweight counts
-    df_sevob = df[df["BmiPScore"] >= 0.996].copy()
-    df_sevob["BmiPopulationCategory"] = "severely obese"
-    df_sevob_group = groupcount(df_sevob, groupcols, countcol)
+    Parameters:
+        df_pupils_data:
+            imported pupil data
+        outputpath:
+            filepath to output file for export (optional)
+        counts:
+            counts from count_bmi_prev, added together across LAs, used
+            instead of counting the imported pupil data (optional)
 
-    df_ovob = df[df["BmiPopulationCategory"].isin(["overweight", "obese"])].copy()
-    df_ovob["BmiPopulationCategory"] = "overweight or obese"
-    df_ovob_group = groupcount(df_ovob, groupcols, countcol)
+    Returns:
+        Dictionary of {sheet name: output dataframe}
+    """
 
-    # Append counts
-    df_bmi_group = pd.concat([df_group, df_sevob_group, df_ovob_group])
+    print("inyear_bmi_prev - processing pupil data")
+
+    categories = BMI_CATEGORIES + list(param.BMI_DERIVED_CATEGORIES)
+
+    if counts is None:
+        counts = count_bmi_prev(df_pupils_import)
 
     # Calculate prevalences and confidence intervals
     print("inyear_bmi_prev - calculating prevalences and confidence intervals")
 
-    # Pivot so one column per category and calculate total
-    df_bmi_prev = df_bmi_group.pivot(index=["SchoolYear", "Gender"],
-                                     columns="BmiPopulationCategory",
-                                     values="Count")
-
-    df_bmi_prev.reset_index(inplace=True)
-    df_bmi_prev["Total"] = df_bmi_prev[["underweight", "healthy weight",
-                                        "overweight", "obese"]].sum(axis=1)
+    df_bmi_prev = counts.reset_index()
+    df_bmi_prev["Total"] = df_bmi_prev[BMI_CATEGORIES].sum(axis=1)
 
     # Add total row for each school year (reception/year 6)
     df_bmi_prevtot = df_bmi_prev.groupby(by="SchoolYear").sum()
@@ -81,10 +89,7 @@ def create_table_bmi_prev(df_pupils_import, outputpath):
     df_bmi_prev = pd.concat([df_bmi_prev, df_bmi_prevtot])
 
     # Calculate prevalences
-    numerators = ["underweight", "healthy weight", "overweight", "obese",
-                  "severely obese", "overweight or obese"]
-
-    for numerator in numerators:
+    for numerator in categories:
         df_bmi_prev[numerator + "_prev"] = (df_bmi_prev[numerator] /
                                             df_bmi_prev["Total"])*100
 
@@ -111,55 +116,38 @@ def create_table_bmi_prev(df_pupils_import, outputpath):
                 for observedcol
                 """
 
-        df["r"] = df[observedcol]
-        df["n"] = df[samplecol]
-
-        df["p"] = df["r"]/df["n"]  # proportion with feature of interest
-        df["q"] = 1 - df["p"]  # proportion without feature of interest
-        df["z"] = scipy.stats.norm.ppf(0.975)  # 𝑧(1−∝/2) from the standard Normal distribution
-
-        df["A"] = (2*df["r"]) + (df["z"]**2)
-        df["B"] = df["z"] * np.sqrt((df["z"]**2) + (4*df["r"]*df["q"]))
-        df["C"] = 2*(df["n"] + df["z"]**2)
+        lower, upper = wilson_interval(df[observedcol], df[samplecol])
 
         if outputformat == "percent":
-            df[observedcol + "_ci_lower"] = (df["A"]-df["B"])/df["C"]*100
-            df[observedcol + "_ci_upper"] = (df["A"]+df["B"])/df["C"]*100
+            df[observedcol + "_ci_lower"] = lower*100
+            df[observedcol + "_ci_upper"] = upper*100
 
         else:
-            df[observedcol + "_ci_lower"] = (df["A"]-df["B"])/df["C"]
-            df[observedcol + "_ci_upper"] = (df["A"]+df["B"])/df["C"]
-
-        df.drop(columns=["r", "n", "p", "q", "z", "A", "B", "C"], inplace=True)
+            df[observedcol + "_ci_lower"] = lower
+            df[observedcol + "_ci_upper"] = upper
 
         return df
 
-    observedcols = ["underweight", "healthy weight", "overweight", "obese",
-                    "severely obese", "overweight or obese"]
-
-    for observedcol in observedcols:
+    for observedcol in categories:
         calc_conf_intervals(df=df_bmi_prev, observedcol=observedcol,
                             samplecol="Total", outputformat="percent")
 
-    df_bmi_prev = df_bmi_prev[["SchoolYear", "Gender", "underweight",
-                               "underweight_prev", "underweight_ci_lower",
-                               "underweight_ci_upper", "healthy weight",
-                               "healthy weight_prev", "healthy weight_ci_lower",
-                               "healthy weight_ci_upper", "overweight",
-                               "overweight_prev", "overweight_ci_lower",
-                               "overweight_ci_upper", "obese", "obese_prev",
-                               "obese_ci_lower", "obese_ci_upper",
-                               "severely obese", "severely obese_prev",
-                               "severely obese_ci_lower",
-                               "severely obese_ci_upper",
-                               "overweight or obese", "overweight or obese_prev",
-                               "overweight or obese_ci_lower",
-                               "overweight or obese_ci_upper",
-                               "Total"]].sort_values(by=(["SchoolYear", "Gender"]),
-                                                     ascending=False)
+    outputcols = ["SchoolYear", "Gender"]
+
+    for category in categories:
+        outputcols += [category, category + "_prev", category + "_ci_lower",
+                       category + "_ci_upper"]
+
+    df_bmi_prev = df_bmi_prev[outputcols + ["Total"]].sort_values(by=(["SchoolYear", "Gender"]),
+                                                                  ascending=False)
 
     # Add extract date
     df_bmi_prev["PupilExtractDate"] = datetime.strptime(param.PUPILS_FILE[27:35],
                                                         "%d%m%Y").date()
 
-    export_excel_data(df_bmi_prev, "BMI_Prev", outputpath)
+    outputs = {"BMI_Prev": df_bmi_prev}
+
+    if outputpath is not None:
+        export_excel_data(df_bmi_prev, "BMI_Prev", outputpath)
+
+    return outputs
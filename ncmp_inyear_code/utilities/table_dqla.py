@@ -7,10 +7,11 @@ from ncmp_inyear_code.utilities.export_inyear import export_excel_data
 
 
 def create_table_dqla(df_la_import, df_la_compyear, df_la_lookups,
-                      laexclude, outputpath):
+                      laexclude, outputpath=None):
     """
     Creates the output needed to feed the LA data quality tables for the
-    in year publication and outputs it to the Excel source data file
+    in year publication and outputs it to the Excel source data file if an
+    output filepath is given
 
     Parameters:
         df_la_import:
@@ -22,10 +23,10 @@ def create_table_dqla(df_la_import, df_la_compyear, df_la_lookups,
         laexclude:
             list of LAs to exclude when calculating LA level indicators
         outputpath:
-            filepath to output file for export
+            filepath to output file for export (optional)
 
     Returns:
-        None
+        Dictionary of {sheet name: output dataframe}
     """
     print("table_dqla - combining and transforming data")
 
@@ -290,4 +291,10 @@ def create_table_dqla(df_la_import, df_la_compyear, df_la_lookups,
     df_dqla["LADQExtractDate"] = datetime.strptime(param.LA_IY_FILE[34:42],
                                                    "%d%m%Y").date()
 
-    export_excel_data(df_dqla, "LA_InYear", outputpath)
+    outputs = {"LA_InYear": df_dqla}
+
+    if outputpath is not None:
+        for sheet, df_output in outputs.items():
+            export_excel_data(df_output, sheet, outputpath)
+
+    return outputs
@@ -3,15 +3,14 @@ from datetime import datetime
 
 import ncmp_inyear_code.parameters_inyear as param
 from ncmp_inyear_code.utilities.export_inyear import export_excel_data
+from ncmp_inyear_code.utilities.pupil_views import create_pupil_view
 
 
-def create_table_ethnicity_imd(df_pupils_import, df_pupils_compyear,
-                               df_ethnicity_ref,
-                               academicyear,
-                               outputpath):
+def count_ethnicity_imd(df_pupils_import, df_pupils_compyear, df_ethnicity_ref):
     """
-    Creates the data for the ethnicity and IMD in year tables and outputs it to
-    the Excel source data file
+    Counts the pupils this year and in the comparison year by school year,
+    ethnicity and IMD decile. Counts for separate sets of pupils (e.g. each
+    LA) can be added together
 
     Parameters:
         df_pupils_import:
@@ -20,47 +19,33 @@ def create_table_ethnicity_imd(df_pupils_import, df_pupils_compyear,
             imported data for comparison year
         df_ethnicity_ref:
             imported ethnicity reference data
-        academicyear:
-            current academic year
-        outputpath:
-            output filepath for export
 
     Returns:
-        None
+        Dataframe of counts (NcmpSystemId) indexed by school year, year
+        reference, ethnicity code and description and IMD decile
     """
+    # Columns used in the outputs
+    keycols = ["NcmpSystemId", "NcmpEthnicityCode", "NhsEthnicityDescription",
+               "PupilIndexOfMultipleDeprivationD", "SchoolYear"]
 
-    print("table_ethnicity_imd - processing pupil data")
-
-    df_thisyear = df_pupils_import.copy()
-
-    # Add year ref columns
-    df_thisyear["AcademicYear"] = academicyear  # specify current academic year
-    df_thisyear["YearRef"] = "ThisYear"  # reference for current academic year
-
-    # Rename column names to match SQL
-    old_text = ["SubmitterLocalAuthorityCode", "SubmitterLocalAuthorityName",
-                "PupilIndexOfMultipleDeprivationDecile"]
-    new_text = ["OrgCode", "OrgName", "PupilIndexOfMultipleDeprivationD"]
-
-    for old_text, new_text in zip(old_text, new_text):
-        df_thisyear.columns = df_thisyear.columns.str.replace(old_text, new_text)
-
-    # Convert data types
-    df_thisyear['OrgCode'] = df_thisyear['OrgCode'].apply(str)
-    df_thisyear['SchoolYear'] = df_thisyear['SchoolYear'].apply(str)
-
-    df_compyear = df_pupils_compyear.copy()
+    # Create view of pupil data with year ref column
+    df_thisyear = create_pupil_view(df_pupils_import, keycols,
+                                    derived={"YearRef": "ThisYear"})  # reference for current academic year
 
     # Combine and transform data
     print("table_ethnicity_imd - combining and transforming data")
 
-    df_compyear["YearRef"] = "CompYear"  # reference for comparison academic year
-
     # Append ethnicity data to comp data
-    df_compyear = pd.merge(df_compyear, df_ethnicity_ref, how="left",
+    df_compyear = pd.merge(df_pupils_compyear[["SchoolYear",
+                                               "NcmpSystemId", "NcmpEthnicityCode",
+                                               "NhsEthnicityCode",
+                                               "PupilIndexOfMultipleDeprivationD"]],
+                           df_ethnicity_ref, how="left",
                            left_on=["NhsEthnicityCode"],
                            right_on=["Value"])
 
+    df_compyear["YearRef"] = "CompYear"  # reference for comparison academic year
+
     # Append the cleaned datasets
     df = df_thisyear.append([df_compyear])
 
@@ -69,19 +54,57 @@ def create_table_ethnicity_imd(df_pupils_import, df_pupils_compyear,
     df["NhsEthnicityDescription"].fillna("Not stated", inplace=True)
     df["PupilIndexOfMultipleDeprivationD"].fillna("Not stated", inplace=True)
 
+    # Count pupils in every combination of the breakdowns used in the outputs
+    return df.groupby(["SchoolYear", "YearRef", "NcmpEthnicityCode",
+                       "NhsEthnicityDescription", "PupilIndexOfMultipleDeprivationD"],
+                      dropna=False)[["NcmpSystemId"]].count()
+
+
+def create_table_ethnicity_imd(df_pupils_import, df_pupils_compyear,
+                               df_ethnicity_ref,
+                               academicyear,
+                               outputpath=None,
+                               counts=None):
+    """
+    Creates the data for the ethnicity and IMD in year tables and outputs it to
+    the Excel source data file if an output filepath is given
+
+    Parameters:
+        df_pupils_import:
+            imported pupil data
+        df_pupils_compyear:
+            imported data for comparison year
+        df_ethnicity_ref:
+            imported ethnicity reference data
+        academicyear:
+            current academic year
+        outputpath:
+            output filepath for export (optional)
+        counts:
+            counts from count_ethnicity_imd, added together across LAs, used
+            instead of counting the imported pupil data (optional)
+
+    Returns:
+        Dictionary of {sheet name: output dataframe}
+    """
+
+    print("table_ethnicity_imd - processing pupil data")
+
+    if counts is None:
+        counts = count_ethnicity_imd(df_pupils_import, df_pupils_compyear,
+                                     df_ethnicity_ref)
+
     # Create table outputs
-    def pupil_keygroups(df, breakdowns, countcol):
-        measured = df[["SchoolYear",
-                       "NcmpSystemId",
-                       "YearRef"]].groupby(["SchoolYear",
-                                            "YearRef"]).count().reset_index()
+    def pupil_keygroups(counts, breakdowns, countcol):
+        measured = counts.groupby(["SchoolYear",
+                                   "YearRef"])[countcol].sum().reset_index()
 
         measured = measured.rename(columns={"NcmpSystemId": "Total"})
-        measured["SchoolYear"] = measured["SchoolYear"].apply(str)
+        measured["SchoolYear"] = measured["SchoolYear"].astype(str)
 
-        subgroup = df[breakdowns + countcol].groupby([*breakdowns]).count().reset_index()
+        subgroup = counts.groupby([*breakdowns])[countcol].sum().reset_index()
         subgroup = subgroup.rename(columns={"NcmpSystemId": "Value"})
-        subgroup["SchoolYear"] = subgroup["SchoolYear"].apply(str)
+        subgroup["SchoolYear"] = subgroup["SchoolYear"].astype(str)
 
         subgroup = pd.merge(subgroup, measured,  how="left",
                             left_on=["YearRef",  "SchoolYear"],
@@ -113,34 +136,34 @@ def create_table_ethnicity_imd(df_pupils_import, df_pupils_compyear,
     breakdowns = ["SchoolYear",  "PupilIndexOfMultipleDeprivationD", "YearRef"]
     countcol = ["NcmpSystemId"]
 
-    df_imd = pupil_keygroups(df, breakdowns, countcol)
+    df_imd = pupil_keygroups(counts, breakdowns, countcol)
 
     # Create ethnicity description data
     breakdowns = ["SchoolYear", "NhsEthnicityDescription",  "YearRef"]
     countcol = ["NcmpSystemId"]
 
-    df_ethnicitydesc = pupil_keygroups(df, breakdowns, countcol)
+    df_ethnicitydesc = pupil_keygroups(counts, breakdowns, countcol)
 
     # Create ethnicity code data
     breakdowns = ["SchoolYear", "NcmpEthnicityCode", "YearRef"]
     countcol = ["NcmpSystemId"]
 
-    df_ethnicitycode = pupil_keygroups(df, breakdowns, countcol)
+    df_ethnicitycode = pupil_keygroups(counts, breakdowns, countcol)
 
     # Add pupil extract date to outputs
     for df in [df_imd, df_ethnicitydesc, df_ethnicitycode]:
         df["PupilExtractDate"] = datetime.strptime(param.PUPILS_FILE[27:35],
                                                    "%d%m%Y").date()
 
-    # Export to Excel
-    export_excel_data(df=df_imd,
-                      sheet="IMD",
-                      file_path=outputpath)
+    outputs = {"IMD": df_imd,
+               "EthnicityDes": df_ethnicitydesc,
+               "EthnicityCode": df_ethnicitycode}
 
-    export_excel_data(df=df_ethnicitydesc,
-                      sheet="EthnicityDes",
-                      file_path=outputpath)
+    # Export to Excel
+    if outputpath is not None:
+        for sheet, df_output in outputs.items():
+            export_excel_data(df=df_output,
+                              sheet=sheet,
+                              file_path=outputpath)
 
-    export_excel_data(df=df_ethnicitycode,
-                      sheet="EthnicityCode",
-                      file_path=outputpath)
+    return outputs
@@ -1,93 +1,152 @@
+import numpy as np
 import pandas as pd
 from datetime import datetime
 
 import ncmp_inyear_code.parameters_inyear as param
+from ncmp_inyear_code.utilities.confidence_intervals import wilson_interval
 from ncmp_inyear_code.utilities.export_inyear import export_excel_data
+from ncmp_inyear_code.utilities.pupil_views import create_pupil_view
 
 
-def create_table_school_cohort(df_pupils_import, df_pupils_compyear,
-                               academicyear, outputpath):
+def count_school_cohort(df_pupils_import, df_pupils_compyear):
     """
-    Creates the data for the school cohort table and outputs it to the Excel
-    source data file
+    Counts the pupils this year and in the comparison year by school, school
+    year and BMI category. Counts for separate sets of pupils (e.g. each LA)
+    can be added together
 
     Parameters:
         df_pupils_import:
             imported pupil data
         df_pupils_compyear:
             imported data for comparison year
-        academicyear:
-            current academic year
-        outputpath:
-            output filepath for export
 
     Returns:
-        None
+        Dataframe of counts (NcmpSystemId) indexed by year reference,
+        school URN, school year and BMI category
     """
+    # Create views of pupil data with converted data types
+    def cohort_view(df, yearref):
+        return create_pupil_view(df, ["BmiPopulationCategory", "NcmpSystemId"],
+                                 derived={"SchoolUrn": df["SchoolUrn"].astype(str),
+                                          "SchoolYear": df["SchoolYear"].astype(str),
+                                          "YearRef": yearref})
 
-    print("table_schoolcohort - processing pupil data")
+    df = cohort_view(df_pupils_import, "ThisYear").append([cohort_view(df_pupils_compyear,
+                                                                       "CompYear")])
 
-    df_thisyear = df_pupils_import.copy()
+    # Count pupils in every combination of the breakdowns used in the outputs,
+    # including pupils without a BMI category in the count measured by school
+    return df.groupby(["YearRef", "SchoolUrn", "SchoolYear", "BmiPopulationCategory"],
+                      dropna=False)[["NcmpSystemId"]].count()
 
-    # This year - convert data types
-    df_thisyear['SchoolUrn'] = df_thisyear['SchoolUrn'].apply(str)
-    df_thisyear['SchoolYear'] = df_thisyear['SchoolYear'].apply(str)
 
-    # This year - add calculated columns
-    df_thisyear["AcademicYear"] = param.IY_THISYEAR  # specify current academic year
-    df_thisyear["YearRef"] = "ThisYear"  # reference for current academic year
-    df_thisyear["CohortLink"] = (df_thisyear["SchoolUrn"] +
-                                 df_thisyear["SchoolYear"])  # add cohort link of urn and school year
+def calc_school_prevalence(counts):
+    """
+    Calculates the number measured and the prevalence of each BMI category,
+    with Wilson confidence intervals, for every school and school year this
+    year and in the comparison year, from the counts of count_school_cohort
 
-    # This year - rename column names to match SQL
-    old_text = ["SubmitterLocalAuthorityCode", "SubmitterLocalAuthorityName",
-                "PupilIndexOfMultipleDeprivationDecile"]
+    Parameters:
+        counts:
+            counts from count_school_cohort
 
-    new_text = ["OrgCode", "OrgName", "PupilIndexOfMultipleDeprivationD"]
+    Returns:
+        Dataframe with one row for each school, school year and BMI
+        category, with the measured totals, counts, prevalences (%) and
+        confidence intervals this year and in the comparison year (missing
+        where the school was not measured that year)
+    """
+    # One row for each school, school year and year, one column for each
+    # BMI category (pupils without a BMI category are only counted as measured)
+    df_counts = counts["NcmpSystemId"].unstack("BmiPopulationCategory", fill_value=0)
 
-    for old_text, new_text in zip(old_text, new_text):
-        df_thisyear.columns = df_thisyear.columns.str.replace(old_text, new_text)
+    measured = df_counts.sum(axis=1).to_numpy(dtype=float)[:, np.newaxis]
+    df_counts = df_counts.loc[:, df_counts.columns.notnull()]
+    values = df_counts.to_numpy(dtype=float)
 
-    # This year - create count of measured by school and school year
-    df_thisyear["SchNoMeasured"] = df_thisyear.groupby(["SchoolUrn",
-                                                        "SchoolYear"]
-                                                       ).NcmpSystemId.transform("count")
+    # Prevalences and confidence intervals of every school and category at once
+    lower, upper = wilson_interval(values, measured)
 
-    # This year - include only schools with submission >=10
-    df_thisyear = df_thisyear.loc[df_thisyear["SchNoMeasured"] >= 10]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stats = {"Measured": np.broadcast_to(measured, values.shape),
+                 "Count": values,
+                 "Prevalence": values / measured * 100,
+                 "CILower": lower * 100,
+                 "CIUpper": upper * 100}
 
-    # Combine and transform data
-    print("table_schoolcohort - combining and transforming data")
+    df = pd.concat({stat: pd.DataFrame(array, index=df_counts.index, columns=df_counts.columns)
+                    for stat, array in stats.items()}, axis=1)
+
+    # Compare this year and the comparison year for each school and category
+    df = df.stack("BmiPopulationCategory").unstack("YearRef")
+    df.columns = [s1 + str(s2) for (s1, s2) in df.columns.tolist()]
+
+    for stat in stats:
+        for yearref in ["ThisYear", "CompYear"]:
+            if stat + yearref not in df.columns:
+                df[stat + yearref] = np.nan
+
+    df["PercPointChange"] = df["PrevalenceThisYear"] - df["PrevalenceCompYear"]
+
+    # Schools included in the school cohort outputs (>=10 measured each year)
+    df["InSchoolCohort"] = (df["MeasuredThisYear"] >= 10) & (df["MeasuredCompYear"] >= 10)
+
+    outputcols = [stat + yearref for stat in stats for yearref in ["ThisYear", "CompYear"]]
+
+    return df[outputcols + ["PercPointChange", "InSchoolCohort"]].reset_index()
+
+
+def create_table_school_cohort(df_pupils_import, df_pupils_compyear,
+                               academicyear, outputpath=None, counts=None):
+    """
+    Creates the data for the school cohort table and outputs it to the Excel
+    source data file if an output filepath is given
+
+    Parameters:
+        df_pupils_import:
+            imported pupil data
+        df_pupils_compyear:
+            imported data for comparison year
+        academicyear:
+            current academic year
+        outputpath:
+            output filepath for export (optional)
+        counts:
+            counts from count_school_cohort, added together across LAs, used
+            instead of counting the imported pupil data (optional)
+
+    Returns:
+        Dictionary of {sheet name: output dataframe}
+    """
+
+    print("table_schoolcohort - processing pupil data")
 
-    # Comparison year - convert data types
-    df_compyear = df_pupils_compyear.copy()
+    if counts is None:
+        counts = count_school_cohort(df_pupils_import, df_pupils_compyear)
 
-    df_compyear["SchoolUrn"] = df_compyear["SchoolUrn"].apply(str)
-    df_compyear["SchoolYear"] = df_compyear["SchoolYear"].apply(str)
+    df = counts.reset_index()
 
-    # Comp year - add reference fields
-    df_compyear["YearRef"] = "CompYear"   # reference for comparison academic year
-    df_compyear["CohortLink"] = (df_compyear["SchoolUrn"] +
-                                 df_compyear["SchoolYear"])
+    # Add cohort link of urn and school year
+    df["CohortLink"] = df["SchoolUrn"] + df["SchoolYear"]
 
-    # Comp year - create count of measured by school and school year
-    df_compyear["SchNoMeasured"] = df_compyear.groupby(["SchoolUrn",
-                                                        "SchoolYear"]
-                                                       ).NcmpSystemId.transform("count")
+    # Create count of measured by school and school year
+    df["SchNoMeasured"] = df.groupby(["YearRef", "SchoolUrn",
+                                      "SchoolYear"]).NcmpSystemId.transform("sum")
 
-    # Comp year - include only schools with submission >=10
-    df_compyear = df_compyear.loc[df_compyear["SchNoMeasured"] >= 10]
+    # Include only schools with submission >=10
+    df = df.loc[df["SchNoMeasured"] >= 10]
 
-    # Append datasets for both years
-    df = df_thisyear.append([df_compyear])
+    # Combine and transform data
+    print("table_schoolcohort - combining and transforming data")
 
     # Create the school cohort outputs
 
     # Get a list of the school URNs for this year
-    school_set_thisyear = list(set(df_thisyear["CohortLink"]))
+    school_set_thisyear = list(set(df.loc[df["YearRef"] == "ThisYear", "CohortLink"]))
 
     # Create list of cohort schools - schools submitted this year and comparison year
-    cohort_compyear = df_compyear[["CohortLink"]].query("CohortLink in @school_set_thisyear")
+    cohort_compyear = df.loc[df["YearRef"] == "CompYear",
+                             ["CohortLink"]].query("CohortLink in @school_set_thisyear")
     school_set_cohort = list(set(cohort_compyear["CohortLink"]))
 
     # Filter data to include only schools in the school cohort
@@ -101,13 +160,13 @@ def create_table_school_cohort(df_pupils_import, df_pupils_compyear,
         measured = df[["SchoolYear",
                        "NcmpSystemId",
                        "YearRef"]].groupby(["SchoolYear",
-                                            "YearRef"]).count().reset_index()
+                                            "YearRef"]).sum().reset_index()
 
         measured = measured.rename(columns={"NcmpSystemId": "Total"})
 
-        subgroup = df[breakdowns + countcol].groupby([*breakdowns]).count().reset_index()
+        subgroup = df[breakdowns + countcol].groupby([*breakdowns]).sum().reset_index()
         subgroup = subgroup.rename(columns={"NcmpSystemId": "Value"})
-        subgroup["SchoolYear"] = subgroup["SchoolYear"].apply(str)
+        subgroup["SchoolYear"] = subgroup["SchoolYear"].astype(str)
 
         subgroup = pd.merge(subgroup, measured,  how="left",
                             left_on=["YearRef",  "SchoolYear"],
@@ -144,8 +203,22 @@ def create_table_school_cohort(df_pupils_import, df_pupils_compyear,
     df_bmi_school_cohort = df_bmi_all.append([df_bmi_cohort, df_bmi_only])
 
     # Add pupil extract date
-    df_bmi_school_cohort["PupilExtractDate"] = datetime.strptime(param.PUPILS_FILE[27:35],
-                                                                 "%d%m%Y").date()
+    extract_date = datetime.strptime(param.PUPILS_FILE[27:35], "%d%m%Y").date()
+    df_bmi_school_cohort["PupilExtractDate"] = extract_date
+
+    outputs = {"CohortAnalysis": df_bmi_school_cohort}
+
+    # School level prevalence for all measured schools, for QA
+    if param.SCHOOL_PREVALENCE:
+        print("table_schoolcohort - calculating school level prevalence")
+
+        df_school_prevalence = calc_school_prevalence(counts)
+        df_school_prevalence["PupilExtractDate"] = extract_date
+
+        outputs["SchoolPrevalence"] = df_school_prevalence
 
     # Export to Excel
-    export_excel_data(df_bmi_school_cohort, "CohortAnalysis", outputpath)
+    if outputpath is not None:
+        export_excel_data(df_bmi_school_cohort, "CohortAnalysis", outputpath)
+
+    return outputs
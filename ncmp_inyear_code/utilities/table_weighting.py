@@ -1,23 +1,157 @@
 import pandas as pd
+import numpy as np
 from datetime import datetime
 
 import ncmp_inyear_code.parameters_inyear as param
 from ncmp_inyear_code.utilities.export_inyear import export_excel_data
+from ncmp_inyear_code.utilities.pupil_views import create_pupil_view
+from ncmp_inyear_code.utilities.raking import rake_weights
+from ncmp_inyear_code.utilities.out_of_core import iter_partitions
+
+
+def process_weighting(df, df_lsoa_ref, df_la_e07_ref,
+                      df_ethnicity_ref_ohid, df_imd_ref_ohid):
+    """
+    Adds the upper tier LA, ethnic group and IMD quintile weighting
+    variables to this year or base years pupil data from the reference data
+    """
+    # Add latest LA codes from reference data based on school LSOA2011
+    df = pd.merge(df,
+                  df_lsoa_ref[["LSOACD", "LADCD"]],
+                  how="left",
+                  left_on=["SchoolLowerSuperOutputArea2011"],
+                  right_on=["LSOACD"])
+
+    # Add latest upper tier LA codes for E07 LAs
+    df = pd.merge(df,
+                  df_la_e07_ref[["PARENT_GEOGRAPHY_CODE",
+                                 "GEOGRAPHY_CODE",
+                                 "ENTITY_CODE"]],
+                  how="left",
+                  left_on=["LADCD"],
+                  right_on=["GEOGRAPHY_CODE"])
+
+    # Assign accurate upper tier LA code
+    df["UpperTierLA"] = df["LADCD"]
+
+    df.loc[df["ENTITY_CODE"] == "E07",
+           "UpperTierLA"] = df["PARENT_GEOGRAPHY_CODE"]
+
+    # Assign LAs to any URNs missing school LSOA as defined in parameters
+    for key in param.URN_UPDATE_WEIGHTING_LA:
+        df.loc[df["SchoolUrn"] == key,
+               "UpperTierLA"] = param.URN_UPDATE_WEIGHTING_LA[key]
+
+    # Recode ethnicity description into 5 groups based on OHID reference
+    df = pd.merge(df,
+                  df_ethnicity_ref_ohid,
+                  how="left",
+                  left_on=["NhsEthnicityDescription"],
+                  right_on=["NhsEthnicityDescription"])
+
+    # Recode IMD decile into 5 groups (quintiles) based on OHID reference
+    df = pd.merge(df,
+                  df_imd_ref_ohid,
+                  how="left",
+                  left_on=["ImdDecile"],
+                  right_on=["IMD Decile"])
+
+    # Convert weighting variables to strings
+    df = df.astype({"UpperTierLA": str, "SchoolYear": str,
+                    "Ethnic Group": str, "IMD Quintile": str})
+
+    return df
+
+
+def aggregate_baseyears(df_pupils_baseyears, df_ethnicity_ref, df_lsoa_ref, df_la_e07_ref,
+                        df_ethnicity_ref_ohid, df_imd_ref_ohid, compyear):
+    """
+    This function will aggregate the base years data used for weighting:
+    the average number of pupils measured in the base years by the weighting
+    variables, and the comparison year rows. These do not depend on the
+    pupil extract, so in batch mode they are created once for all extracts
+
+    Parameters:
+        df_pupils_baseyears:
+            imported data for base years, or the folder of its partitions
+            if imported out of core
+        df_ethnicity_ref:
+            imported ethnicity reference data
+        df_lsoa_ref:
+            imported LSOA reference data
+        df_la_e07_ref:
+            imported LA reference data for E07 codes
+        df_ethnicity_ref_ohid:
+            imported ethnicity reference lookups from OHID
+        df_imd_ref_ohid:
+            imported IMD quintiles reference lookups from OHID
+        compyear:
+            comparison year
+
+    Returns:
+        Dictionary of {"df_baseyears_weight": average base years counts,
+        "df_compyear_weight": comparison year rows}
+    """
+    keycols = ["BmiPopulationCategory", "ImdDecile", "NcmpSystemId", "OrgCode",
+               "SchoolLowerSuperOutputArea2011", "SchoolUrn", "SchoolYear"]
+
+    # Base years - count pupils grouped by key variables, one partition at a
+    # time if the base years data is held out of core, and keep the
+    # comparison year rows
+    weightcols = ["SchoolYear", "UpperTierLA", "IMD Quintile", "Ethnic Group"]
+
+    baseyears_counts = []
+    baseyears = set()
+    compyear_parts = []
+
+    for df_baseyears in iter_partitions(df_pupils_baseyears):
+
+        # Add ethnicity description from ethnicity reference data
+        df_baseyears = pd.merge(df_baseyears[keycols + ["AcademicYear",
+                                                        "NhsEthnicityCode"]],
+                                df_ethnicity_ref,
+                                how="left",
+                                left_on=["NhsEthnicityCode"],
+                                right_on=["Value"])
+
+        df_baseyears = process_weighting(df_baseyears, df_lsoa_ref, df_la_e07_ref,
+                                         df_ethnicity_ref_ohid, df_imd_ref_ohid)
+
+        baseyears_counts.append(df_baseyears[weightcols +
+                                             ["NcmpSystemId"]].groupby(weightcols).count())
+
+        baseyears.update(df_baseyears["AcademicYear"])
+
+        compyear_parts.append(df_baseyears.loc[df_baseyears["AcademicYear"] == compyear[3:10],
+                                               ["SchoolYear", "BmiPopulationCategory",
+                                                "UpperTierLA", "OrgCode"]])
+
+    # Base years - create average measured value (2016/17 to 2018/19) grouped by key variables
+    df_baseyears_weight = pd.concat(baseyears_counts).groupby(level=weightcols).sum().reset_index()
+
+    # Base years - calculate average value
+    df_baseyears_weight["measured_BaseYear"] = (df_baseyears_weight["NcmpSystemId"] /
+                                                len(baseyears))
+
+    return {"df_baseyears_weight": df_baseyears_weight,
+            "df_compyear_weight": pd.concat(compyear_parts)}
 
 
 def create_table_weighting(df_pupils_import, df_pupils_baseyears,
                            df_ethnicity_ref, df_lsoa_ref, df_la_e07_ref,
                            df_ethnicity_ref_ohid, df_imd_ref_ohid,
-                           academicyear, compyear, outputpath):
+                           academicyear, compyear, outputpath=None,
+                           df_la_lookups=None, baseyears=None):
     """
     Creates the data for the weighting table and outputs it to the Excel
-    source data file
+    source data file if an output filepath is given
 
     Parameters:
         df_pupils_import:
             imported pupil data
         df_pupils_baseyears:
-            imported data for base years
+            imported data for base years, or the folder of its partitions
+            if imported out of core
         df_ethnicity_ref:
             imported ethnicity reference data
         df_lsoa_ref:
@@ -33,118 +167,48 @@ def create_table_weighting(df_pupils_import, df_pupils_baseyears,
         compyear:
             comparison year
         outputpath:
-            output filepath for export
+            output filepath for export (optional)
+        df_la_lookups:
+            LA to reporting region lookups, used for the weighted outputs
+            by region (optional)
+        baseyears:
+            base years data already aggregated by aggregate_baseyears, used
+            instead of df_pupils_baseyears (optional)
 
     Returns:
-        None
+        Dictionary of {sheet name: output dataframe}
     """
 
-    print("table_weighting - processing pupil data for this year and base years")
-
-    df_thisyear = df_pupils_import.copy()
-
-    # This year add year reference columns
-    df_thisyear["AcademicYear"] = academicyear  # specify current academic year
-    df_thisyear["Year_ref"] = "ThisYear"  # specify reference current academic year
+    if param.WEIGHTING_METHOD not in ["cell", "raking"]:
+        raise ValueError(f"Unknown weighting method: {param.WEIGHTING_METHOD}")
 
-    # This year - rename column names to match SQL
-    old_text = ["PupilIndexOfMultipleDeprivationDecile",
-                "SchoolIndexOfMultipleDeprivationDecile"]
-
-    new_text = ["PupilIndexOfMultipleDeprivationD",
-                "SchoolIndexOfMultiDeprivationD"]
-
-    for old_text, new_text in zip(old_text, new_text):
-        df_thisyear.columns = df_thisyear.columns.str.replace(old_text, new_text)
+    print("table_weighting - processing pupil data for this year and base years")
 
-    # Base years - add ethnicity description from ethnicity reference data
-    df_baseyears = df_pupils_baseyears.copy()
+    # Columns used in the weighting process
+    keycols = ["BmiPopulationCategory", "ImdDecile", "NcmpSystemId", "OrgCode",
+               "SchoolLowerSuperOutputArea2011", "SchoolUrn", "SchoolYear"]
 
-    df_baseyears = pd.merge(df_baseyears,
-                            df_ethnicity_ref,
-                            how="left",
-                            left_on=["NhsEthnicityCode"],
-                            right_on=["Value"])
-
-    # Add reference data and update data types for this year and base years
-    def process_weighting(df, df_lsoa_ref, df_la_e07_ref,
-                          df_ethnicity_ref_ohid, df_imd_ref_ohid):
-
-        # Replace missing pupil IMD with school IMD
-        df["ImdDecile"] = df["PupilIndexOfMultipleDeprivationD"]
-
-        df.loc[df["ImdDecile"].isnull(),
-               "ImdDecile"] = df["SchoolIndexOfMultiDeprivationD"]
-
-        # Add latest LA codes from reference data based on school LSOA2011
-        df = pd.merge(df,
-                      df_lsoa_ref[["LSOACD", "LADCD"]],
-                      how="left",
-                      left_on=["SchoolLowerSuperOutputArea2011"],
-                      right_on=["LSOACD"])
-
-        # Add latest upper tier LA codes for E07 LAs
-        df = pd.merge(df,
-                      df_la_e07_ref[["PARENT_GEOGRAPHY_CODE",
-                                     "GEOGRAPHY_CODE",
-                                     "ENTITY_CODE"]],
-                      how="left",
-                      left_on=["LADCD"],
-                      right_on=["GEOGRAPHY_CODE"])
-
-        # Assign accurate upper tier LA code
-        df["UpperTierLA"] = df["LADCD"]
-
-        df.loc[df["ENTITY_CODE"] == "E07",
-               "UpperTierLA"] = df["PARENT_GEOGRAPHY_CODE"]
-
-        # Assign LAs to any URNs missing school LSOA as defined in parameters
-        for key in param.URN_UPDATE_WEIGHTING_LA:
-            df.loc[df["SchoolUrn"] == key,
-                   "UpperTierLA"] = param.URN_UPDATE_WEIGHTING_LA[key]
-
-        # Recode ethnicity description into 5 groups based on OHID reference
-        df = pd.merge(df,
-                      df_ethnicity_ref_ohid,
-                      how="left",
-                      left_on=["NhsEthnicityDescription"],
-                      right_on=["NhsEthnicityDescription"])
-
-        # Recode IMD decile into 5 groups (quintiles) based on OHID reference
-        df = pd.merge(df,
-                      df_imd_ref_ohid,
-                      how="left",
-                      left_on=["ImdDecile"],
-                      right_on=["IMD Decile"])
-
-        # Convert weighting variables to strings
-        df = df.astype({"UpperTierLA": str, "SchoolYear": str,
-                        "Ethnic Group": str, "IMD Quintile": str})
-
-        return df
+    # This year - create view of pupil data with year reference columns
+    df_thisyear = create_pupil_view(df_pupils_import,
+                                    keycols + ["NhsEthnicityDescription"],
+                                    derived={"AcademicYear": academicyear,  # specify current academic year
+                                             "Year_ref": "ThisYear"})  # specify reference current academic year
 
+    # Add reference data and update data types for this year
     df_thisyear = process_weighting(df_thisyear, df_lsoa_ref, df_la_e07_ref,
                                     df_ethnicity_ref_ohid, df_imd_ref_ohid)
 
-    df_baseyears = process_weighting(df_baseyears, df_lsoa_ref, df_la_e07_ref,
-                                     df_ethnicity_ref_ohid, df_imd_ref_ohid)
-
     # Create weightings
     print("table_weighting - creating weightings")
 
-    # Base years - create average measured value (2016/17 to 2018/19) grouped by key variables
-    df_baseyears_weight = df_baseyears[["SchoolYear",
-                                        "UpperTierLA",
-                                        "IMD Quintile",
-                                        "Ethnic Group",
-                                        "NcmpSystemId"]].groupby(["SchoolYear",
-                                                                  "UpperTierLA",
-                                                                  "IMD Quintile",
-                                                                  "Ethnic Group"]).count().reset_index()
+    # Base years - average counts by key variables and comparison year rows,
+    # unless already aggregated (once for every extract in batch mode)
+    if baseyears is None:
+        baseyears = aggregate_baseyears(df_pupils_baseyears, df_ethnicity_ref, df_lsoa_ref,
+                                        df_la_e07_ref, df_ethnicity_ref_ohid, df_imd_ref_ohid,
+                                        compyear)
 
-    # Base years - calculate average value
-    df_baseyears_weight["measured_BaseYear"] = (df_baseyears_weight["NcmpSystemId"] /
-                                                len(set(df_baseyears["AcademicYear"])))
+    df_baseyears_weight = baseyears["df_baseyears_weight"].copy()
 
     # Base years - create a link field
     df_baseyears_weight["Link_Field"] = (df_baseyears_weight["SchoolYear"] +
@@ -217,6 +281,23 @@ def create_table_weighting(df_pupils_import, df_pupils_baseyears,
     df_thisyear_weight["Weight"] = (df_thisyear_weight["proportion_BaseYear"] /
                                     df_thisyear_weight["proportion_ThisYear"])
 
+    # This year - replace cell weights with raked weights if selected, matching
+    # the base years distribution of each weighting variable separately
+    if param.WEIGHTING_METHOD == "raking":
+        print("table_weighting - creating raked weights")
+
+        df_thisyear_weight["Weight"], df_raking = rake_weights(df_thisyear_weight,
+                                                               df_baseyears_weight,
+                                                               ["UpperTierLA",
+                                                                "IMD Quintile",
+                                                                "Ethnic Group"],
+                                                               param.RAKING_TOLERANCE,
+                                                               param.RAKING_MAX_ITERATIONS)
+
+        print(f"table_weighting - raking {'converged' if df_raking['Converged'].iloc[-1] else 'did not converge'}"
+              f" after {len(df_raking)} iterations "
+              f"(max margin error {df_raking['MaxMarginError'].iloc[-1]:.2e})")
+
     # Combine weighted and unweighted data
     print("table_weighting - combining weighted and unweighted data")
 
@@ -234,19 +315,19 @@ def create_table_weighting(df_pupils_import, df_pupils_baseyears,
                            right_on=["Link_Field"])
 
     # Extract comparison year data from base data
-    df_compyear = df_baseyears.loc[df_baseyears["AcademicYear"] == compyear[3:10]].copy()
-
-    # Add year ref for comparison year
-    df_compyear["Year_ref"] = "CompYear"
-
-    # Add weight equal to 1 to comparison data
-    df_compyear["Weight"] = 1
+    # Add year ref for comparison year and weight equal to 1 to comparison data
+    df_compyear = create_pupil_view(baseyears["df_compyear_weight"],
+                                    ["SchoolYear", "BmiPopulationCategory",
+                                     "UpperTierLA", "OrgCode"],
+                                    derived={"Year_ref": "CompYear", "Weight": 1})
 
     # Create weighting table output
     print("table_weighting - creating outputs")
 
     # Combine comparison year and this year data
-    df = df_compyear.append([df_thisyear])
+    df = df_compyear.append([df_thisyear[["SchoolYear", "BmiPopulationCategory",
+                                          "UpperTierLA", "OrgCode",
+                                          "Year_ref", "Weight"]]])
 
     # Add unweighted value of 1 for all rows
     df["Unweighted"] = 1
@@ -255,17 +336,21 @@ def create_table_weighting(df_pupils_import, df_pupils_baseyears,
     def pupil_keygroups(df, breakdowns, sumcol):
         measured = df[["SchoolYear",
                        sumcol[0],
-                       "Year_ref"]].groupby(["SchoolYear",
-                                             "Year_ref"])[sumcol[0]].agg(Total="sum",
-                                                                         Count="count").reset_index()
+                       "Year_ref"]].assign(SumSq=df[sumcol[0]]**2).groupby(["SchoolYear",
+                                                                             "Year_ref"]).agg(Total=(sumcol[0], "sum"),
+                                                                                              Count=(sumcol[0], "count"),
+                                                                                              SumSq=("SumSq", "sum")).reset_index()
+
+        # Kish effective sample size, (sum of w)^2 / sum of w^2
+        measured["EffectiveSampleSize"] = measured["Total"]**2 / measured["SumSq"]
 
-        measured["SchoolYear"] = measured["SchoolYear"].apply(str)
-        measured["Year_ref"] = measured["Year_ref"].apply(str)
+        measured["SchoolYear"] = measured["SchoolYear"].astype(str)
+        measured["Year_ref"] = measured["Year_ref"].astype(str)
 
         subgroup = df[breakdowns + sumcol].groupby([*breakdowns]).sum().reset_index()
         subgroup = subgroup.rename(columns={sumcol[0]: "Value"})
-        subgroup["SchoolYear"] = subgroup["SchoolYear"].apply(str)
-        subgroup["Year_ref"] = subgroup["Year_ref"].apply(str)
+        subgroup["SchoolYear"] = subgroup["SchoolYear"].astype(str)
+        subgroup["Year_ref"] = subgroup["Year_ref"].astype(str)
 
         subgroup = pd.merge(subgroup,
                             measured,
@@ -281,7 +366,8 @@ def create_table_weighting(df_pupils_import, df_pupils_baseyears,
                                   values=["Total",
                                           "Proportion",
                                           "Value",
-                                          "Count"],
+                                          "Count",
+                                          "EffectiveSampleSize"],
                                   index=breakdowns[:-1],
                                   columns="Year_ref").reset_index()
 
@@ -292,8 +378,8 @@ def create_table_weighting(df_pupils_import, df_pupils_baseyears,
 
         return subgroup
 
-    # Create weighted output, excluding rows with weights >4
-    df_trim = df.loc[df["Weight"] <= 4]
+    # Create weighted output, excluding rows with weights above the trim (4)
+    df_trim = df.loc[df["Weight"] <= param.WEIGHT_TRIM]
 
     breakdowns = ["SchoolYear", "BmiPopulationCategory", "Year_ref"]
     sumcol = ["Weight"]
@@ -305,7 +391,9 @@ def create_table_weighting(df_pupils_import, df_pupils_baseyears,
                                        "TotalCompYear", "TotalThisYear",
                                        "ValueCompYear", "ValueThisYear",
                                        "PercPointChange", "CountThisYear",
-                                       "CountCompYear"]]
+                                       "CountCompYear",
+                                       "EffectiveSampleSizeThisYear",
+                                       "EffectiveSampleSizeCompYear"]]
 
     # Create BMI unweighted
     sumcol = ["Unweighted"]
@@ -319,11 +407,224 @@ def create_table_weighting(df_pupils_import, df_pupils_baseyears,
                                            "PercPointChange", "CountThisYear",
                                            "CountCompYear"]]
 
+    outputs = {"Weighted": df_bmi_weighted,
+               "Unweighted": df_bmi_unweighted}
+
+    # Create weighted outputs by upper tier LA and region
+    print("table_weighting - creating weighted outputs by upper tier LA and region")
+
+    outputs.update(create_weighted_geography(df_trim, df_la_lookups))
+
+    # Add raking convergence diagnostics
+    if param.WEIGHTING_METHOD == "raking":
+        outputs["RakingDiagnostics"] = df_raking
+
+    # Create sensitivity of weighted prevalence to the weight trim and caps
+    if param.WEIGHT_SENSITIVITY:
+        print("table_weighting - creating weight trimming sensitivity output")
+
+        outputs["WeightSensitivity"] = create_weight_sensitivity(df,
+                                                                 param.WEIGHT_SENSITIVITY_TRIMS,
+                                                                 param.WEIGHT_SENSITIVITY_CAPS)
+
     # Add pupil extract date to outputs
-    for df in [df_bmi_weighted, df_bmi_unweighted]:
+    for df in outputs.values():
         df["PupilExtractDate"] = datetime.strptime(param.PUPILS_FILE[27:35],
                                                    "%d%m%Y").date()
 
     # Export to Excel
-    export_excel_data(df_bmi_weighted, "Weighted", outputpath)
-    export_excel_data(df_bmi_unweighted, "Unweighted", outputpath)
+    if outputpath is not None:
+        for sheet, df_output in outputs.items():
+            export_excel_data(df_output, sheet, outputpath)
+
+    return outputs
+
+
+def create_weighted_geography(df, df_la_lookups=None):
+    """
+    Creates weighted prevalence, denominators and effective sample sizes
+    (Kish) by upper tier LA and by region, from a single grouped sum of the
+    weights, squared weights and counts over the weighted data.
+
+    Pupils are assigned to the upper tier LA of their school (as used for
+    weighting), and each upper tier LA to the region of the LA submitting
+    most of its pupils, so pupils at schools over an LA boundary are shown
+    in the region of their upper tier LA. Upper tier LAs whose LA is
+    missing from the LA lookups are reported and shown under region
+    "Unknown", so the regions add up to England.
+
+    Parameters:
+        df:
+            combined this year and comparison year data with Weight column,
+            excluding trimmed rows
+        df_la_lookups:
+            LA to reporting region lookups - the region output is only
+            created if given
+
+    Returns:
+        Dictionary of {sheet name: output dataframe}
+    """
+    groupcols = ["UpperTierLA", "OrgCode", "SchoolYear", "Year_ref",
+                 "BmiPopulationCategory"]
+
+    # Sum weights and squared weights and count pupils in one pass
+    df_sums = df[groupcols + ["Weight"]].assign(WeightSq=df["Weight"]**2)
+    df_sums = df_sums.groupby(groupcols).agg(Value=("Weight", "sum"),
+                                             WeightSq=("WeightSq", "sum"),
+                                             Count=("Weight", "count")).reset_index()
+
+    geographies = {"WeightedUTLA": "UpperTierLA"}
+
+    if df_la_lookups is not None:
+        regions = df_la_lookups.set_index(df_la_lookups["LACode"].astype(str))["PHERegionalOffice"]
+
+        # LA submitting most pupils in each upper tier LA
+        df_las = (df_sums.assign(OrgCode=df_sums["OrgCode"].astype(str))
+                         .groupby(["UpperTierLA", "OrgCode"])["Count"].sum().reset_index()
+                         .sort_values(["UpperTierLA", "Count", "OrgCode"],
+                                      ascending=[True, False, True], kind="mergesort")
+                         .drop_duplicates("UpperTierLA"))
+
+        utla_las = df_las.set_index("UpperTierLA")["OrgCode"]
+        df_sums["Region"] = df_sums["UpperTierLA"].map(utla_las.map(regions))
+
+        unmapped = df_sums["Region"].isnull()
+
+        if unmapped.any():
+            print(f"table_weighting - {df_sums.loc[unmapped, 'Count'].sum()} pupils in upper tier LAs "
+                  f"of LAs missing from the LA lookups shown under region Unknown: "
+                  f"{', '.join(sorted(df_sums.loc[unmapped, 'UpperTierLA'].map(utla_las).unique()))}")
+
+            df_sums["Region"] = df_sums["Region"].fillna("Unknown")
+
+        geographies["WeightedRegion"] = "Region"
+
+    outputs = {}
+
+    for sheet, geocol in geographies.items():
+        keys = [geocol, "SchoolYear", "Year_ref"]
+
+        df_geo = df_sums.groupby(keys + ["BmiPopulationCategory"])[["Value", "WeightSq", "Count"]].sum()
+
+        # Denominators and Kish effective sample size, (sum of w)^2 / sum of w^2
+        totals = df_geo.groupby(level=keys).transform("sum")
+        df_geo["Total"] = totals["Value"]
+        df_geo["Count"] = totals["Count"]
+        df_geo["EffectiveSampleSize"] = totals["Value"]**2 / totals["WeightSq"]
+        df_geo["Proportion"] = df_geo["Value"] / df_geo["Total"] * 100
+
+        # One column per year reference, as for the national weighted output
+        df_geo = pd.pivot_table(df_geo.reset_index(),
+                                values=["Total", "Proportion", "Value", "Count",
+                                        "EffectiveSampleSize"],
+                                index=[geocol, "SchoolYear", "BmiPopulationCategory"],
+                                columns="Year_ref").reset_index()
+
+        df_geo.columns = [s1 + str(s2) for (s1, s2) in df_geo.columns.tolist()]
+
+        df_geo["PercPointChange"] = (df_geo["ProportionThisYear"] -
+                                     df_geo["ProportionCompYear"])
+
+        outputs[sheet] = df_geo[[geocol, "SchoolYear", "BmiPopulationCategory",
+                                 "ProportionCompYear", "ProportionThisYear",
+                                 "TotalCompYear", "TotalThisYear",
+                                 "ValueCompYear", "ValueThisYear",
+                                 "PercPointChange", "CountThisYear", "CountCompYear",
+                                 "EffectiveSampleSizeThisYear",
+                                 "EffectiveSampleSizeCompYear"]]
+
+    return outputs
+
+
+def create_weight_sensitivity(df, trims, caps):
+    """
+    Creates weighted prevalence for a grid of weight trimming thresholds
+    (rows with weights above the threshold are excluded) and weight caps
+    (weights above the cap are set to the cap), in a single pass over the
+    data.
+
+    Weights are summed by school year, year reference, BMI category and
+    weight value, sorted by weight once, and cumulative sums of the weights
+    and counts are then read off at each threshold and cap.
+
+    Parameters:
+        df:
+            combined this year and comparison year data with Weight column
+        trims:
+            list of weight trimming thresholds
+        caps:
+            list of weight caps
+
+    Returns:
+        Dataframe with weighted prevalence for each school year and BMI
+        category, by method (Trim or Cap) and threshold
+    """
+    groupcols = ["SchoolYear", "Year_ref"]
+
+    # Sum weights and count pupils for each distinct weight by BMI category
+    df_weights = df.groupby(groupcols + ["Weight", "BmiPopulationCategory"]
+                            ).Weight.agg(["sum", "count"]).unstack(fill_value=0)
+
+    categories = df_weights["sum"].columns
+
+    df_sens = []
+
+    for (schoolyear, year_ref), df_group in df_weights.groupby(level=groupcols):
+
+        # Weights in ascending order, with cumulative sums by category
+        weights = df_group.index.get_level_values("Weight").to_numpy()
+        cum_sum = np.cumsum(df_group["sum"].to_numpy(), axis=0)
+        cum_count = np.cumsum(df_group["count"].to_numpy(), axis=0)
+
+        # Pad with zeros so thresholds below the smallest weight select no rows
+        cum_sum = np.vstack([np.zeros(len(categories)), cum_sum])
+        cum_count = np.vstack([np.zeros(len(categories)), cum_count])
+
+        # Trim - keep rows with weights up to the threshold
+        trim_pos = np.searchsorted(weights, trims, side="right")
+        trim_value = cum_sum[trim_pos]
+        trim_count = cum_count[trim_pos]
+
+        # Cap - weights up to the cap are unchanged, those above count as the cap
+        cap_pos = np.searchsorted(weights, caps, side="right")
+        cap_value = (cum_sum[cap_pos] +
+                     np.array(caps, dtype=float)[:, None] *
+                     (cum_count[-1] - cum_count[cap_pos]))
+        cap_count = np.repeat(cum_count[-1:], len(caps), axis=0)
+
+        for method, thresholds, value, count in [("Trim", trims, trim_value, trim_count),
+                                                 ("Cap", caps, cap_value, cap_count)]:
+            if len(thresholds) == 0:
+                continue
+
+            df_method = pd.DataFrame({"Method": method,
+                                      "Threshold": np.repeat(thresholds, len(categories)),
+                                      "SchoolYear": str(schoolyear),
+                                      "Year_ref": str(year_ref),
+                                      "BmiPopulationCategory": np.tile(categories, len(thresholds)),
+                                      "Value": value.ravel(),
+                                      "Total": np.repeat(value.sum(axis=1), len(categories)),
+                                      "Count": np.repeat(count.sum(axis=1), len(categories))})
+
+            df_sens.append(df_method)
+
+    df_sens = pd.concat(df_sens)
+    df_sens["Proportion"] = df_sens["Value"]/df_sens["Total"] * 100
+
+    # One column per year reference, as for the weighted output
+    df_sens = pd.pivot_table(df_sens,
+                             values=["Total", "Proportion", "Value", "Count"],
+                             index=["Method", "Threshold", "SchoolYear",
+                                    "BmiPopulationCategory"],
+                             columns="Year_ref").reset_index()
+
+    df_sens.columns = [s1 + str(s2) for (s1, s2) in df_sens.columns.tolist()]
+
+    df_sens["PercPointChange"] = (df_sens["ProportionThisYear"] -
+                                  df_sens["ProportionCompYear"])
+
+    return df_sens[["Method", "Threshold", "SchoolYear", "BmiPopulationCategory",
+                    "ProportionCompYear", "ProportionThisYear",
+                    "TotalCompYear", "TotalThisYear",
+                    "ValueCompYear", "ValueThisYear",
+                    "PercPointChange", "CountThisYear", "CountCompYear"]]
@@ -5,10 +5,16 @@ from setuptools import find_packages, setup
 setup(
     name='ncmp_code',
     packages=find_packages(),
+    package_data={'ncmp_inyear_code': ['sql_code/*.sql']},
     version='0.1.0',
     description='To create publication ...',
     author='NHS_Digital',
     license='',
     setup_requires=['pytest-runner','flake8'],
     tests_require=['pytest'],
+    entry_points={
+        'console_scripts': [
+            'ncmp-inyear=ncmp_inyear_code.create_publication_inyear:main',
+        ],
+    },
 )
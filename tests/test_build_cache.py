@@ -0,0 +1,44 @@
+"""
+Purpose of script: checks that the code version of a table build covers the
+package modules it uses through other package modules.
+"""
+import sys
+import types
+
+import ncmp_inyear_code.parameters_inyear as param
+from ncmp_inyear_code.utilities.build_cache import get_code_modules
+from ncmp_inyear_code.utilities.table_weighting import create_table_weighting
+
+
+def test_code_modules_followed_through_package_modules(monkeypatch):
+    # Table module using a helper module, which uses a further helper
+    modules = {name: types.ModuleType(f"ncmp_inyear_code.{name}")
+               for name in ["fake_table", "fake_helper", "fake_inner"]}
+
+    def create_fake_table():
+        pass
+
+    def inner_function():
+        pass
+
+    create_fake_table.__module__ = "ncmp_inyear_code.fake_table"
+    inner_function.__module__ = "ncmp_inyear_code.fake_inner"
+
+    modules["fake_table"].create_fake_table = create_fake_table
+    modules["fake_table"].fake_helper = modules["fake_helper"]
+    modules["fake_table"].param = param
+    modules["fake_helper"].inner_function = inner_function
+
+    for module in modules.values():
+        monkeypatch.setitem(sys.modules, module.__name__, module)
+
+    assert get_code_modules(create_fake_table) == {"ncmp_inyear_code.fake_table",
+                                                   "ncmp_inyear_code.fake_helper",
+                                                   "ncmp_inyear_code.fake_inner"}
+
+
+def test_code_modules_of_weighting_table():
+    modules = get_code_modules(create_table_weighting)
+
+    assert "ncmp_inyear_code.utilities.raking" in modules
+    assert param.__name__ not in modules
@@ -0,0 +1,112 @@
+"""
+Purpose of script: checks that unchanged sheets are only skipped on export
+while the workbook is the one last exported to.
+"""
+import sys
+import types
+
+import pandas as pd
+import pytest
+
+import ncmp_inyear_code.parameters_inyear as param
+from ncmp_inyear_code.utilities import export_inyear
+
+
+class FakeSheet:
+    """
+    Sheet of the fake workbook, recording the sheets written to
+    """
+    def __init__(self, name, written):
+        self.name = name
+        self.written = written
+
+    def select(self):
+        pass
+
+    def clear_contents(self):
+        pass
+
+    def range(self, cell):
+        return self
+
+    def options(self, *args, **kwargs):
+        return self
+
+    @property
+    def value(self):
+        return None
+
+    @value.setter
+    def value(self, df):
+        self.written.append(self.name)
+
+
+class FakeSheets(dict):
+    """
+    Sheets of the fake workbook, iterated as sheets as in xlwings
+    """
+    def __iter__(self):
+        return iter(self.values())
+
+
+class FakeBook:
+    """
+    Fake workbook, which changes the workbook file on save as Excel does
+    """
+    def __init__(self, written):
+        self.sheets = FakeSheets({name: FakeSheet(name, written) for name in ["Weighted", "IMD"]})
+
+    def save(self, path):
+        path.write_bytes(path.read_bytes() + b"+")
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def workbook(tmp_path, monkeypatch):
+    """
+    Returns the path of an output workbook and the list of the sheets
+    written to it, with xlwings replaced by a fake
+    """
+    file_path = tmp_path / "ncmp_inyear_source.xlsx"
+    file_path.write_bytes(b"template")
+
+    written = []
+
+    xw = types.ModuleType("xlwings")
+    xw.App = lambda **kwargs: types.SimpleNamespace(quit=lambda: None)
+    xw.books = types.SimpleNamespace(open=lambda path: FakeBook(written))
+
+    monkeypatch.setitem(sys.modules, "xlwings", xw)
+    monkeypatch.setattr(param, "IY_FORCE_EXPORT", False)
+
+    return file_path, written
+
+
+def test_unchanged_sheet_is_skipped(workbook):
+    file_path, written = workbook
+    df = pd.DataFrame({"Value": [1.0, 2.0]})
+
+    assert export_inyear.export_excel_data(df, "Weighted", file_path)
+    assert export_inyear.export_excel_data(df, "IMD", file_path)
+
+    # The first sheet is still current after the second sheet is saved
+    assert not export_inyear.export_excel_data(df, "Weighted", file_path)
+    assert not export_inyear.export_excel_data(df, "IMD", file_path)
+    assert written == ["Weighted", "IMD"]
+
+
+def test_replaced_workbook_is_refilled(workbook):
+    file_path, written = workbook
+    df = pd.DataFrame({"Value": [1.0, 2.0]})
+
+    export_inyear.export_excel_data(df, "Weighted", file_path)
+    export_inyear.export_excel_data(df, "IMD", file_path)
+
+    # Restore the workbook from the template, leaving the manifest in place
+    file_path.write_bytes(b"template")
+
+    assert export_inyear.export_excel_data(df, "Weighted", file_path)
+    assert export_inyear.export_excel_data(df, "IMD", file_path)
+    assert written == ["Weighted", "IMD", "Weighted", "IMD"]
@@ -0,0 +1,56 @@
+"""
+Purpose of script: checks that the byte ranges of a pupil data file parsed
+separately by the parallel reader are read with the same column types, when
+one range has blank or alphanumeric identifiers.
+"""
+import numpy as np
+import pandas as pd
+
+import ncmp_inyear_code.utilities.parallel_csv as parallel_csv
+from ncmp_inyear_code.utilities.import_inyeardata import PUPIL_IMPORT_COLS, PUPIL_DTYPES, filter_ncmp
+
+
+def write_pupils_file(file_path, size):
+    """
+    Writes a pupil data file with numeric identifiers, except near the end
+    of the file where the school URN is blank and the pupil ID has letters
+    """
+    df = pd.DataFrame({col: "x" for col in PUPIL_IMPORT_COLS}, index=range(size))
+
+    df["Bmi"] = 17.5
+    df["BmiPScore"] = 0.5
+    df["NcmpSchoolStatus"] = "NCMP"
+    df["NcmpSystemId"] = np.arange(size).astype(str)
+    df["PupilIndexOfMultipleDeprivationDecile"] = 3
+    df["SchoolIndexOfMultipleDeprivationDecile"] = 4
+    df["SchoolUrn"] = "100101"
+    df["SubmitterLocalAuthorityCode"] = "E06000001"
+
+    df.loc[size - 10:, "SchoolUrn"] = ""
+    df.loc[size - 10:, "NcmpSystemId"] = "A" + df["NcmpSystemId"]
+
+    df.to_csv(file_path, index=False)
+
+
+def test_ranges_read_with_same_identifier_types(tmp_path, monkeypatch):
+    file_path = tmp_path / "pupils.csv"
+    write_pupils_file(file_path, 2000)
+
+    # Split the small file into several ranges, the last holding the blank
+    # and alphanumeric identifiers
+    monkeypatch.setattr(parallel_csv, "MIN_RANGE_BYTES", 1024)
+
+    assert len(parallel_csv.get_byte_ranges(file_path, 8)) > 1
+
+    df = parallel_csv.read_csv_parallel(file_path, PUPIL_IMPORT_COLS, PUPIL_DTYPES,
+                                        filter_ncmp, workers=2)
+
+    expected = filter_ncmp(pd.read_csv(file_path, usecols=PUPIL_IMPORT_COLS, dtype=PUPIL_DTYPES))
+
+    pd.testing.assert_frame_equal(df, expected)
+
+    # Identifiers are strings in every range, as from the SQL data
+    assert df.loc[0, "SchoolUrn"] == "100101"
+    assert df.loc[0, "NcmpSystemId"] == "0"
+    assert df["SchoolUrn"].isna().sum() == 10
+    assert df["NcmpSystemId"].map(type).eq(str).all()
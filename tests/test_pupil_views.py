@@ -0,0 +1,38 @@
+"""
+Purpose of script: checks that the pupil views share the memory of the
+imported pupil data rather than copying it, on the pinned pandas version.
+"""
+import numpy as np
+import pandas as pd
+
+from ncmp_inyear_code.utilities.pupil_views import create_pupil_view
+
+
+def create_pupils():
+    """
+    Returns a small imported pupil frame with columns of several types
+    """
+    return pd.DataFrame({"Bmi": [15.2, 17.8, 21.4, 16.0],
+                         "BmiPScore": [0.21, 0.55, 0.97, 0.40],
+                         "NcmpSystemId": [1, 2, 3, 4],
+                         "SchoolYear": ["R", "6", "6", "R"]})
+
+
+def test_view_shares_memory_with_source_columns():
+    df = create_pupils()
+
+    view = create_pupil_view(df, list(df.columns),
+                             derived={"Obese": df["BmiPScore"] >= 0.95})
+
+    for col in df.columns:
+        assert np.shares_memory(view[col].to_numpy(), df[col].to_numpy()), col
+
+
+def test_renamed_view_shares_memory_with_source_columns():
+    df = create_pupils()
+
+    view = create_pupil_view(df, {"Bmi": "BmiValue", "BmiPScore": "PScore"})
+
+    assert list(view.columns) == ["BmiValue", "PScore"]
+    assert np.shares_memory(view["BmiValue"].to_numpy(), df["Bmi"].to_numpy())
+    assert np.shares_memory(view["PScore"].to_numpy(), df["BmiPScore"].to_numpy())
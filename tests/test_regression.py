@@ -0,0 +1,22 @@
+"""
+Purpose of script: checks every table created from the synthetic inputs
+matches the golden outputs committed in tests/regression_golden.
+"""
+import pytest
+
+from ncmp_inyear_code.create_publication_inyear import TABLE_FUNCTIONS, build_table
+from ncmp_inyear_code.utilities import regression_check
+
+
+@pytest.fixture(scope="module")
+def synthetic_inputs():
+    with regression_check.pinned_params():
+        yield regression_check.create_synthetic_inputs()
+
+
+@pytest.mark.parametrize("table", sorted(TABLE_FUNCTIONS))
+def test_table_matches_golden_outputs(table, synthetic_inputs):
+    with regression_check.pinned_params():
+        outputs = regression_check.add_export_tests(table, build_table(table, synthetic_inputs))
+
+        assert regression_check.compare_golden(table, outputs) == []
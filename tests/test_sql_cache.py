@@ -0,0 +1,42 @@
+"""
+Purpose of script: checks that dry runs report SQL imports as cached only
+when the query result cache holds an unexpired result of the query rendered
+for the run.
+"""
+import pandas as pd
+
+import ncmp_inyear_code.parameters_inyear as param
+import ncmp_inyear_code.utilities.import_inyeardata as import_inyeardata
+from ncmp_inyear_code.create_publication_inyear import import_cache_status
+from ncmp_inyear_code.utilities.sql_cache import get_query_key, write_parts
+
+
+def cache_query(query, ttl_days):
+    """
+    Stores a query result in the query result cache
+    """
+    key = get_query_key(query, import_inyeardata.SQL_SERVER, import_inyeardata.SQL_DATABASE)
+
+    for _ in write_parts(key, iter([pd.DataFrame({"NcmpSystemId": ["1"]})]), query,
+                         import_inyeardata.SQL_SERVER, import_inyeardata.SQL_DATABASE, ttl_days):
+        pass
+
+
+def test_sql_import_cache_status(tmp_path, monkeypatch):
+    monkeypatch.setattr(param, "SQL_CACHE", True)
+    monkeypatch.setattr(param, "SQL_CACHE_DIR", tmp_path)
+    monkeypatch.setattr(param, "IY_COMPYEAR", "2018/19")
+
+    assert import_cache_status("df_pupils_compyear") == "uncached"
+
+    cache_query(import_inyeardata.render_query("query_pupils_compyear.sql", "<IY_COMPYEAR>", "2018/19"), 1)
+    cache_query(import_inyeardata.render_query("query_la_compyear.sql", "<IY_COMPYEAR>", "2018/19"), 0)
+
+    assert import_cache_status("df_pupils_compyear").startswith("cached")
+
+    # Expired result, and result of the query for another year
+    assert import_cache_status("df_la_compyear") == "uncached"
+
+    monkeypatch.setattr(param, "IY_COMPYEAR", "2017/18")
+
+    assert import_cache_status("df_pupils_compyear") == "uncached"
@@ -0,0 +1,47 @@
+"""
+Purpose of script: checks that the weighted outputs by upper tier LA and
+region place pupils at schools over an LA boundary consistently.
+"""
+import pandas as pd
+
+from ncmp_inyear_code.utilities.table_weighting import create_weighted_geography
+
+
+def test_cross_boundary_pupils_in_region_of_upper_tier_la():
+    # Upper tier LA E06000001 is submitted by LA 800, apart from one pupil at
+    # a school just over the boundary submitted by LA 801 (in another region)
+    df = pd.DataFrame({"UpperTierLA": ["E06000001"] * 4 + ["E06000002"] * 2,
+                       "OrgCode": [800, 800, 800, 801, 801, 801],
+                       "SchoolYear": "R",
+                       "Year_ref": ["ThisYear", "CompYear"] * 3,
+                       "BmiPopulationCategory": "healthy weight",
+                       "Weight": [1.0, 1.0, 2.0, 1.5, 1.0, 1.0]})
+
+    df_la_lookups = pd.DataFrame({"LACode": [800, 801],
+                                  "PHERegionalOffice": ["North East", "North West"]})
+
+    outputs = create_weighted_geography(df, df_la_lookups)
+
+    df_utla = outputs["WeightedUTLA"].set_index("UpperTierLA")
+    df_region = outputs["WeightedRegion"].set_index("Region")
+
+    # Each region holds exactly the pupils of the upper tier LAs in it
+    assert df_region.loc["North East", "ValueThisYear"] == df_utla.loc["E06000001", "ValueThisYear"]
+    assert df_region.loc["North East", "ValueCompYear"] == df_utla.loc["E06000001", "ValueCompYear"]
+    assert df_region.loc["North West", "CountThisYear"] == df_utla.loc["E06000002", "CountThisYear"]
+    assert df_region["CountThisYear"].sum() == df_utla["CountThisYear"].sum()
+
+
+def test_upper_tier_la_of_unknown_la_in_region_unknown():
+    df = pd.DataFrame({"UpperTierLA": ["E06000001", "E06000001", "E06000003", "E06000003"],
+                       "OrgCode": [800, 800, 999, 999],
+                       "SchoolYear": "6",
+                       "Year_ref": ["ThisYear", "CompYear"] * 2,
+                       "BmiPopulationCategory": "obese",
+                       "Weight": 1.0})
+
+    df_la_lookups = pd.DataFrame({"LACode": [800], "PHERegionalOffice": ["North East"]})
+
+    df_region = create_weighted_geography(df, df_la_lookups)["WeightedRegion"]
+
+    assert sorted(df_region["Region"]) == ["North East", "Unknown"]